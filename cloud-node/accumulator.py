@@ -0,0 +1,335 @@
+import time
+
+import numpy as np
+
+from update_encoding import dequantize
+
+
+DEFAULT_DTYPE = "float32"
+
+class WeightedAccumulator(object):
+    """
+    Session-scoped accumulator for the running weighted average of the updates
+    sent by the libraries.
+
+    One contiguous buffer is preallocated per layer (in `dtype`) the first time
+    an update is added. Every update is then folded in place into an
+    unnormalized weighted sum, and the division by the sum of the omegas only
+    happens when the average is read.
+
+    Updates can either be a list of arrays (one per layer) or a single flat
+    array, and the average is returned in the same layout. Quantized (`int8`)
+    updates are dequantized on the fly while they're folded in, and sparse
+    updates are scatter-added (see `add_sparse()`).
+
+    When `batch_size` is greater than 1, updates are staged in a bounded queue
+    instead of being folded in one at a time. The queue is flushed with a
+    single stacked weighted reduction per layer (a dot product over the omega
+    vector) once it holds `batch_size` updates, once the oldest staged update
+    is older than `batch_timeout_ms`, or when the average is read.
+
+    Args:
+        dtype (str, optional): The dtype of the preallocated buffers. Defaults
+            to `float32`.
+        batch_size (int, optional): The number of updates to stage before
+            flushing. Defaults to 1 (no batching).
+        batch_timeout_ms (float, optional): The maximum time in milliseconds
+            an update can stay staged. Defaults to `None` (no timeout).
+    """
+
+    def __init__(self, dtype=DEFAULT_DTYPE, batch_size=1, batch_timeout_ms=None):
+        self.dtype = np.dtype(dtype)
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_timeout_ms = batch_timeout_ms
+        self.sigma_omega = 0
+        self._buffers = None
+        self._scratch = None
+        self._flat = False
+        self._average = None
+        self._staged = None
+        self._staged_omegas = None
+        self._num_staged = 0
+        self._staged_since = None
+
+    def __len__(self):
+        return len(self._buffers) if self._buffers is not None else 0
+
+    def __repr__(self):
+        return "WeightedAccumulator(dtype={0}, layers={1}, sigma_omega={2}, " \
+            "staged={3})".format(self.dtype, len(self), self.sigma_omega, \
+            self._num_staged)
+
+    @property
+    def layout(self):
+        """
+        The shapes of the layers, or `None` if no update was added yet.
+        """
+        if self._buffers is None:
+            return None
+        return tuple(buffer.shape for buffer in self._buffers)
+
+    @property
+    def empty(self):
+        """
+        Whether no update has been folded in yet.
+        """
+        return self.sigma_omega == 0
+
+    def add(self, values, omega, scales=None, zero_points=None, discount=1.0):
+        """
+        Fold (or stage, when batching) a new update into the weighted sum.
+
+        Args:
+            values (list or np.ndarray): The new update, either a list of
+                arrays (one per layer) or a single flat array.
+            omega (float): The weight of the new update.
+            scales (list, optional): The scale of every layer, if the update
+                is quantized.
+            zero_points (list, optional): The zero-point of every layer, if
+                the update is quantized.
+            discount (float, optional): Scales the update without counting
+                towards the sum of the omegas (e.g. for stale updates), so it
+                shrinks the average instead of only reweighting it.
+        """
+        layers = self._as_layers(values)
+        if self._buffers is None:
+            self._allocate([np.shape(layer) for layer in layers])
+        layers = self._check_layout(layers)
+        quantization = self._quantization(scales, zero_points, len(layers))
+
+        omega = float(omega)
+        weight = omega * float(discount)
+        if self.batch_size == 1:
+            self._fold(layers, weight, quantization)
+        else:
+            self._stage(layers, weight, quantization)
+            if self._num_staged == self.batch_size or self._flush_is_due():
+                self.flush()
+
+        self.sigma_omega += omega
+        self._average = None
+
+    def add_sparse(self, indices, values, shapes, omega, scales=None, \
+            zero_points=None, discount=1.0):
+        """
+        Scatter-add a sparse update into the weighted sum.
+
+        Sparse updates are always folded in right away (never staged), since
+        they only touch a few entries of every layer.
+
+        Args:
+            indices (list): The indices (into the flattened layer) of the
+                entries sent for every layer.
+            values (list): The values of the entries sent for every layer.
+            shapes (list): The shape of every layer.
+            omega (float): The weight of the new update.
+            scales (list, optional): The scale of every layer, if the values
+                are quantized.
+            zero_points (list, optional): The zero-point of every layer, if
+                the values are quantized.
+            discount (float, optional): Scales the update without counting
+                towards the sum of the omegas (see `add()`).
+        """
+        shapes = [tuple(shape) for shape in shapes]
+        if self._buffers is None:
+            self._allocate(shapes)
+        self._check_shapes(shapes)
+        quantization = self._quantization(scales, zero_points, len(shapes))
+        if len(indices) != len(shapes) or len(values) != len(shapes):
+            raise ValueError("Sparse update doesn't have {} layers!".format(
+                len(shapes)))
+
+        omega = float(omega)
+        weight = omega * float(discount)
+        for buffer, layer_indices, layer_values, params in zip(self._buffers, \
+                indices, values, quantization):
+            layer_indices = np.asarray(layer_indices, dtype=np.intp)
+            layer_values = np.asarray(layer_values)
+            if layer_indices.shape != layer_values.shape \
+                    or layer_indices.ndim != 1:
+                raise ValueError("Sparse layer indices don't match its values!")
+            if layer_indices.size and (layer_indices.min() < 0 \
+                    or layer_indices.max() >= buffer.size):
+                raise ValueError("Sparse layer index out of bounds!")
+
+            scratch = self._scratch[:layer_values.size]
+            if params is None:
+                np.multiply(layer_values, weight, out=scratch)
+            else:
+                scale, zero_point = params
+                dequantize(layer_values, scale * weight, zero_point, scratch)
+            np.add.at(buffer.reshape(-1), layer_indices, scratch)
+
+        self.sigma_omega += omega
+        self._average = None
+
+    def flush(self):
+        """
+        Fold all staged updates into the weighted sum with one stacked
+        reduction per layer.
+        """
+        if not self._num_staged:
+            return
+
+        num_staged = self._num_staged
+        omegas = self._staged_omegas[:num_staged]
+        for buffer, staged in zip(self._buffers, self._staged):
+            scratch = self._scratch[:buffer.size]
+            np.dot(omegas, staged[:num_staged].reshape(num_staged, -1), \
+                out=scratch)
+            np.add(buffer, scratch.reshape(buffer.shape), out=buffer)
+
+        self._num_staged = 0
+        self._staged_since = None
+
+    def flush_if_due(self):
+        """
+        Flush the staged updates if the oldest one has timed out.
+
+        Returns:
+            bool: Returns `True` if a flush happened, `False` otherwise.
+        """
+        if self._num_staged and self._flush_is_due():
+            self.flush()
+            return True
+        return False
+
+    def average(self):
+        """
+        Normalize the weighted sum by the sum of the omegas.
+
+        The result is cached until the next update is folded in.
+
+        Returns:
+            list or np.ndarray: The weighted average, in the same layout as
+                the updates that were added, or `None` if nothing was added.
+        """
+        if self.empty:
+            return None
+
+        self.flush()
+        if self._average is None:
+            sigma_omega = float(self.sigma_omega)
+            self._average = [np.divide(buffer, sigma_omega) \
+                for buffer in self._buffers]
+
+        return self._average[0] if self._flat else self._average
+
+    def reset(self):
+        """
+        Zero the weighted sum, keeping the preallocated buffers around.
+        """
+        if self._buffers is not None:
+            for buffer in self._buffers:
+                buffer.fill(0)
+        self.sigma_omega = 0
+        self._average = None
+        self._num_staged = 0
+        self._staged_since = None
+
+    def _as_layers(self, values):
+        """
+        Normalize an update into a list of layers.
+        """
+        if isinstance(values, np.ndarray) and values.dtype != object:
+            self._flat = True
+            return [values]
+        return values
+
+    def _check_layout(self, layers):
+        """
+        Make sure the update has the same layout as the buffers.
+        """
+        layers = [np.asarray(layer) for layer in layers]
+        self._check_shapes([layer.shape for layer in layers])
+        return layers
+
+    def _check_shapes(self, shapes):
+        """
+        Make sure the layers of an update have the same shapes as the buffers.
+        """
+        if len(shapes) != len(self._buffers):
+            raise ValueError("Update has {0} layers, expected {1}!".format(
+                len(shapes), len(self._buffers)))
+
+        for buffer, shape in zip(self._buffers, shapes):
+            if shape != buffer.shape:
+                raise ValueError("Update layer has shape {0}, expected {1}!" \
+                    .format(shape, buffer.shape))
+
+    def _quantization(self, scales, zero_points, num_layers):
+        """
+        Pair up the scale and zero-point of every layer (`None` for every
+        layer if the update isn't quantized).
+        """
+        if scales is None:
+            return [None] * num_layers
+
+        quantization = list(zip(scales, zero_points))
+        if len(quantization) != num_layers:
+            raise ValueError("Update has {0} scales, expected {1}!".format(
+                len(quantization), num_layers))
+        return quantization
+
+    def _fold(self, layers, omega, quantization):
+        """
+        Fold a single update into the weighted sum, in place.
+        """
+        for buffer, layer, params in zip(self._buffers, layers, quantization):
+            scratch = self._scratch[:buffer.size].reshape(buffer.shape)
+            if params is None:
+                np.multiply(layer, omega, out=scratch)
+            else:
+                scale, zero_point = params
+                dequantize(layer, scale * omega, zero_point, scratch)
+            np.add(buffer, scratch, out=buffer)
+
+    def _stage(self, layers, omega, quantization):
+        """
+        Copy (or dequantize) an update into the next free slot of the staging
+        queue.
+        """
+        if self._staged is None:
+            self._staged = [np.empty((self.batch_size,) + buffer.shape, \
+                dtype=self.dtype) for buffer in self._buffers]
+            self._staged_omegas = np.empty(self.batch_size, dtype=self.dtype)
+
+        index = self._num_staged
+        for staged, layer, params in zip(self._staged, layers, quantization):
+            if params is None:
+                staged[index] = layer
+            else:
+                scale, zero_point = params
+                dequantize(layer, scale, zero_point, staged[index])
+        self._staged_omegas[index] = omega
+
+        if not self._num_staged:
+            self._staged_since = time.time()
+        self._num_staged += 1
+
+    @property
+    def flush_deadline(self):
+        """
+        When the oldest staged update times out (as a timestamp), or `None`
+        if no update is staged or there's no timeout.
+        """
+        if self.batch_timeout_ms is None or self._staged_since is None:
+            return None
+        return self._staged_since + self.batch_timeout_ms / 1000
+
+    def _flush_is_due(self):
+        """
+        Whether the oldest staged update has been waiting for longer than
+        `batch_timeout_ms`.
+        """
+        flush_deadline = self.flush_deadline
+        return flush_deadline is not None and time.time() >= flush_deadline
+
+    def _allocate(self, shapes):
+        """
+        Preallocate one buffer per layer and a scratch buffer large enough
+        for the biggest layer.
+        """
+        self._buffers = [np.zeros(shape, dtype=self.dtype) for shape in shapes]
+        max_size = max([buffer.size for buffer in self._buffers] + [1])
+        self._scratch = np.empty(max_size, dtype=self.dtype)
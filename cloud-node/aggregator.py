@@ -1,22 +1,40 @@
 import time
 import logging
+from collections import deque
 
 import numpy as np
 
 import state
+from accumulator import WeightedAccumulator, DEFAULT_DTYPE
+from update_encoding import encode_update, decode_update
 from updatestore import store_update
-from coordinator import start_next_round, stop_session
-from model import swap_weights, save_mlmodel_weights
+from coordinator import start_next_round, start_next_version, \
+    hand_out_version, stop_session, METRIC_HISTORY_SIZE
+from model import swap_weights, save_mlmodel_weights, \
+    get_committed_flat_weights
 from message import ClientType, LibraryType, ActionType, ErrorType, make_error_results
 
 
+DEFAULT_BUFFER_SIZE = 10
+DEFAULT_STALENESS_EXPONENT = 0.5
+METRICS = ("loss", "accuracy")
+
 logging.basicConfig(level=logging.ERROR)
 
-def handle_new_update(message, clients_dict):
+def handle_new_update(repo_state, message, clients_dict):
     """
     Handle new weights from a Library.
 
+    In asynchronous sessions (`mode` is `ASYNC` in the aggregation config)
+    there's no round barrier: updates trained on older versions of the model
+    (up to `max_staleness` versions old, if set) are accepted, with their
+    weights discounted by `(1 + staleness) ** -staleness_exponent`. Every
+    `buffer_size` updates are committed into a new version, and the node that
+    sent the update is handed the latest version right away. The
+    continuation criteria don't apply.
+
     Args:
+        repo_state (RepoState): The state of the repo.
         message (NewUpdateMessage): The `NEW_UPDATE` message sent to the server.
         clients_dict (dict): Dictionary of clients, keyed by type of client
             (either `LIBRARY` or `DASHBOARD`).
@@ -28,66 +46,200 @@ def handle_new_update(message, clients_dict):
     results = {"action": ActionType.DO_NOTHING, "error": False}
 
     # 1. Check things match.
-    if (state.state["library_type"] == LibraryType.IOS_IMAGE.value \
-            or state.state["library_type"] == LibraryType.IOS_TEXT.value) \
-            and state.state["dataset_id"] != message.dataset_id:
+    if (repo_state["library_type"] == LibraryType.IOS_IMAGE.value \
+            or repo_state["library_type"] == LibraryType.IOS_TEXT.value) \
+            and repo_state["dataset_id"] != message.dataset_id:
         error_message = "The dataset ID in the message doesn't match the service's."
         return make_error_results(error_message, ErrorType.NEW_UPDATE)
 
-    if state.state["session_id"] != message.session_id:
+    if repo_state["session_id"] != message.session_id:
         error_message = "The session ID in the message doesn't match the service's."
         return make_error_results(error_message, ErrorType.NEW_UPDATE)
 
-    if state.state["current_round"] != message.round:
+    staleness = state.get_staleness(repo_state["current_round"], \
+        message.round, repo_state["max_staleness"])
+    if staleness is None:
         error_message = "The round in the message doesn't match the current round."
+        if repo_state["asynchronous"]:
+            error_message = "The update in the message is too stale."
         return make_error_results(error_message, ErrorType.NEW_UPDATE)
 
-    state.state["last_message_time"] = time.time()
+    repo_state["last_message_time"] = time.time()
 
-    # 2. Do running weighted average on the new weights.
-    _do_running_weighted_average(message)
+    # 2. Fold the new weights into the running weighted average. The model
+    #    itself is only updated once the round is over.
+    _do_running_weighted_average(repo_state, message, staleness)
+    _record_update_metrics(repo_state, message)
 
     # 3. Update the number of nodes averaged (+1)
-    state.state["num_nodes_averaged"] += 1
+    repo_state["num_nodes_averaged"] += 1
 
     # 4. Save binary received weights, if received.
     # NOTE: This only used after the first round of training with IOS_TEXT.
     if message.binary_weights:
-        save_mlmodel_weights(binary_weights)
-    
-    # 5. Swap in the newly averaged weights for this model.
-    swap_weights()
-
-    # 6. Store the model in S3, following checkpoint frequency constraints.
-    if state.state["current_round"] % state.state["checkpoint_frequency"] == 0:
-        store_update("ROUND_COMPLETED", message)
-
-    # 7. If 'Continuation Criteria' is met...
-    if check_continuation_criteria():
-        # 7.a. Update round number (+1)
-        state.state["current_round"] += 1
-
-        # 7.b. If 'Termination Criteria' isn't met, then kickstart a new FL round
-        # NOTE: We need a way to swap the weights from the initial message
-        # in node............
-        if not check_termination_criteria():
-            print("Going to the next round...")
-            results = start_next_round(clients_dict[ClientType.LIBRARY])
-
-    # 8. If 'Termination Criteria' is met...
-    # (NOTE: can't and won't happen with step 7.b.)
-    if check_termination_criteria():
-        # 8.a. Reset all state in the service and mark BUSY as false
-        results = stop_session(message.repo_id, clients_dict)
+        save_mlmodel_weights(repo_state, message.binary_weights)
+
+    if repo_state["asynchronous"]:
+        return _handle_async_update(repo_state, message, clients_dict)
+
+    # 5. If 'Continuation Criteria' is met, close the round (and kickstart a
+    #    new one if 'Termination Criteria' isn't met).
+    if check_continuation_criteria(repo_state):
+        results = _close_round(repo_state, clients_dict, message)
+
+    # 6. If 'Termination Criteria' is met...
+    # (NOTE: can't and won't happen with step 5.)
+    if check_termination_criteria(repo_state):
+        # 6.a. Reset all state in the service and mark BUSY as false
+        results = stop_session(repo_state, clients_dict)
+
+    return results
+
+def handle_round_deadline(repo_state, session_id, round, clients_dict):
+    """
+    Handle a round deadline (see `ROUND_DEADLINE` in the continuation
+    criteria) that expired: close the round with whatever has been
+    aggregated so far, if the continuation criteria is met.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        session_id (str): The session the deadline is for.
+        round (int): The round the deadline is for.
+        clients_dict (dict): Dictionary of clients, keyed by type of client
+            (either `LIBRARY` or `DASHBOARD`).
+
+    Returns:
+        dict: Returns a dictionary detailing whether an error occurred and
+            if there was no error, what the next action is.
+    """
+    results = {"action": ActionType.DO_NOTHING, "error": False}
+
+    # 1. Check the deadline is for the current round.
+    if not repo_state["busy"] or repo_state["session_id"] != session_id \
+            or repo_state["current_round"] != round or not clients_dict:
+        return results
+
+    if not clients_dict[ClientType.DASHBOARD]:
+        # Stopping session as the session starter has disconnected.
+        print("Disconnected from dashboard client, stopping session.")
+        return stop_session(repo_state, clients_dict)
+
+    # 2. If 'Continuation Criteria' is met, close the round.
+    if check_continuation_criteria(repo_state):
+        print("Round {} deadline expired, closing the round...".format(round))
+        results = _close_round(repo_state, clients_dict)
+
+    # 3. If 'Termination Criteria' is met...
+    if check_termination_criteria(repo_state):
+        results = stop_session(repo_state, clients_dict)
+
+    return results
+
+def handle_session_deadline(repo_state, session_id, clients_dict):
+    """
+    Handle a wall-clock budget (see `WALL_CLOCK` in the termination criteria)
+    that expired: stop the session, if the termination criteria is met.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        session_id (str): The session the budget is for.
+        clients_dict (dict): Dictionary of clients, keyed by type of client
+            (either `LIBRARY` or `DASHBOARD`).
+
+    Returns:
+        dict: Returns a dictionary detailing whether an error occurred and
+            if there was no error, what the next action is.
+    """
+    # 1. Check the budget is for the current session.
+    if not repo_state["busy"] or repo_state["session_id"] != session_id \
+            or not clients_dict:
+        return {"action": ActionType.DO_NOTHING, "error": False}
+
+    # 2. If 'Termination Criteria' is met, stop the session.
+    # NOTE: With `ALL_OF`, the other criteria may not be met yet. They're
+    # checked again with the next update then.
+    if check_termination_criteria(repo_state):
+        print("Session wall-clock budget expired, stopping session...")
+        return stop_session(repo_state, clients_dict)
+
+    return {"action": ActionType.DO_NOTHING, "error": False}
+
+def _handle_async_update(repo_state, message, clients_dict):
+    """
+    Finish handling an update in an asynchronous session: commit the buffer
+    into a new version of the model once it's full, and hand the latest
+    version to the node that sent the update.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        message (NewUpdateMessage): The `NEW_UPDATE` message sent to the server.
+        clients_dict (dict): Dictionary of clients, keyed by type of client
+            (either `LIBRARY` or `DASHBOARD`).
+
+    Returns:
+        dict: Returns a dictionary detailing whether an error occurred and
+            if there was no error, what the next action is.
+    """
+    aggregation_config = repo_state["initial_message"].aggregation_config
+    buffer_size = aggregation_config.get("buffer_size", DEFAULT_BUFFER_SIZE)
+    if repo_state["num_nodes_averaged"] >= buffer_size:
+        _close_round(repo_state, clients_dict, message)
+
+    if check_termination_criteria(repo_state):
+        return stop_session(repo_state, clients_dict)
+    return hand_out_version(repo_state, message.round)
+
+def _close_round(repo_state, clients_dict, message=None):
+    """
+    Close the current round: commit its averaged weights, checkpoint them
+    and kickstart the next round (unless 'Termination Criteria' is met). In
+    asynchronous sessions, the next round (version) isn't broadcast.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        clients_dict (dict): Dictionary of clients, keyed by type of client
+            (either `LIBRARY` or `DASHBOARD`).
+        message (NewUpdateMessage, optional): The message that closed the
+            round, if any.
+
+    Returns:
+        dict: The results of starting the next round, if any.
+    """
+    results = {"action": ActionType.DO_NOTHING, "error": False}
+
+    # 1. Swap in the averaged weights of this round for this model.
+    accumulator = repo_state.get("accumulator")
+    if accumulator is not None and not accumulator.empty:
+        _commit_round(repo_state)
+
+        # 2. Store the model in S3, following checkpoint frequency
+        # constraints.
+        if repo_state["current_round"] % repo_state["checkpoint_frequency"] == 0:
+            store_update(repo_state, "ROUND_COMPLETED", message)
+
+    # 3. Update round number (+1)
+    repo_state["current_round"] += 1
+
+    # 4. If 'Termination Criteria' isn't met, then kickstart a new FL round
+    # NOTE: We need a way to swap the weights from the initial message
+    # in node............
+    if not check_termination_criteria(repo_state):
+        print("Going to the next round...")
+        if repo_state["asynchronous"]:
+            start_next_version(repo_state)
+        else:
+            results = start_next_round(repo_state, \
+                clients_dict[ClientType.LIBRARY])
 
     return results
 
-def handle_no_dataset(message, clients_dict):
+def handle_no_dataset(repo_state, message, clients_dict):
     """
     Handle `NO_DATASET` message from a Library. Reduce the number of chosen
     nodes by 1 and then check the continuation/termination criteria again.
 
     Args:
+        repo_state (RepoState): The state of the repo.
         message (NoDatasetMessage): The `NO_DATASET` message sent to the server.
         clients_dict (dict): Dictionary of clients, keyed by type of client
             (either `LIBRARY` or `DASHBOARD`).
@@ -97,104 +249,263 @@ def handle_no_dataset(message, clients_dict):
             if there was no error, what the next action is.
     """
     # 1. Check things match.
-    if (state.state["library_type"] == LibraryType.IOS_IMAGE.value \
-            or state.state["library_type"] == LibraryType.IOS_TEXT.value) \
-            and state.state["dataset_id"] != message.dataset_id:
+    if (repo_state["library_type"] == LibraryType.IOS_IMAGE.value \
+            or repo_state["library_type"] == LibraryType.IOS_TEXT.value) \
+            and repo_state["dataset_id"] != message.dataset_id:
         error_message = "The dataset ID in the message doesn't match the service's."
         return make_error_results(error_message, ErrorType.NO_DATASET)
 
-    if state.state["session_id"] != message.session_id:
+    if repo_state["session_id"] != message.session_id:
         error_message = "The session ID in the message doesn't match the service's."
         return make_error_results(error_message, ErrorType.NO_DATASET)
 
-    if state.state["current_round"] != message.round:
+    if repo_state["current_round"] != message.round:
         error_message = "The round in the message doesn't match the current round."
         return make_error_results(error_message, ErrorType.NO_DATASET)
 
     # 2. Reduce the number of chosen nodes by 1.
-    state.state["num_nodes_chosen"] -= 1
+    repo_state["num_nodes_chosen"] -= 1
 
     # 3. If there are no nodes left in this round, cancel the session.
-    if state.state["num_nodes_chosen"] == 0:
+    if repo_state["num_nodes_chosen"] == 0:
         state.reset_state(message.repo_id)
         error_message = "No nodes in this round have the specified dataset!"
         client_list = clients_dict[ClientType.DASHBOARD]
         return make_error_results(error_message, ErrorType.NEW_SESSION, \
             action=ActionType.BROADCAST, client_list=client_list)
 
-    # 4. If 'Continuation Criteria' is met...
-    if check_continuation_criteria():
-        # 4.a. Update round number (+1)
-        state.state["current_round"] += 1
-
-        # 4.b. If 'Termination Criteria' isn't met, then kickstart a new FL round
-        # NOTE: We need a way to swap the weights from the initial message
-        # in node............
-        if not check_termination_criteria():
-            print("Going to the next round...")
-            return start_next_round(clients_dict[ClientType.LIBRARY])
+    # 4. If 'Continuation Criteria' is met, close the round just like a
+    # last update would.
+    if check_continuation_criteria(repo_state):
+        results = _close_round(repo_state, clients_dict)
+        if not check_termination_criteria(repo_state):
+            return results
 
     # 5. If 'Termination Criteria' is met...
     # (NOTE: can't and won't happen with step 7.b.)
-    if check_termination_criteria():
+    if check_termination_criteria(repo_state):
         # 4.a. Reset all state in the service and mark BUSY as false
         print("Session finished!")
-        return stop_session(message.repo_id, clients_dict)
+        return stop_session(repo_state, clients_dict)
 
     return {"action": ActionType.DO_NOTHING, "error": False}
 
 
-def _do_running_weighted_average(message):
+def _do_running_weighted_average(repo_state, message, staleness=0):
     """
-    Runs running weighted average with the new weights and the current weights
-    and changes the global state with the result.
+    Folds the new weights into the session's accumulator (or stages them, if
+    the session batches its aggregation). The division by the sum of the
+    omegas is deferred until the average is read with
+    `_read_running_weighted_average()`.
 
     Args:
+        repo_state (RepoState): The state of the repo.
         message (NewUpdateMessage): The `NEW_UPDATE` message sent to the server.
+        staleness (int, optional): How many versions of the model behind the
+            current one the update was trained on. Stale updates are
+            discounted, so they move the model less.
     """
-    key = "current_gradients" if state.state["use_gradients"] else "current_weights"    
+    key = "current_gradients" if repo_state["use_gradients"] else "current_weights"
     new_values = message.gradients if key == 'current_gradients' else message.weights
 
-    if state.state[key] is None or state.state["sigma_omega"] is None:
-        state.state[key] = new_values
-        state.state["sigma_omega"] = message.omega
-        return
+    aggregation_config = repo_state["initial_message"].aggregation_config
+    discount = 1.0
+    if staleness:
+        exponent = aggregation_config.get("staleness_exponent", \
+            DEFAULT_STALENESS_EXPONENT)
+        discount = (1 + staleness) ** -exponent
+
+    accumulator = repo_state.get("accumulator")
+    if accumulator is None:
+        accumulator = WeightedAccumulator(
+            dtype=aggregation_config.get("dtype", DEFAULT_DTYPE),
+            batch_size=aggregation_config.get("batch_size", 1),
+            batch_timeout_ms=aggregation_config.get("batch_timeout_ms", None),
+        )
+        repo_state["accumulator"] = accumulator
+
+    if message.indices is not None:
+        accumulator.add_sparse(message.indices, new_values, message.shapes, \
+            message.omega, message.scales, message.zero_points, discount)
+    else:
+        accumulator.add(new_values, message.omega, message.scales, \
+            message.zero_points, discount)
+        # NOTE: Only dense updates have the accumulator's layout.
+        repo_state["update_layout"] = accumulator.layout
+    repo_state["sigma_omega"] = accumulator.sigma_omega
+
+def _read_running_weighted_average(repo_state):
+    """
+    Normalizes the session's accumulator and changes the global state with the
+    resulting weighted average.
+
+    If the session has a server optimizer (`server_optimizer` in the
+    aggregation config), the averaged gradients are a pseudo-gradient and
+    the optimizer's step is used instead (see `server_optimizer.py`). When
+    the libraries average weights, the pseudo-gradient is the difference
+    between the previous weights and the averaged ones, and the optimizer's
+    step is taken from the previous weights.
+
+    For Python libraries, the averaged gradients are also encoded with the
+    session's update encoding to be broadcast in the next round. The model is
+    then updated with the decoded gradients, so that it stays in sync with the
+    libraries' models.
 
-    # Get the variables ready
-    current_values = state.state[key]
-    sigma_omega = state.state["sigma_omega"]
-    new_omega = message.omega
+    Args:
+        repo_state (RepoState): The state of the repo.
+    """
+    key = "current_gradients" if repo_state["use_gradients"] else "current_weights"
+    average = repo_state["accumulator"].average()
+    server_optimizer = repo_state["server_optimizer"]
+    if key == "current_gradients" and server_optimizer is not None:
+        average = server_optimizer.step(average)
+    elif server_optimizer is not None:
+        previous_weights = repo_state["current_weights"]
+        if previous_weights is None:
+            previous_weights = get_committed_flat_weights(repo_state)
+        previous_weights = np.asarray(previous_weights, dtype=average.dtype)
+        step = server_optimizer.step(previous_weights - average)
+        average = previous_weights - step
+    if key == "current_gradients" \
+            and repo_state["library_type"] == LibraryType.PYTHON.value:
+        encoded_gradients = encode_update(average, repo_state["update_encoding"])
+        repo_state["encoded_gradients"] = encoded_gradients
+        average = decode_update(encoded_gradients[0], **encoded_gradients[1])
+    repo_state[key] = average
+
+def _commit_round(repo_state):
+    """
+    Materializes the averaged weights of the current round into the model and
+    resets the accumulator for the next round.
+
+    This is the only place where the model gets loaded, updated and saved, so
+    it should only happen once per round.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+    """
+    previous_weights = repo_state["current_weights"]
+    _read_running_weighted_average(repo_state)
+    swap_weights(repo_state)
+
+    # NOTE: The norm of the aggregated update, not of the server optimizer's
+    # step (the average is cached until the accumulator is reset).
+    if repo_state["use_gradients"]:
+        update_norm = _norm(repo_state["accumulator"].average())
+    elif previous_weights is not None:
+        update_norm = _norm(np.subtract(repo_state["accumulator"].average(), \
+            previous_weights))
+    else:
+        update_norm = None
+    _record_round_metrics(repo_state, update_norm)
+    repo_state["accumulator"].reset()
 
-    # Run the math
-    temp = np.multiply(current_values, float(sigma_omega))
-    temp = np.add(temp, np.multiply(new_values, float(new_omega)))
-    new_sigma_omega = sigma_omega + new_omega
-    new_weighted_avg = np.divide(temp, float(new_sigma_omega))
-    new_weighted_avg = [np.array(avg) for avg in new_weighted_avg]
+    _count_materialization(repo_state)
 
-    # Update state
-    state.state[key] = new_weighted_avg
-    state.state["sigma_omega"] = new_sigma_omega
+def _count_materialization(repo_state):
+    """
+    Count a materialization of the model in the current round, both per
+    round and in the summary published with the serving snapshot (see
+    `/stats`).
+    """
+    current_round = repo_state["current_round"]
+    materializations = repo_state["num_materializations"]
+    materializations[current_round] = materializations.get(current_round, 0) + 1
+    count = materializations[current_round]
+    print("Materialized round {0} ({1} time(s) this round).".format(
+        current_round, count))
+
+    stats = repo_state["materialization_stats"]
+    stats["materializations"] += 1
+    stats["rounds"] = len(materializations)
+    stats["max_per_round"] = max(stats["max_per_round"], count)
+
+def _record_update_metrics(repo_state, message):
+    """
+    Fold the training metrics reported with an update into the metrics of the
+    round, weighted by the update's omega.
+    """
+    round_metrics = repo_state["round_metrics"]
+    round_metrics["num_updates"] = round_metrics.get("num_updates", 0) + 1
+    for name in METRICS:
+        value = message.metrics.get(name)
+        if value is None:
+            continue
+        sigma_omega, weighted_sum = round_metrics.get(name, (0, 0))
+        round_metrics[name] = (sigma_omega + message.omega, \
+            weighted_sum + message.omega * float(value))
+
+def _record_round_metrics(repo_state, update_norm):
+    """
+    Append the metrics of the round that was just committed to the metric
+    history of the session (see `state.RoundMetrics`).
+    """
+    round_metrics = repo_state["round_metrics"]
+    averages = {}
+    for name in METRICS:
+        sigma_omega, weighted_sum = round_metrics.get(name, (0, 0))
+        averages[name] = weighted_sum / sigma_omega if sigma_omega else None
+
+    if repo_state["metric_history"] is None:
+        repo_state["metric_history"] = deque(maxlen=METRIC_HISTORY_SIZE)
+    elapsed = None
+    if repo_state["session_start_time"] is not None:
+        elapsed = time.time() - repo_state["session_start_time"]
+    repo_state["metric_history"].append(state.RoundMetrics(
+        round=repo_state["current_round"],
+        num_updates=round_metrics.get("num_updates", 0),
+        loss=averages["loss"],
+        accuracy=averages["accuracy"],
+        update_norm=update_norm,
+        elapsed=elapsed,
+    ))
+    repo_state["round_metrics"] = {}
+
+def _norm(layers):
+    """
+    Get the L2 norm of an update (a list of layers or a flat array).
+    """
+    if isinstance(layers, np.ndarray):
+        layers = [layers]
+    return float(np.sqrt(sum(np.sum(np.square(layer, dtype=np.float64)) \
+        for layer in layers)))
 
-def check_continuation_criteria():
+def check_continuation_criteria(repo_state):
     """
     Check the continuation criteria to determine whether we should start the
     next round.
 
-    Right now only implements percentage of nodes averaged.
+    The criteria can be:
+        - `PERCENTAGE_AVERAGED`: A percentage (`value`) of the chosen nodes
+          were averaged.
+        - `NUM_NODES_AVERAGED`: An absolute number (`value`) of nodes were
+          averaged (or all the chosen nodes, if there are fewer).
+        - `ROUND_DEADLINE`: The round has been open for `value` seconds, and
+          at least one node was averaged.
+        - `ANY_OF` / `ALL_OF`: Any / all of a list of `criteria` are met.
 
-    TODO: Implement an absolute number of nodes to average (NUM_NODES_AVERAGED).
+    If more nodes were chosen than the round needs (see `OVER_SELECTION` in
+    `coordinator._choose_clients()`), the nodes are counted out of the ones
+    needed.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
 
     Returns:
         bool: Returns `True` if criteria is met, `False` otherwise.
     """
-    continuation_criteria = state.state["initial_message"].continuation_criteria
+    continuation_criteria = repo_state["initial_message"].continuation_criteria
+    return _check_continuation_criterion(repo_state, continuation_criteria)
 
-    if "type" not in continuation_criteria:
+def _check_continuation_criterion(repo_state, criterion):
+    """
+    Check a single (possibly compound) continuation criterion.
+    """
+    if "type" not in criterion:
         raise Exception("Continuation criteria is not well defined.")
 
-    if continuation_criteria["type"] == "PERCENTAGE_AVERAGED":
-        if state.state["num_nodes_chosen"] == 0:
+    if criterion["type"] == "PERCENTAGE_AVERAGED":
+        if repo_state["num_nodes_chosen"] == 0:
             # TODO: Implement a lower bound of how many nodes are needed to
             # continue to the next round.
 
@@ -205,27 +516,109 @@ def check_continuation_criteria():
             # session, then the update of the first node to finish training will
             # trigger the continuation criteria.
             return False
-        percentage = state.state["num_nodes_averaged"] / state.state["num_nodes_chosen"]
-        return continuation_criteria["value"] <= percentage
+        percentage = repo_state["num_nodes_averaged"] / _num_nodes_needed(repo_state)
+        return criterion["value"] <= percentage
+    elif criterion["type"] == "NUM_NODES_AVERAGED":
+        num_nodes = criterion["value"]
+        if repo_state["num_nodes_chosen"] > 0:
+            num_nodes = min(num_nodes, _num_nodes_needed(repo_state))
+        return repo_state["num_nodes_averaged"] >= max(num_nodes, 1)
+    elif criterion["type"] == "ROUND_DEADLINE":
+        round_start_time = repo_state.get("round_start_time")
+        if round_start_time is None or repo_state["num_nodes_averaged"] == 0:
+            return False
+        return time.time() - round_start_time >= criterion["value"]
+    elif criterion["type"] == "ANY_OF":
+        return any(_check_continuation_criterion(repo_state, sub_criterion) \
+            for sub_criterion in criterion["criteria"])
+    elif criterion["type"] == "ALL_OF":
+        return all(_check_continuation_criterion(repo_state, sub_criterion) \
+            for sub_criterion in criterion["criteria"])
     else:
         raise Exception("Continuation criteria is not well defined.")
 
 
-def check_termination_criteria():
+def _num_nodes_needed(repo_state):
+    """
+    Get the number of updates the round needs: every chosen node, or only
+    the first ones to finish if more nodes were chosen than needed (see
+    `OVER_SELECTION` in `coordinator._choose_clients()`).
+    """
+    num_nodes = repo_state["num_nodes_chosen"]
+    if repo_state.get("num_nodes_target"):
+        num_nodes = min(num_nodes, repo_state["num_nodes_target"])
+    return num_nodes
+
+def check_termination_criteria(repo_state):
     """
     Check the termination criteria to determine whether training is complete.
 
-    Right now only implements a maximum amount of rounds.
+    The criteria can be:
+        - `MAX_ROUND`: More than `value` rounds were completed.
+        - `PLATEAU`: The training `metric` (`loss` or `accuracy`, averaged
+          over the updates of every round) didn't improve by more than
+          `min_delta` (defaults to 0) over the best value before the last
+          `patience` rounds (defaults to 3). Rounds without the metric don't
+          count.
+        - `UPDATE_NORM`: The norm of the last aggregated update fell below
+          `value`.
+        - `WALL_CLOCK`: The session has been running for `value` seconds.
+          Also checked when the budget expires, even if no update arrives
+          (see `handle_session_deadline`).
+        - `ANY_OF` / `ALL_OF`: Any / all of a list of `criteria` are met.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
 
     Returns:
         bool: Returns `True` if criteria is met, `False` otherwise.
     """
-    termination_criteria = state.state["initial_message"].termination_criteria
+    termination_criteria = repo_state["initial_message"].termination_criteria
+    return _check_termination_criterion(repo_state, termination_criteria)
 
-    if "type" not in termination_criteria:
+def _check_termination_criterion(repo_state, criterion):
+    """
+    Check a single (possibly compound) termination criterion.
+    """
+    if "type" not in criterion:
         raise Exception("Termination criteria is not well defined.")
 
-    if termination_criteria["type"] == "MAX_ROUND":
-        return termination_criteria["value"] < state.state["current_round"]
+    history = repo_state.get("metric_history") or ()
+    if criterion["type"] == "MAX_ROUND":
+        return criterion["value"] < repo_state["current_round"]
+    elif criterion["type"] == "PLATEAU":
+        metric = criterion.get("metric", "loss")
+        if metric not in METRICS:
+            raise Exception("Termination criteria is not well defined.")
+        return _has_plateaued(history, metric, criterion.get("patience", 3), \
+            criterion.get("min_delta", 0))
+    elif criterion["type"] == "UPDATE_NORM":
+        return bool(history) and history[-1].update_norm is not None \
+            and history[-1].update_norm < criterion["value"]
+    elif criterion["type"] == "WALL_CLOCK":
+        session_start_time = repo_state.get("session_start_time")
+        return session_start_time is not None \
+            and time.time() - session_start_time >= criterion["value"]
+    elif criterion["type"] == "ANY_OF":
+        return any(_check_termination_criterion(repo_state, sub_criterion) \
+            for sub_criterion in criterion["criteria"])
+    elif criterion["type"] == "ALL_OF":
+        return all(_check_termination_criterion(repo_state, sub_criterion) \
+            for sub_criterion in criterion["criteria"])
     else:
         raise Exception("Termination criteria is not well defined.")
+
+def _has_plateaued(history, metric, patience, min_delta):
+    """
+    Check whether a metric of the history stopped improving: none of its last
+    `patience` values beats the best one before them by more than
+    `min_delta`. The loss improves by going down, the accuracy by going up.
+    """
+    values = [getattr(row, metric) for row in history \
+        if getattr(row, metric) is not None]
+    if patience < 1 or len(values) <= patience:
+        return False
+    sign = -1 if metric == "loss" else 1
+    best_before = max(sign * value for value in values[:-patience])
+    best_since = max(sign * value for value in values[-patience:])
+    return best_since - best_before <= min_delta
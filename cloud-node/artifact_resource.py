@@ -0,0 +1,179 @@
+import os
+import mimetypes
+
+from twisted.internet import threads
+from twisted.web import http, resource, server, static
+
+import state
+import artifacts
+from message import LibraryType
+
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+def _accepted_encodings(request):
+    """
+    Get the content codings the client accepts (see `Accept-Encoding`).
+    """
+    header = request.getHeader(b"accept-encoding") or b""
+    encodings = set()
+    for coding in header.decode("latin-1").split(","):
+        parts = [part.strip() for part in coding.split(";")]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0] and quality > 0:
+            encodings.add(parts[0].lower())
+    return encodings
+
+class ArtifactResource(resource.Resource):
+    """
+    Serves the models (and weights) the libraries download at the start of
+    every round straight from Twisted, instead of through the WSGI app.
+
+    Files are streamed by Twisted's static file producer, with byte ranges
+    and strong ETags (so a conditional request gets a `304`), and the
+    precompressed variant of the file is sent to the clients that accept it.
+
+    The resource is mounted at:
+        - `/model/<session_id>/<path>`: The TFJS model.
+        - `/mlmodel/<session_id>`: The MLModel (iOS image).
+        - `/mlmodel/weights/<session_id>`: The MLModel weights (iOS text).
+        - `/keras/<session_id>`: The Keras model.
+
+    TODO: Should also have some auth token -> session id mapping (security
+    fix in the future).
+
+    Args:
+        kind (str): The kind of artifact served, `model`, `mlmodel` or
+            `keras`.
+    """
+    isLeaf = True
+
+    def __init__(self, kind):
+        resource.Resource.__init__(self)
+        self.kind = kind
+
+    def render_GET(self, request):
+        """
+        Serve the artifact the request is for.
+        """
+        path, snapshot, error_message = self._resolve(request)
+        if path is None or not os.path.isfile(path):
+            request.setResponseCode(http.NOT_FOUND)
+            return (error_message or "Artifact not found!\n").encode()
+
+        artifact = artifacts.get_artifact(path)
+        if artifact is not None:
+            return self._render_artifact(request, artifact)
+
+        d = threads.deferToThread(artifacts.publish_file, path, \
+            snapshot.current_round)
+        d.addCallback(self._finish_render, request)
+        d.addErrback(self._fail_render, request)
+        return server.NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+    def _resolve(self, request):
+        """
+        Find the file the request is for, from the serving snapshot of the
+        session.
+
+        Returns:
+            tuple: The path of the file (or `None`), the snapshot and the
+                error message.
+        """
+        segments = [segment.decode() for segment in request.postpath]
+        if self.kind == "mlmodel" and segments[:1] == ["weights"]:
+            kind, segments = "mlmodel_weights", segments[1:]
+        else:
+            kind = self.kind
+        if not segments or not segments[0]:
+            return None, None, None
+
+        snapshot = state.get_snapshot_by_session_id(segments[0])
+        if not snapshot or not snapshot.busy:
+            return None, snapshot, "No active session!\n"
+
+        if kind == "model":
+            if snapshot.library_type != LibraryType.JS.value:
+                return None, snapshot, "Current session is not for JAVASCRIPT!"
+            if snapshot.tfjs_model_path is None or len(segments) < 2:
+                return None, snapshot, None
+            folder_path = os.path.join(ROOT_PATH, snapshot.tfjs_model_path)
+            path = os.path.normpath(os.path.join(folder_path, *segments[1:]))
+            if not path.startswith(os.path.normpath(folder_path) + os.sep):
+                return None, snapshot, None
+            return path, snapshot, None
+
+        if len(segments) != 1:
+            return None, snapshot, None
+        if kind == "mlmodel":
+            library_type, path = LibraryType.IOS_IMAGE, snapshot.mlmodel_path
+        elif kind == "mlmodel_weights":
+            library_type, path = LibraryType.IOS_TEXT, \
+                snapshot.mlmodel_weights_path
+        else:
+            library_type, path = LibraryType.PYTHON, snapshot.h5_model_path
+        if snapshot.library_type != library_type.value:
+            error_message = "Current session is not for {}!".format(
+                "PYTHON" if library_type == LibraryType.PYTHON else "IOS")
+            return None, snapshot, error_message
+        if path is None:
+            return None, snapshot, None
+        return os.path.join(ROOT_PATH, path), snapshot, None
+
+    def _render_artifact(self, request, artifact):
+        """
+        Serve an artifact, or its precompressed variant.
+        """
+        path, etag, encoding = artifact.path, artifact.etag, None
+        accepted = _accepted_encodings(request)
+        for variant_encoding, _ in artifacts.ENCODINGS:
+            variant_path = artifact.variants.get(variant_encoding)
+            if variant_encoding in accepted and variant_path \
+                    and os.path.isfile(variant_path):
+                path, encoding = variant_path, variant_encoding
+                etag = "{0}-{1}".format(etag, variant_encoding)
+                break
+
+        if artifact.variants:
+            request.setHeader(b"vary", b"Accept-Encoding")
+        # NOTE: The URLs stay the same across rounds, so caches have to
+        # revalidate (which is cheap, thanks to the ETag).
+        request.setHeader(b"cache-control", b"no-cache")
+        if request.setETag('"{}"'.format(etag).encode()) is http.CACHED:
+            return b""
+
+        file_resource = static.File(path)
+        file_resource.type = mimetypes.guess_type(artifact.path)[0] \
+            or DEFAULT_CONTENT_TYPE
+        file_resource.encoding = encoding
+        return file_resource.render_GET(request)
+
+    def _finish_render(self, artifact, request):
+        """
+        Serve an artifact once it's published.
+        """
+        if request.finished or request._disconnected:
+            return
+        body = self._render_artifact(request, artifact)
+        if body is not server.NOT_DONE_YET:
+            request.write(body)
+            request.finish()
+
+    def _fail_render(self, failure, request):
+        """
+        Let the client know an artifact couldn't be published.
+        """
+        print("Error publishing artifact: " + str(failure.value))
+        if request.finished or request._disconnected:
+            return
+        request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.finish()
@@ -0,0 +1,158 @@
+import os
+import gzip
+import shutil
+import hashlib
+import mimetypes
+import threading
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MIN_COMPRESSED_SIZE = 1024
+READ_CHUNK_SIZE = 1 << 20
+
+# The precompressed variants, in order of preference.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+VARIANT_EXTENSIONS = tuple(extension for _, extension in ENCODINGS)
+
+class Artifact(namedtuple("Artifact", ["path", "size", "mtime", "etag", \
+        "variants"])):
+    """
+    A published artifact: a file served to the libraries, along with its
+    strong ETag (derived from the round it was published in and the hash of
+    its content) and the paths of its precompressed variants, keyed by
+    encoding.
+    """
+    __slots__ = ()
+
+_artifacts = {}
+_artifacts_lock = threading.Lock()
+
+def publish(path, current_round):
+    """
+    Publish an artifact (or every file in a folder of artifacts): hash it and
+    write its gzip (and brotli, if available) variants next to it, so none
+    of this happens while it's being served.
+
+    Should be called every time an artifact is written. Artifacts that
+    weren't published (or changed since) are published on their first
+    request.
+
+    Args:
+        path (str): The path of the file or folder.
+        current_round (int): The round the artifact is for.
+    """
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            file_path = os.path.join(path, filename)
+            if os.path.isfile(file_path) \
+                    and not filename.endswith(VARIANT_EXTENSIONS + (".tmp",)):
+                publish_file(file_path, current_round)
+    elif os.path.isfile(path):
+        publish_file(path, current_round)
+
+def get_artifact(path):
+    """
+    Get a published artifact, if it didn't change since it was published.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        Artifact: The artifact, or `None` if it has to be published again.
+    """
+    stat = os.stat(path)
+    with _artifacts_lock:
+        artifact = _artifacts.get(os.path.abspath(path))
+    if artifact is None \
+            or (artifact.size, artifact.mtime) != (stat.st_size, stat.st_mtime):
+        return None
+    return artifact
+
+def publish_file(path, current_round):
+    """
+    Hash a file and write its precompressed variants (see `publish()`).
+
+    Args:
+        path (str): The path of the file.
+        current_round (int): The round the artifact is for.
+
+    Returns:
+        Artifact: The published artifact.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    etag = "{0}-{1}".format(current_round, digest.hexdigest()[:32])
+
+    variants = {}
+    if stat.st_size >= MIN_COMPRESSED_SIZE:
+        for encoding, extension in ENCODINGS:
+            variant_path = _compress(path, encoding, extension)
+            if variant_path is not None:
+                variants[encoding] = variant_path
+
+    artifact = Artifact(path, stat.st_size, stat.st_mtime, etag, variants)
+    with _artifacts_lock:
+        for old_path in [p for p in _artifacts if not os.path.exists(p)]:
+            del _artifacts[old_path]
+        _artifacts[path] = artifact
+    return artifact
+
+def remove(path):
+    """
+    Remove an artifact (or a folder of artifacts) that's no longer served,
+    along with its precompressed variants.
+
+    Args:
+        path (str): The path of the file or folder.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        for extension in ("",) + VARIANT_EXTENSIONS:
+            if os.path.exists(path + extension):
+                os.remove(path + extension)
+
+    folder = os.path.join(path, "")
+    with _artifacts_lock:
+        for old_path in [p for p in _artifacts \
+                if p == path or p.startswith(folder)]:
+            del _artifacts[old_path]
+
+def _compress(path, encoding, extension):
+    """
+    Write a compressed variant of a file, keeping it only if it's smaller.
+
+    Returns:
+        str: The path of the variant, or `None` if there's none.
+    """
+    if encoding == "br" and brotli is None:
+        return None
+
+    variant_path = path + extension
+    temp_path = "{0}.{1}.tmp".format(variant_path, threading.get_ident())
+    with open(path, "rb") as source:
+        if encoding == "gzip":
+            with gzip.open(temp_path, "wb") as target:
+                shutil.copyfileobj(source, target, READ_CHUNK_SIZE)
+        else:
+            compressor = brotli.Compressor()
+            with open(temp_path, "wb") as target:
+                for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), b""):
+                    target.write(compressor.process(chunk))
+                target.write(compressor.finish())
+
+    if os.path.getsize(temp_path) >= os.path.getsize(path):
+        os.remove(temp_path)
+        return None
+    os.replace(temp_path, variant_path)
+    return variant_path
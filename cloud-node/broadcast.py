@@ -0,0 +1,292 @@
+import os
+import time
+from collections import deque
+
+from twisted.internet import reactor
+
+from tensor_frames import encode_frame, encode_json, has_tensors
+
+
+DEFER_POLICY = "defer"
+DROP_POLICY = "drop"
+SLOW_CLIENT_POLICIES = (DEFER_POLICY, DROP_POLICY)
+
+SLOW_CLIENT_POLICY = os.environ.get("SLOW_CLIENT_POLICY", DEFER_POLICY)
+MAX_CLIENT_BUFFER_SIZE = int(os.environ.get("MAX_CLIENT_BUFFER_SIZE", 16 << 20))
+MAX_DEFERRED_MESSAGES = int(os.environ.get("MAX_DEFERRED_MESSAGES", 8))
+DEFERRED_RETRY_INTERVAL = 0.05
+
+def outbound_buffer_size(client):
+    """
+    Get the number of bytes written to a client's transport that haven't been
+    sent to the network yet.
+
+    Twisted doesn't expose this, so it's read from the buffers of the TCP
+    transport (see `twisted.internet.abstract.FileDescriptor`). Transports
+    without them are considered to have an empty buffer.
+    `tests/test_broadcast.py` pins how the supported Twisted version fills
+    and drains them.
+
+    NOTE: A push producer can't be registered on the transport instead, since
+    the HTTP channel the websocket took the transport over from (see
+    `WebSocketResource`) is still registered as its producer.
+
+    Args:
+        client (CloudNodeProtocol): The client.
+
+    Returns:
+        int: The size of the outbound buffer in bytes.
+    """
+    transport = getattr(client, "transport", None)
+    if transport is None:
+        return 0
+    data_buffer = getattr(transport, "dataBuffer", b"")
+    offset = getattr(transport, "offset", 0)
+    return len(data_buffer) - offset + getattr(transport, "_tempDataLen", 0)
+
+class Broadcaster(object):
+    """
+    Fans messages out to the clients, with backpressure for the slow ones.
+
+    Every message is encoded and framed once per format (JSON or binary
+    tensor frame, see `tensor_frames.py`) as an autobahn prepared message, no
+    matter how many clients it's sent to.
+
+    A client whose outbound buffer holds more than `max_buffer_size` bytes is
+    slow. With the `defer` policy, messages to slow clients are queued (in
+    order) and sent once their buffer drains, and a client with more than
+    `max_deferred` queued messages is dropped. With the `drop` policy, slow
+    clients are dropped right away. Dropped clients are disconnected, so
+    they get unregistered like any other node that leaves.
+
+    Messages can also be dispatched in waves (see `dispatch()`), to spread
+    out the downloads the clients start when they get them.
+
+    NOTE: Must only be used from the reactor thread.
+
+    Args:
+        prepare_message (callable): Prepares a message for being sent to
+            many clients (see `WebSocketServerFactory.prepareMessage()`).
+        policy (str, optional): What to do with slow clients, `defer` or
+            `drop`.
+        max_buffer_size (int, optional): The size of the outbound buffer in
+            bytes above which a client is slow.
+        max_deferred (int, optional): The maximum number of messages queued
+            for a slow client.
+        clock (IReactorTime, optional): Schedules the retries of deferred
+            messages and the waves of dispatches.
+        on_send (callable, optional): Called with every client a message is
+            sent (or queued) to and the message.
+    """
+
+    def __init__(self, prepare_message, policy=SLOW_CLIENT_POLICY, \
+            max_buffer_size=MAX_CLIENT_BUFFER_SIZE, \
+            max_deferred=MAX_DEFERRED_MESSAGES, clock=reactor, on_send=None):
+        if policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError("Slow client policy must be one of {}!".format(
+                ", ".join(SLOW_CLIENT_POLICIES)))
+        self.prepare_message = prepare_message
+        self.policy = policy
+        self.max_buffer_size = max_buffer_size
+        self.max_deferred = max_deferred
+        self.clock = clock
+        self.on_send = on_send
+        self._deferred = {}
+        self._retry = None
+        self._dispatches = {}
+        self._dispatch_stats = {
+            "dispatches": 0,
+            "waves_sent": 0,
+            "dispatches_cancelled": 0,
+            "last_dispatch": [],
+        }
+        self._stats = {
+            "fanouts": 0,
+            "messages_sent": 0,
+            "bytes_sent": 0,
+            "messages_deferred": 0,
+            "clients_dropped": 0,
+            "total_time": 0.0,
+            "max_time": 0.0,
+            "last_time": 0.0,
+            "last_bytes": 0,
+        }
+
+    def broadcast(self, payload, client_list):
+        """
+        Send a message to every client in `client_list`.
+
+        Args:
+            payload (dict): The message.
+            client_list (list): The clients to send it to.
+        """
+        started = time.time()
+        sent_before = self._stats["bytes_sent"]
+        prepared = {}
+        binary = has_tensors(payload)
+        for client in client_list:
+            isBinary = binary and client.binary_frames
+            if isBinary not in prepared:
+                encoded = encode_frame(payload) if isBinary \
+                    else encode_json(payload)
+                prepared[isBinary] = self.prepare_message(encoded, isBinary)
+            if self.on_send is not None:
+                self.on_send(client, payload)
+            self._send(client, prepared[isBinary])
+
+        elapsed = time.time() - started
+        stats = self._stats
+        stats["fanouts"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        stats["last_time"] = elapsed
+        stats["last_bytes"] = stats["bytes_sent"] - sent_before
+
+    def dispatch(self, payload, waves, key):
+        """
+        Send a message in waves (see `coordinator._stagger_dispatch()`),
+        cancelling the waves of the last message dispatched with the same key
+        that weren't sent yet.
+
+        Args:
+            payload (dict): The message.
+            waves (list): The waves, with their `delay` in seconds and their
+                `clients`.
+            key (object): The dispatch key (e.g. the repo ID).
+        """
+        self.cancel_dispatch(key)
+        started = self.clock.seconds()
+        timings = []
+        self._dispatch_stats["dispatches"] += 1
+        self._dispatch_stats["last_dispatch"] = timings
+        self._dispatches[key] = [self.clock.callLater(wave["delay"], \
+                self._send_wave, key, payload, index, wave, started, timings) \
+            for index, wave in enumerate(waves)]
+
+    def cancel_dispatch(self, key):
+        """
+        Cancel the waves of a dispatch that weren't sent yet.
+
+        Args:
+            key (object): The dispatch key.
+        """
+        calls = self._dispatches.pop(key, [])
+        pending = [call for call in calls if call.active()]
+        for call in pending:
+            call.cancel()
+        if pending:
+            self._dispatch_stats["dispatches_cancelled"] += 1
+
+    def discard(self, client):
+        """
+        Forget the messages queued for a client (e.g. once it disconnects).
+        """
+        self._deferred.pop(client, None)
+
+    def pending(self, client):
+        """
+        Get the number of messages queued for a client.
+        """
+        return len(self._deferred.get(client, ()))
+
+    def stats(self):
+        """
+        Get the fan-out counters, and the dispatch counters along with the
+        timing of every wave of the last dispatch.
+
+        Returns:
+            dict: The counters, keyed by stage.
+        """
+        stats = dict(self._stats)
+        stats["clients_deferred"] = len(self._deferred)
+        dispatch_stats = dict(self._dispatch_stats)
+        dispatch_stats["last_dispatch"] = [dict(timing) \
+            for timing in dispatch_stats["last_dispatch"]]
+        dispatch_stats["pending_dispatches"] = len(self._dispatches)
+        return {"broadcast": stats, "dispatch": dispatch_stats}
+
+    def _send_wave(self, key, payload, index, wave, started, timings):
+        """
+        Send a wave of a dispatch to the clients that are still connected,
+        timing it.
+        """
+        clients = [client for client in wave["clients"] \
+            if getattr(client, "transport", None) is not None]
+        self.broadcast(payload, clients)
+        timings.append({
+            "wave": index,
+            "clients": len(clients),
+            "planned_delay": wave["delay"],
+            "delay": self.clock.seconds() - started,
+            "fanout_time": self._stats["last_time"],
+            "bytes": self._stats["last_bytes"],
+        })
+        self._dispatch_stats["waves_sent"] += 1
+
+        calls = self._dispatches.get(key, [])
+        if not any(call.active() for call in calls):
+            self._dispatches.pop(key, None)
+
+    def _send(self, client, prepared):
+        """
+        Send a prepared message to a client, unless it's slow.
+        """
+        queue = self._deferred.get(client)
+        if queue is None and outbound_buffer_size(client) <= self.max_buffer_size:
+            self._write(client, prepared)
+            return
+
+        if self.policy == DROP_POLICY:
+            self._drop(client)
+            return
+
+        if queue is None:
+            queue = self._deferred[client] = deque()
+        if len(queue) >= self.max_deferred:
+            self._drop(client)
+            return
+        queue.append(prepared)
+        self._stats["messages_deferred"] += 1
+        self._schedule_retry()
+
+    def _write(self, client, prepared):
+        """
+        Write a prepared message to a client's transport.
+        """
+        client.sendPreparedMessage(prepared)
+        self._stats["messages_sent"] += 1
+        self._stats["bytes_sent"] += len(prepared.payloadHybi)
+
+    def _drop(self, client):
+        """
+        Disconnect a slow client.
+        """
+        print("Dropping slow client {}".format(getattr(client, "peer", None)))
+        self.discard(client)
+        self._stats["clients_dropped"] += 1
+        client.dropConnection(abort=True)
+
+    def _schedule_retry(self):
+        """
+        Retry sending the deferred messages in a bit, if not already
+        scheduled.
+        """
+        if self._retry is None or not self._retry.active():
+            self._retry = self.clock.callLater(DEFERRED_RETRY_INTERVAL, \
+                self._send_deferred)
+
+    def _send_deferred(self):
+        """
+        Send the deferred messages of the clients whose buffer drained.
+        """
+        for client, queue in list(self._deferred.items()):
+            if getattr(client, "transport", None) is None:
+                self.discard(client)
+                continue
+            while queue and outbound_buffer_size(client) <= self.max_buffer_size:
+                self._write(client, queue.popleft())
+            if not queue:
+                del self._deferred[client]
+
+        if self._deferred:
+            self._schedule_retry()
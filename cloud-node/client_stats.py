@@ -0,0 +1,213 @@
+import os
+import time
+import threading
+
+from message import LibraryActionType
+
+
+STATS_SMOOTHING = float(os.environ.get("CLIENT_STATS_SMOOTHING", 0.3))
+STATS_TTL = float(os.environ.get("CLIENT_STATS_TTL", 24 * 60 * 60))
+
+class ClientRecord(object):
+    """
+    The performance history of a client: how long it takes to download the
+    model, to train and how fast it uploads its update, as exponential moving
+    averages over the rounds it took part in. Also holds the timestamps of
+    the round it's training in.
+
+    Records are kept under the `client_id` the client sent when it
+    registered, so they outlive its connection, and expire after `STATS_TTL`
+    seconds without activity. Clients without an ID are tracked by their
+    connection instead.
+    """
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.last_seen = time.time()
+        self.rounds = 0
+        self.download_time = None
+        self.train_time = None
+        self.upload_throughput = None
+        self.update_size = None
+        self.sent_at = None
+        self.first_byte_at = None
+        self.last_byte_at = None
+        self.bytes_received = 0
+
+    def expected_round_time(self):
+        """
+        Get how long the client is expected to take to go through a round.
+
+        Returns:
+            float: The expected time in seconds, or `None` if the client
+                never finished a round.
+        """
+        if not self.rounds:
+            return None
+        round_time = (self.download_time or 0) + self.train_time
+        if self.upload_throughput:
+            round_time += self.update_size / self.upload_throughput
+        return round_time
+
+    def to_dict(self):
+        return {
+            "peer": self.peer,
+            "rounds": self.rounds,
+            "download_time": self.download_time,
+            "train_time": self.train_time,
+            "upload_throughput": self.upload_throughput,
+            "expected_round_time": self.expected_round_time(),
+        }
+
+_records = {}
+_records_lock = threading.Lock()
+
+def record_sent(client, message):
+    """
+    Record that a message was sent to a client. A `TRAIN` message starts the
+    timing of the client's round.
+
+    Args:
+        client (CloudNodeProtocol): The client.
+        message (dict): The message.
+    """
+    if message.get("action") != LibraryActionType.TRAIN.value:
+        return
+    with _records_lock:
+        record = _get_record(client)
+        record.sent_at = record.last_seen = time.time()
+        record.first_byte_at = None
+        record.last_byte_at = None
+        record.bytes_received = 0
+
+def record_message(client, started, finished, size):
+    """
+    Record that a message was received from a client while it's training.
+    The messages it sends until its update is processed make up the upload
+    of the update (a single message, or the messages of a chunked upload).
+
+    Args:
+        client (CloudNodeProtocol): The client.
+        started (float): When the first byte of the message arrived.
+        finished (float): When the last byte of the message arrived.
+        size (int): The size of the message in bytes.
+    """
+    with _records_lock:
+        record = _records.get(_key(client))
+        if record is None or record.sent_at is None:
+            return
+        record.last_seen = time.time()
+        if record.first_byte_at is None:
+            record.first_byte_at = started
+        record.last_byte_at = finished
+        record.bytes_received += size
+
+def record_update(client, timings=None):
+    """
+    Record that a client's update was received, folding the timings of its
+    round into its history.
+
+    The node only sees when the `TRAIN` message was sent and when the update
+    started and finished arriving, so the download time is the one the
+    library reports in `timings` (if any) and the rest of the turnaround is
+    counted as training.
+
+    Args:
+        client (CloudNodeProtocol): The client.
+        timings (dict, optional): The timings reported by the library, in
+            seconds.
+    """
+    with _records_lock:
+        record = _records.get(_key(client))
+        if record is None or record.sent_at is None \
+                or record.first_byte_at is None:
+            return
+        record.last_seen = time.time()
+
+        turnaround = max(record.first_byte_at - record.sent_at, 0)
+        download_time = (timings or {}).get("download")
+        if download_time is not None:
+            download_time = min(max(float(download_time), 0), turnaround)
+            record.download_time = _smooth(record.download_time, download_time)
+        record.train_time = _smooth(record.train_time, \
+            turnaround - (download_time or 0))
+
+        upload_time = record.last_byte_at - record.first_byte_at
+        if upload_time > 0:
+            record.upload_throughput = _smooth(record.upload_throughput, \
+                record.bytes_received / upload_time)
+        record.update_size = _smooth(record.update_size, \
+            record.bytes_received)
+
+        record.rounds += 1
+        record.sent_at = None
+
+def expected_round_time(client):
+    """
+    Get how long a client is expected to take to go through a round (see
+    `ClientRecord.expected_round_time()`).
+    """
+    with _records_lock:
+        record = _records.get(_key(client))
+        return record.expected_round_time() if record is not None else None
+
+def discard(client):
+    """
+    Forget the history of a client without a `client_id` once it
+    disconnects, since it can't be matched with its next connection. The
+    history of the other clients is kept until it expires.
+    """
+    if getattr(client, "client_id", None) is None:
+        with _records_lock:
+            _records.pop(client, None)
+
+def get_stats():
+    """
+    Get the history of every client.
+
+    Returns:
+        dict: The histories, under `clients`.
+    """
+    with _records_lock:
+        _expire()
+        return {"clients": [record.to_dict() for record in _records.values()]}
+
+def _key(client):
+    """
+    Get the key of the record of a client: its `client_id`, or the client
+    itself if it didn't send one.
+    """
+    return getattr(client, "client_id", None) or client
+
+def _get_record(client):
+    """
+    Get the record of a client, making it if there's none. Should be called
+    with `_records_lock` held.
+    """
+    key = _key(client)
+    record = _records.get(key)
+    if record is None:
+        # NOTE: Records can only pile up as they're made, so it's enough to
+        # expire the old ones then.
+        _expire()
+        record = _records[key] = ClientRecord(getattr(client, "peer", None))
+    record.peer = getattr(client, "peer", None)
+    return record
+
+def _expire():
+    """
+    Forget the records that haven't been active in `STATS_TTL` seconds.
+    Should be called with `_records_lock` held.
+    """
+    now = time.time()
+    for key, record in list(_records.items()):
+        if now - record.last_seen > STATS_TTL:
+            del _records[key]
+
+def _smooth(average, value):
+    """
+    Fold a value into an exponential moving average.
+    """
+    if average is None:
+        return value
+    return (1 - STATS_SMOOTHING) * average + STATS_SMOOTHING * value
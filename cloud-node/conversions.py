@@ -0,0 +1,155 @@
+from collections import OrderedDict
+
+from keras import backend as K
+from keras.layers import Dense
+from keras.models import load_model, Sequential
+from keras.optimizers import SGD, Adam
+import numpy as np
+import tensorflowjs as tfjs
+import coremltools
+from coremltools.converters import keras as keras_converter
+from coremltools.proto import FeatureTypes_pb2 as _FeatureTypes_pb2
+from coremltools.models.neural_network import SgdParams, AdamParams
+from coremltools.models import MLModel
+import tensorflow as tf
+tf.compat.v1.disable_v2_behavior()
+
+from weightstore import H5WeightStore
+from mlmodel_writer import MLModelWriter
+
+
+UNLIMITED_EPOCHS = 100000
+MAX_CACHED_MLMODEL_WRITERS = 8
+
+# NOTE: Cached per worker process, keyed by the path of the session's first
+# (fully converted) MLModel. `None` means the model can't be patched.
+_mlmodel_writers = OrderedDict()
+
+def warm_up():
+    """
+    Pay the TensorFlow graph setup once, when the worker process starts,
+    instead of on the first conversion.
+    """
+    model = Sequential([Dense(1, input_shape=(1,))])
+    model.compile(optimizer="sgd", loss="mean_squared_error")
+    model.predict(np.zeros((1, 1)))
+    K.clear_session()
+
+def keras_to_tfjs(h5_model_path, tfjs_model_path):
+    """
+    Converts a Keras h5 model into a tf.js model and saves it on disk.
+
+    Args:
+        h5_model_path (str): Path to the Keras model.
+        tfjs_model_path (str): The folder to save the tf.js model to.
+
+    Returns:
+        str: The folder the tf.js model was saved to.
+    """
+    model = load_model(h5_model_path)
+    tfjs.converters.save_keras_model(model, tfjs_model_path, np.uint16)
+    K.clear_session()
+    return tfjs_model_path
+
+def keras_to_mlmodel_image(h5_model_path, mlmodel_path, ios_config, \
+        hyperparams, spec_mlmodel_path=None):
+    """
+    Writes the ML Model for image data of the given Keras h5 model.
+
+    If `spec_mlmodel_path` is given (the MLModel converted at the beginning
+    of the session), its updatable spec is reused and only the weights are
+    patched. Otherwise, the Keras model is fully converted.
+
+    NOTE: Image configuration must be specified from Explora.
+
+    NOTE: Currently, only categorical cross entropy loss is supported.
+
+    Args:
+        h5_model_path (str): Path to the Keras model.
+        mlmodel_path (str): The path to save the MLModel to.
+        ios_config (dict): The iOS configuration of the session.
+        hyperparams (dict): The hyperparameters of the session.
+        spec_mlmodel_path (str, optional): Path to the first MLModel of the
+            session.
+
+    Returns:
+        str: The path the MLModel was saved to.
+    """
+    if spec_mlmodel_path:
+        weight_store, mlmodel_writer = \
+            _get_mlmodel_writer(spec_mlmodel_path, h5_model_path)
+        if mlmodel_writer is not None:
+            weights = weight_store.get_weights(h5_model_path)
+            mlmodel_writer.write(weight_store.get_layer_weights(weights), \
+                mlmodel_path)
+            return mlmodel_path
+
+    model = load_model(h5_model_path)
+    class_labels = ios_config["class_labels"]
+    mlmodel = keras_converter.convert(model, input_names=['image'],
+                                output_names=['output'],
+                                class_labels=class_labels,
+                                predicted_feature_name='label')
+    mlmodel.save(mlmodel_path)
+
+    image_config = ios_config["image_config"]
+    spec = coremltools.utils.load_spec(mlmodel_path)
+    builder = coremltools.models.neural_network.NeuralNetworkBuilder(spec=spec)
+
+    dims = image_config["dims"]
+    spec.description.input[0].type.imageType.width = dims[0]
+    spec.description.input[0].type.imageType.height = dims[1]
+
+    cs = _FeatureTypes_pb2.ImageFeatureType.ColorSpace.Value(image_config["color_space"])
+    spec.description.input[0].type.imageType.colorSpace = cs
+
+    trainable_layer_names = [layer.name for layer in model.layers if layer.get_weights()]
+    builder.make_updatable(trainable_layer_names)
+
+    builder.set_categorical_cross_entropy_loss(name='loss', input='output')
+
+    if isinstance(model.optimizer, SGD):
+        params = SgdParams(
+            lr=K.eval(model.optimizer.lr),
+            batch=hyperparams["batch_size"],
+        )
+        builder.set_sgd_optimizer(params)
+    elif isinstance(model.optimizer, Adam):
+        params = AdamParams(
+            lr=K.eval(model.optimizer.lr),
+            batch_size=hyperparams["batch_size"],
+            beta1=model.optimizer.beta1,
+            beta2=model.optimizer.beta2,
+            eps=model.optimizer.eps,
+        )
+        builder.set_adam_optimizer(params)
+    else:
+        raise Exception("iOS optimizer must be SGD or Adam!")
+
+    builder.set_epochs(UNLIMITED_EPOCHS)
+    builder.set_shuffle(hyperparams["shuffle"])
+
+    mlmodel_updatable = MLModel(spec)
+    mlmodel_updatable.save(mlmodel_path)
+
+    K.clear_session()
+    return mlmodel_path
+
+def _get_mlmodel_writer(spec_mlmodel_path, h5_model_path):
+    """
+    Get the weight store and the MLModel writer of a session, loading the
+    spec the first time this worker sees the session.
+    """
+    if spec_mlmodel_path in _mlmodel_writers:
+        _mlmodel_writers.move_to_end(spec_mlmodel_path)
+        return _mlmodel_writers[spec_mlmodel_path]
+
+    weight_store = H5WeightStore(h5_model_path)
+    mlmodel_writer = MLModelWriter(spec_mlmodel_path)
+    if not mlmodel_writer.supports(weight_store.layer_names):
+        mlmodel_writer = None
+
+    _mlmodel_writers[spec_mlmodel_path] = (weight_store, mlmodel_writer)
+    if len(_mlmodel_writers) > MAX_CACHED_MLMODEL_WRITERS:
+        _mlmodel_writers.popitem(last=False)
+    return weight_store, mlmodel_writer
@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+import multiprocessing
+
+
+CONVERTER_POOL_SIZE = int(os.environ.get("CONVERTER_POOL_SIZE", 2))
+MAX_PENDING_CONVERSIONS = int(os.environ.get("MAX_PENDING_CONVERSIONS", 8))
+QUEUE_TIMEOUT = 300
+CONVERSION_TIMEOUT = 600
+
+class ConverterPool(object):
+    """
+    Runs model conversions (see `conversions.py`) in a pool of long-lived
+    worker processes which import TensorFlow, tf.js and coremltools once and
+    warm up when they start, so the cloud node process stays TF-free.
+
+    Jobs and their results are passed by path: the workers read the models
+    from disk and write the converted artifacts to disk.
+
+    `run()` blocks the calling thread (never the reactor thread) until the
+    job is done. At most `max_pending` jobs can be pending at once; callers
+    beyond that wait for a slot.
+
+    If `num_workers` is 0, the jobs run in the calling process instead.
+
+    Args:
+        num_workers (int, optional): The number of worker processes.
+        max_pending (int, optional): The maximum number of pending jobs.
+    """
+
+    def __init__(self, num_workers=CONVERTER_POOL_SIZE, \
+            max_pending=MAX_PENDING_CONVERSIONS):
+        self.num_workers = num_workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def start(self):
+        """
+        Start (and warm up) the worker processes, if not started already.
+        """
+        with self._pool_lock:
+            if self._pool is None and self.num_workers > 0:
+                context = multiprocessing.get_context("spawn")
+                self._pool = context.Pool(self.num_workers, \
+                    initializer=_warm_up)
+
+    def stop(self):
+        """
+        Terminate the worker processes.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def run(self, job, *args):
+        """
+        Run a conversion job and wait for its result.
+
+        Args:
+            job (str): The name of the function in `conversions.py`.
+
+        Returns:
+            object: The result of the job.
+        """
+        if not self._slots.acquire(timeout=QUEUE_TIMEOUT):
+            raise Exception("Too many pending conversions!")
+
+        submitted = time.time()
+        self._record_submit(job)
+        try:
+            if self.num_workers > 0:
+                self.start()
+                pending = self._pool.apply_async(_run_job, (job, args))
+                result, started, elapsed = pending.get(CONVERSION_TIMEOUT)
+            else:
+                result, started, elapsed = _run_job(job, args)
+        except Exception:
+            self._record_done(job, submitted, None, None)
+            raise
+        finally:
+            self._slots.release()
+
+        self._record_done(job, submitted, started, elapsed)
+        return result
+
+    def stats(self):
+        """
+        Get the queue depth and timing counters of every job.
+
+        Returns:
+            dict: The counters, keyed by job.
+        """
+        with self._stats_lock:
+            return {job: dict(stats) for job, stats in self._stats.items()}
+
+    def _record_submit(self, job):
+        """
+        Count a newly submitted job.
+        """
+        with self._stats_lock:
+            stats = self._job_stats(job)
+            stats["queue_depth"] += 1
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], \
+                stats["queue_depth"])
+
+    def _record_done(self, job, submitted, started, elapsed):
+        """
+        Record the timing of a finished job (`started` is `None` if it failed).
+        """
+        with self._stats_lock:
+            stats = self._job_stats(job)
+            stats["queue_depth"] -= 1
+            if started is None:
+                stats["failed"] += 1
+                return
+            stats["processed"] += 1
+            stats["total_wait"] += max(started - submitted, 0.0)
+            stats["total_latency"] += elapsed
+            stats["max_latency"] = max(stats["max_latency"], elapsed)
+            stats["last_latency"] = elapsed
+
+    def _job_stats(self, job):
+        """
+        Get (or create) the counters of a job.
+        """
+        if job not in self._stats:
+            self._stats[job] = {
+                "queue_depth": 0,
+                "max_queue_depth": 0,
+                "processed": 0,
+                "failed": 0,
+                "total_wait": 0.0,
+                "total_latency": 0.0,
+                "max_latency": 0.0,
+                "last_latency": 0.0,
+            }
+        return self._stats[job]
+
+def _warm_up():
+    """
+    Import the conversion libraries and warm them up in a worker process.
+
+    NOTE: Errors are only logged, otherwise the pool would keep respawning
+    workers and pending jobs would never finish. They surface again when a
+    job runs.
+    """
+    try:
+        import conversions
+        conversions.warm_up()
+    except Exception as e:
+        print("Error warming up converter: {0}".format(e))
+
+def _run_job(job, args):
+    """
+    Run a conversion job, timing it.
+
+    Returns:
+        tuple: The result of the job, when it started and how long it took.
+    """
+    import conversions
+    started = time.time()
+    result = getattr(conversions, job)(*args)
+    return result, started, time.time() - started
+
+_converter_pool = ConverterPool()
+
+def start():
+    """
+    Start the worker processes of the cloud node's converter pool.
+    """
+    _converter_pool.start()
+
+def stop():
+    """
+    Stop the worker processes of the cloud node's converter pool.
+    """
+    _converter_pool.stop()
+
+def run(job, *args):
+    """
+    Run a conversion job in the cloud node's converter pool.
+
+    Args:
+        job (str): The name of the function in `conversions.py`.
+
+    Returns:
+        object: The result of the job.
+    """
+    return _converter_pool.run(job, *args)
+
+def stats():
+    """
+    Get the counters of the cloud node's converter pool.
+
+    Returns:
+        dict: The counters, keyed by job.
+    """
+    return _converter_pool.stats()
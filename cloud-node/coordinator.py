@@ -1,20 +1,40 @@
+import os
+import math
+import time
 import uuid
+import random
+import heapq
+import hashlib
 import logging
+from collections import deque
 
 import state
 import copy
+import artifacts
+import client_stats
 from model import convert_keras_model_to_tfjs, fetch_keras_model, \
     convert_keras_model_to_mlmodel, fetch_mlmodel
 from message import ClientType, LibraryType, ActionType, LibraryActionType
+from tensor_frames import encode_frame
+from server_optimizer import ServerOptimizer
 
 
+DELTA_URL = "/delta/{0}/{1}"
+EGRESS_BANDWIDTH = float(os.environ.get("EGRESS_BANDWIDTH", 0))
+DISPATCH_WAVE_INTERVAL = float(os.environ.get("DISPATCH_WAVE_INTERVAL", 1.0))
+DISPATCH_JITTER = float(os.environ.get("DISPATCH_JITTER", 0.25))
+OVER_SELECTION_RATIO = 0.3
+ASYNC_MODE = "ASYNC"
+METRIC_HISTORY_SIZE = int(os.environ.get("METRIC_HISTORY_SIZE", 1000))
+
 logging.basicConfig(level=logging.ERROR)
 
-def start_new_session(message, clients):
+def start_new_session(repo_state, message, clients):
     """
     Starts a new DML session.
 
     Args:
+        repo_state (RepoState): The state of the repo.
         message (NEW_SESSION): The `NEW_SESSION` message sent to the server.
         clients (list): List of `LIBRARY` clients to train with.
 
@@ -25,40 +45,52 @@ def start_new_session(message, clients):
     print("Starting new session...")
 
     # 1. Mark the service as BUSY.
-    state.state["busy"] = True
+    repo_state["busy"] = True
 
     # 2. Set the internal round variable to 1, reset the number of nodes
     #    averaged to 0, update the initial message.
-    state.state["current_round"] = 1
-    state.state["num_nodes_averaged"] = 0
-    state.state["initial_message"] = message
-    state.state["repo_id"] = message.repo_id
-    state.state["dataset_id"] = message.dataset_id
-    state.state["session_id"] = message.session_id
-    state.state["checkpoint_frequency"] = message.checkpoint_frequency
-    state.state["ios_config"] = message.ios_config
+    repo_state["current_round"] = 1
+    repo_state["num_nodes_averaged"] = 0
+    repo_state["session_start_time"] = time.time()
+    repo_state["metric_history"] = deque(maxlen=METRIC_HISTORY_SIZE)
+    repo_state["initial_message"] = message
+    repo_state["repo_id"] = message.repo_id
+    repo_state["dataset_id"] = message.dataset_id
+    repo_state["session_id"] = message.session_id
+    repo_state["checkpoint_frequency"] = message.checkpoint_frequency
+    repo_state["ios_config"] = message.ios_config
+    repo_state["update_encoding"] = message.update_encoding
+    if "server_optimizer" in message.aggregation_config:
+        repo_state["server_optimizer"] = ServerOptimizer( \
+            message.aggregation_config["server_optimizer"])
+    repo_state["asynchronous"] = \
+        message.aggregation_config.get("mode") == ASYNC_MODE
+    if repo_state["asynchronous"]:
+        repo_state["max_staleness"] = \
+            message.aggregation_config.get("max_staleness", None)
     
     # 3. If there are already 5 ongoing sessions, don't start a new one and 
     #    notify the user.
-    if state.num_sessions == 5:
-        error_message = "Too many ongoing sessions! Please check back in 5 " \
-            "minutes!"
-        return {
-            "action": "UNICAST",
-            "error": True,
-            "message": error_message,
-        }
-    
-    state.num_sessions += 1
+    with state.sessions_lock:
+        if state.num_sessions == 5:
+            error_message = "Too many ongoing sessions! Please check back in 5 " \
+                "minutes!"
+            return {
+                "action": "UNICAST",
+                "error": True,
+                "message": error_message,
+            }
+
+        state.num_sessions += 1
 
     # 4. According to the 'Selection Criteria', choose clients to forward
     #    training messages to.
-    chosen_clients = _choose_clients(message.selection_criteria, clients)
-    state.state["num_nodes_chosen"] = len(chosen_clients)
+    chosen_clients = _set_chosen_clients(repo_state, \
+        message.selection_criteria, clients)
 
     new_message = {
-        "session_id": state.state["session_id"],
-        "repo_id": state.state["repo_id"],
+        "session_id": repo_state["session_id"],
+        "repo_id": repo_state["repo_id"],
         "round": 1,
         "action": LibraryActionType.TRAIN.value,
         "hyperparams": message.hyperparams,
@@ -67,40 +99,45 @@ def start_new_session(message, clients):
 
     # 5. Record the message to be sent and the library type we are training
     #    with. By default, we use gradients for transmission.
-    state.state["last_message_sent_to_library"] = new_message
-    state.state["use_gradients"] = True
-    state.state["library_type"] = message.library_type
-    if state.state["library_type"] == LibraryType.IOS.value:
-        new_message["dataset_id"] = state.state["dataset_id"]
-        data_type = state.state["ios_config"]["data_type"]
-        state.state["library_type"] = LibraryType.IOS_IMAGE.value \
+    repo_state["last_message_sent_to_library"] = new_message
+    repo_state["use_gradients"] = True
+    repo_state["library_type"] = message.library_type
+    if repo_state["library_type"] == LibraryType.IOS.value:
+        new_message["dataset_id"] = repo_state["dataset_id"]
+        data_type = repo_state["ios_config"]["data_type"]
+        repo_state["library_type"] = LibraryType.IOS_IMAGE.value \
             if data_type == "image" else LibraryType.IOS_TEXT.value
 
     # 6. Retrieve the initial model we are training with and convert it if 
     #    necessary..
-    if state.state["library_type"] == LibraryType.IOS_TEXT.value:
-        fetch_mlmodel()
+    if repo_state["library_type"] == LibraryType.IOS_TEXT.value:
+        fetch_mlmodel(repo_state)
     else:
-        fetch_keras_model()
-        if state.state["library_type"] == LibraryType.JS.value:
-            _ = convert_keras_model_to_tfjs()    
-            state.state["use_gradients"] = False
-        elif state.state["library_type"] == LibraryType.IOS_IMAGE.value:
-            state.state["hyperparams"] = message.hyperparams
-            _ = convert_keras_model_to_mlmodel()
+        fetch_keras_model(repo_state)
+        if repo_state["library_type"] == LibraryType.JS.value:
+            _ = convert_keras_model_to_tfjs(repo_state)    
+            repo_state["use_gradients"] = False
+        elif repo_state["library_type"] == LibraryType.IOS_IMAGE.value:
+            repo_state["hyperparams"] = message.hyperparams
+            _ = convert_keras_model_to_mlmodel(repo_state)
 
     # 7. Kickstart a DML Session with the model and round # 1
-    return {
+    results = {
         "action": ActionType.BROADCAST,
         "client_list": chosen_clients,
         "message": new_message,
     }
+    _stagger_dispatch(repo_state, results)
+    _start_round_clock(repo_state, results)
+    _start_session_clock(repo_state, results)
+    return results
 
-def start_next_round(clients):
+def start_next_round(repo_state, clients):
     """
     Starts a new round in the current DML Session.
 
     Args:
+        repo_state (RepoState): The state of the repo.
         message (dict): The `NEW_SESSION` message sent to the server.
         clients (list): List of `LIBRARY` clients to train with.
 
@@ -109,63 +146,137 @@ def start_next_round(clients):
             if there was no error, what the next action is.
     """
     print("Starting next round...")
-    state.state["num_nodes_averaged"] = 0
+    repo_state["num_nodes_averaged"] = 0
 
-    message = state.state["initial_message"]
+    message = repo_state["initial_message"]
 
     # According to the 'Selection Criteria', choose clients to forward
     # training messages to.
-    chosen_clients = _choose_clients(message.selection_criteria, clients)
-    state.state["num_nodes_chosen"] = len(chosen_clients)
+    chosen_clients = _set_chosen_clients(repo_state, \
+        message.selection_criteria, clients)
+
+    new_message = _prepare_round(repo_state)
+    assert repo_state["current_round"] > 0
+
+    results = {
+        "action": ActionType.BROADCAST,
+        "client_list": chosen_clients,
+        "message": new_message,
+    }
+    _stagger_dispatch(repo_state, results)
+    _start_round_clock(repo_state, results)
+    return results
 
+def start_next_version(repo_state):
+    """
+    Starts the next version of the model (the next round) in an asynchronous
+    session.
+
+    Unlike `start_next_round()`, nothing is broadcast: every node gets the
+    latest version as soon as it's idle (see `hand_out_version()`).
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+    """
+    print("Starting version {}...".format(repo_state["current_round"]))
+    repo_state["num_nodes_averaged"] = 0
+    _prepare_round(repo_state)
+
+def hand_out_version(repo_state, base_round=None):
+    """
+    Hands the latest version of the model to an idle node in an asynchronous
+    session.
+
+    Python libraries only get the delta if they have the previous version
+    (they keep the model of the round they last trained in). They train
+    again with the model they have if it's still the latest, and reload the
+    whole model otherwise.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        base_round (int, optional): The round (version) of the model the node
+            has, if any.
+
+    Returns:
+        dict: Returns a dictionary detailing whether an error occurred and
+            if there was no error, what the next action is.
+    """
+    new_message = dict(repo_state["last_message_sent_to_library"], \
+        asynchronous=True)
+    current_round = repo_state["current_round"]
+    if repo_state["library_type"] == LibraryType.PYTHON.value \
+            and base_round != current_round - 1:
+        new_message.pop("delta_url", None)
+        new_message.pop("delta_hash", None)
+        if base_round is None or base_round < current_round - 1:
+            new_message["reload_model"] = True
+
+    return {
+        "action": ActionType.UNICAST,
+        "message": new_message,
+    }
+
+def _prepare_round(repo_state):
+    """
+    Prepares the model of the current round for the libraries (the delta for
+    Python libraries, the converted model for the others) and records the
+    `TRAIN` message of the round.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+
+    Returns:
+        dict: The `TRAIN` message.
+    """
+    message = repo_state["initial_message"]
     new_message = {
-        "session_id": state.state["session_id"],
-        "repo_id": state.state["repo_id"],
-        "round": state.state["current_round"],
+        "session_id": repo_state["session_id"],
+        "repo_id": repo_state["repo_id"],
+        "round": repo_state["current_round"],
         "action": LibraryActionType.TRAIN.value,
         "hyperparams": message.hyperparams,
         "error": False,
     }
 
-    if state.state['library_type'] == LibraryType.PYTHON.value:
-        new_message['gradients'] = [gradient.tolist() for gradient in state.state['current_gradients']]
-    elif state.state['library_type'] == LibraryType.JS.value:
-        _ = convert_keras_model_to_tfjs()
-    elif state.state["library_type"] == LibraryType.IOS_IMAGE.value:
-        _ = convert_keras_model_to_mlmodel()
-        new_message["dataset_id"] = state.state["dataset_id"]
-    elif state.state["library_type"] == LibraryType.IOS_TEXT.value:
-        new_message["dataset_id"] = state.state["dataset_id"]
+    if repo_state['library_type'] == LibraryType.PYTHON.value:
+        # NOTE: The gradients aren't inlined, the libraries fetch them from
+        # the URL and check them against the hash.
+        delta = _make_delta(repo_state)
+        repo_state["delta"] = delta
+        new_message["delta_hash"] = delta.sha256
+        new_message["delta_url"] = DELTA_URL.format(repo_state["session_id"], \
+            delta.round)
+    elif repo_state['library_type'] == LibraryType.JS.value:
+        _ = convert_keras_model_to_tfjs(repo_state)
+    elif repo_state["library_type"] == LibraryType.IOS_IMAGE.value:
+        _ = convert_keras_model_to_mlmodel(repo_state)
+        new_message["dataset_id"] = repo_state["dataset_id"]
+    elif repo_state["library_type"] == LibraryType.IOS_TEXT.value:
+        new_message["dataset_id"] = repo_state["dataset_id"]
         
-    state.state["last_message_sent_to_library"] = new_message
-    assert state.state["current_round"] > 0
+    repo_state["last_message_sent_to_library"] = new_message
+    return new_message
 
-    return {
-        "action": ActionType.BROADCAST,
-        "client_list": chosen_clients,
-        "message": new_message,
-    }
-
-def stop_session(repo_id, clients_dict):
+def stop_session(repo_state, clients_dict):
     """
     Stop the current session. Reset state and return broadcast `STOP` message
     to all clients.
 
     Args:
-        repo_id (str): The repo ID of the repo in this session.
+        repo_state (RepoState): The state of the repo in this session.
         clients_dict (dict): Dictionary of clients, keyed by type of client
             (either `LIBRARY` or `DASHBOARD`).
 
     Returns:
         dict: Returns the broadcast message with action `STOP`.
     """
-    state.reset_state(repo_id)
+    state.reset_state(repo_state["repo_id"])
 
     new_message = {
         "action": LibraryActionType.STOP.value,
-        "session_id": state.state["session_id"],
-        "dataset_id": state.state["dataset_id"],
-        "repo_id": state.state["repo_id"],
+        "session_id": repo_state["session_id"],
+        "dataset_id": repo_state["dataset_id"],
+        "repo_id": repo_state["repo_id"],
         "error": False,
     }
     
@@ -178,12 +289,254 @@ def stop_session(repo_id, clients_dict):
 
     return results
 
+def _make_delta(repo_state):
+    """
+    Encode the encoded averaged gradients of the last round (and their
+    encoding parameters) into the delta served for the current round.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+
+    Returns:
+        ModelDelta: The delta.
+    """
+    gradients, encoding_params = repo_state["encoded_gradients"]
+    payload = encode_frame(dict(encoding_params, gradients=list(gradients)))
+    return state.ModelDelta(
+        round=repo_state["current_round"],
+        sha256=hashlib.sha256(payload).hexdigest(),
+        payload=payload,
+    )
+
+def _stagger_dispatch(repo_state, results):
+    """
+    Split the broadcast of a `TRAIN` message into waves, so that the chosen
+    clients don't all download the model at the same time.
+
+    Every wave is sized so that its downloads fit in the egress bandwidth
+    budget (`EGRESS_BANDWIDTH`, in bytes per second) during one wave
+    interval, and waves are released one interval apart, with some jitter.
+    Nothing is staggered if there's no budget or a single wave is enough.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        results (dict): The broadcast results, updated in place with the
+            `waves` (their `delay` in seconds and their `clients`).
+    """
+    download_size = _download_size(repo_state)
+    if EGRESS_BANDWIDTH <= 0 or not download_size:
+        return
+
+    clients = results["client_list"]
+    wave_size = max(int(EGRESS_BANDWIDTH * DISPATCH_WAVE_INTERVAL \
+        // download_size), 1)
+    if wave_size >= len(clients):
+        return
+
+    waves = []
+    for index, start in enumerate(range(0, len(clients), wave_size)):
+        delay = index * DISPATCH_WAVE_INTERVAL
+        if index:
+            delay += random.uniform(0, DISPATCH_JITTER * DISPATCH_WAVE_INTERVAL)
+        waves.append({
+            "delay": delay,
+            "clients": clients[start:start+wave_size],
+        })
+    results["waves"] = waves
+
+def _start_round_clock(repo_state, results):
+    """
+    Record when the round starts (once its last wave is dispatched, if it's
+    staggered) and, if the continuation criteria has round deadlines, when
+    they expire. Asynchronous sessions have no rounds to close, so they have
+    no deadlines.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        results (dict): The broadcast results, updated in place with the
+            `round_deadlines` (as timestamps), if any.
+    """
+    last_wave_delay = results["waves"][-1]["delay"] if "waves" in results else 0
+    repo_state["round_start_time"] = time.time() + last_wave_delay
+
+    continuation_criteria = repo_state["initial_message"].continuation_criteria
+    deadlines = _round_deadlines(continuation_criteria)
+    if deadlines and not repo_state["asynchronous"]:
+        results["round_deadlines"] = [repo_state["round_start_time"] + deadline \
+            for deadline in deadlines]
+
+def _round_deadlines(criterion):
+    """
+    Get the round deadlines (in seconds) of a continuation criterion and of
+    its sub-criteria.
+
+    Returns:
+        list: The distinct deadlines, in increasing order.
+    """
+    if criterion.get("type") == "ROUND_DEADLINE":
+        return [criterion["value"]]
+    deadlines = set()
+    for sub_criterion in criterion.get("criteria", []):
+        deadlines.update(_round_deadlines(sub_criterion))
+    return sorted(deadlines)
+
+def _start_session_clock(repo_state, results):
+    """
+    If the termination criteria has wall-clock budgets, record when they
+    expire, so the session can be stopped even if no message arrives.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        results (dict): The broadcast results, updated in place with the
+            `session_deadlines` (as timestamps), if any.
+    """
+    termination_criteria = repo_state["initial_message"].termination_criteria
+    budgets = _wall_clock_budgets(termination_criteria)
+    if budgets:
+        results["session_deadlines"] = [repo_state["session_start_time"] \
+            + budget for budget in budgets]
+
+def _wall_clock_budgets(criterion):
+    """
+    Get the wall-clock budgets (in seconds) of a termination criterion and of
+    its sub-criteria.
+
+    Returns:
+        list: The distinct budgets, in increasing order.
+    """
+    if criterion.get("type") == "WALL_CLOCK":
+        return [criterion["value"]]
+    budgets = set()
+    for sub_criterion in criterion.get("criteria", []):
+        budgets.update(_wall_clock_budgets(sub_criterion))
+    return sorted(budgets)
+
+def _download_size(repo_state):
+    """
+    Get the number of bytes every client downloads at the start of the
+    current round (the model, or the delta for Python libraries after the
+    first round).
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+
+    Returns:
+        int: The size of the download, or 0 if it's unknown.
+    """
+    library_type = repo_state["library_type"]
+    if library_type == LibraryType.PYTHON.value:
+        if repo_state.get("delta") is not None \
+                and repo_state["delta"].round == repo_state["current_round"]:
+            return len(repo_state["delta"].payload)
+        path = repo_state.get("h5_model_path")
+    elif library_type == LibraryType.JS.value:
+        path = repo_state.get("tfjs_model_path")
+    elif library_type == LibraryType.IOS_IMAGE.value:
+        path = repo_state.get("mlmodel_path")
+    else:
+        path = repo_state.get("mlmodel_weights_path")
+
+    try:
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(path, filename)) \
+                for filename in os.listdir(path) \
+                if not filename.endswith(artifacts.VARIANT_EXTENSIONS))
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+def _set_chosen_clients(repo_state, selection_criteria, client_list):
+    """
+    Choose the clients of the round and record them, along with the number
+    of updates the round needs.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
+        selection_criteria (dict): The 'Selection Criteria'.
+        client_list (list): List of `LIBRARY` clients to choose from.
+
+    Returns:
+        list: The chosen clients.
+    """
+    chosen_clients, num_nodes_target = _choose_clients(selection_criteria, \
+        client_list)
+    # NOTE: Copied, since the clients that disconnect are removed from it.
+    repo_state["chosen_clients"] = list(chosen_clients)
+    repo_state["num_nodes_chosen"] = len(chosen_clients)
+    repo_state["num_nodes_target"] = num_nodes_target
+    return chosen_clients
+
 def _choose_clients(selection_criteria, client_list):
     """
-    TO BE FINISHED.
+    Choose the clients to train with in a round, according to the
+    'Selection Criteria'.
+
+    The criteria can be:
+        - `ALL_NODES`: Every client.
+        - `UNIFORM`: `value` clients, sampled uniformly.
+        - `OVER_SELECTION`: `value` + `extra` clients, sampled uniformly, of
+          which the round only keeps the first `value` to finish (the updates
+          of the others arrive too late and are dropped). `extra` defaults to
+          30% of `value`.
+        - `SPEED_WEIGHTED`: `value` (+ `extra`, optional, like
+          `OVER_SELECTION`) clients, sampled with probabilities inversely
+          proportional to how long they're expected to take to go through a
+          round (see `client_stats.py`). Clients that never finished a round
+          are as likely to be chosen as the fastest one, so they get measured.
 
-    Need to define a selection criteria object first.
+    Args:
+        selection_criteria (dict): The 'Selection Criteria'.
+        client_list (list): List of `LIBRARY` clients to choose from.
 
-    Right now it just chooses all clients.
+    Returns:
+        tuple: The chosen clients, and the number of updates the round needs
+            (`None` if it needs all of them, see `check_continuation_criteria`).
     """
-    return client_list
+    selection_type = selection_criteria.get("type", "ALL_NODES")
+    if selection_type == "ALL_NODES":
+        return list(client_list), None
+    if selection_type not in ("UNIFORM", "OVER_SELECTION", "SPEED_WEIGHTED"):
+        raise Exception("Selection criteria is not well defined.")
+
+    num_nodes = int(selection_criteria["value"])
+    if num_nodes < 1:
+        raise Exception("Selection criteria must choose at least one node.")
+
+    num_extra = selection_criteria.get("extra", 0)
+    if selection_type == "OVER_SELECTION":
+        num_extra = selection_criteria.get("extra", \
+            math.ceil(OVER_SELECTION_RATIO * num_nodes))
+    num_chosen = min(num_nodes + int(num_extra), len(client_list))
+    num_nodes_target = num_nodes if num_extra else None
+
+    if selection_type == "SPEED_WEIGHTED":
+        chosen_clients = _sample_by_speed(client_list, num_chosen)
+    else:
+        chosen_clients = random.sample(client_list, num_chosen)
+    return chosen_clients, num_nodes_target
+
+def _sample_by_speed(client_list, num_chosen):
+    """
+    Sample clients without replacement, with probabilities inversely
+    proportional to their expected round time.
+
+    Uses weighted reservoir sampling: every client gets the key `u ** (1 / w)`
+    (`u` uniform in (0, 1], `w` its weight) and the ones with the largest
+    keys are chosen. The keys are compared as logarithms, so they don't
+    underflow for slow clients.
+    """
+    weights = []
+    for client in client_list:
+        round_time = client_stats.expected_round_time(client)
+        weights.append(None if round_time is None \
+            else 1 / max(round_time, 1e-3))
+    known_weights = [weight for weight in weights if weight is not None]
+    new_client_weight = max(known_weights) if known_weights else 1.0
+
+    keyed_clients = []
+    for index, (client, weight) in enumerate(zip(client_list, weights)):
+        if weight is None:
+            weight = new_client_weight
+        key = math.log(1 - random.random()) / weight
+        keyed_clients.append((key, index, client))
+    return [client for _, _, client in heapq.nlargest(num_chosen, keyed_clients)]
@@ -1,6 +1,13 @@
+import threading
+
 from autobahn.twisted.websocket import WebSocketServerFactory
+from twisted.internet import reactor
 
 import state
+import client_stats
+from pipeline import MessagePipeline
+from broadcast import Broadcaster
+from uploads import UploadStore
 from message import ClientType, ErrorType, ActionType, make_error_results
 
 
@@ -8,17 +15,36 @@ class CloudNodeFactory(WebSocketServerFactory):
     """
     Class that implements part of the Cloud Node networking logic. It keeps
     track of the nodes that have been registered.
+
+    The client table is changed from the worker threads of the message
+    pipeline and read from the reactor thread, so it's guarded by its own
+    lock. It may be taken while holding the lock of a repo, but never the
+    other way around.
     """
     def __init__(self):
         """
-        Set up state for clients.
+        Set up state for clients, the pipeline their messages are processed
+        in, the broadcaster that sends them messages, the staging buffers
+        of their chunked uploads and the timers of the round deadlines, of
+        the wall-clock budgets of the sessions and of the flushes of staged
+        updates.
         """
         WebSocketServerFactory.__init__(self)
         self.clients = {}
+        self.clients_lock = threading.RLock()
+        self.pipeline = MessagePipeline()
+        self.broadcaster = Broadcaster(self.prepareMessage, \
+            on_send=client_stats.record_sent)
+        self.uploads = UploadStore()
+        self.round_timers = {}
+        self.session_timers = {}
+        self.flush_timers = {}
+        state.add_reset_hook(self._on_reset)
 
     def _new_repo(self, repo_id):
         """
-        Create a new entry with the given repo ID.
+        Create a new entry with the given repo ID. Should be called with
+        `clients_lock` held.
 
         Args:
             repo_id (str): The repo ID whose clients are to be tracked.
@@ -41,20 +67,39 @@ class CloudNodeFactory(WebSocketServerFactory):
         assert client_type in (ClientType.DASHBOARD, ClientType.LIBRARY), \
             "Type must be DASHBOARD or LIBRARY!"
 
-        if repo_id not in self.clients:
-            self._new_repo(repo_id)
+        with self.clients_lock:
+            if repo_id not in self.clients:
+                self._new_repo(repo_id)
 
-        client_already_exists = False
-        for _, clients in self.clients[repo_id].items():
-            if client in clients:
-                return "Client already exists!"
+            for _, clients in self.clients[repo_id].items():
+                if client in clients:
+                    return "Client already exists!"
 
-        if client_type == ClientType.DASHBOARD \
-                and len(self.clients[repo_id][client_type]) == 1:
-            return "Only one DASHBOARD client allowed at a time!"
-        
-        self.clients[repo_id][client_type].append(client)
-        return ""
+            if client_type == ClientType.DASHBOARD \
+                    and len(self.clients[repo_id][client_type]) == 1:
+                return "Only one DASHBOARD client allowed at a time!"
+
+            self.clients[repo_id][client_type].append(client)
+            return ""
+
+    def get_clients(self, repo_id):
+        """
+        Get the clients registered with the given repo.
+
+        Args:
+            repo_id (str): The repo ID.
+
+        Returns:
+            dict: A copy of the lists of clients, keyed by type of client
+                (either `LIBRARY` or `DASHBOARD`), or `None` if no client
+                ever registered with the repo.
+        """
+        with self.clients_lock:
+            repo_clients = self.clients.get(repo_id)
+            if repo_clients is None:
+                return None
+            return {client_type: list(clients) \
+                for client_type, clients in repo_clients.items()}
 
     def unregister(self, client):
         """
@@ -66,27 +111,75 @@ class CloudNodeFactory(WebSocketServerFactory):
         Returns:
             bool: Returns whether unregistration was successful.
         """
-        messages = []
+        # NOTE: The client is removed from the table before any repo lock is
+        # taken, see the lock order above.
+        removed = []
+        with self.clients_lock:
+            for repo_id, repo_clients in self.clients.items():
+                for client_type, clients in repo_clients.items():
+                    if client in clients:
+                        print("Unregistered client {}".format(client.peer))
+                        clients.remove(client)
+                        removed.append((repo_id, client_type))
 
-        success = False
-        for repo_id, repo_clients in self.clients.items():
-            state.start_state(repo_id)
-            for client_type, clients in repo_clients.items():
-                if client in clients:
-                    print("Unregistered client {}".format(client.peer))
-                    self.clients[repo_id][client_type].remove(client)
-                    success = True
-                    if client_type == ClientType.DASHBOARD:
+        messages = []
+        for repo_id, client_type in removed:
+            repo_state = state.start_state(repo_id)
+            try:
+                if client_type == ClientType.DASHBOARD:
+                    state.reset_state(repo_id)
+                elif repo_state["busy"] \
+                        and client in repo_state["chosen_clients"]:
+                    repo_state["chosen_clients"].remove(client)
+                    repo_state["num_nodes_chosen"] -= 1
+                    if repo_state["num_nodes_chosen"] == 0:
                         state.reset_state(repo_id)
-                    elif state.state["busy"]:
-                        state.state["num_nodes_chosen"] -= 1
-                        if state.state["num_nodes_chosen"] == 0:
-                            state.reset_state(repo_id)
-                            message = self._make_no_nodes_left_message(repo_id)
-                            messages.append(message)
-                            
-            state.stop_state()
-        return success, messages
+                        message = self._make_no_nodes_left_message(repo_id)
+                        messages.append(message)
+            finally:
+                state.stop_state(repo_state)
+        return bool(removed), messages
+
+    def cancel_round(self, repo_id):
+        """
+        Cancel the pending round deadlines and wall-clock budgets of a repo
+        and the waves of its last dispatch that weren't sent yet, so they
+        don't reach the next session of the repo.
+
+        NOTE: Must only be called from the reactor thread.
+
+        Args:
+            repo_id (str): The repo ID.
+        """
+        self.cancel_round_deadlines(repo_id)
+        for call in self.session_timers.pop(repo_id, []):
+            if call.active():
+                call.cancel()
+        self.broadcaster.cancel_dispatch(repo_id)
+
+    def cancel_round_deadlines(self, repo_id):
+        """
+        Cancel the pending round deadlines of a repo.
+
+        NOTE: Must only be called from the reactor thread.
+
+        Args:
+            repo_id (str): The repo ID.
+        """
+        for call in self.round_timers.pop(repo_id, []):
+            if call.active():
+                call.cancel()
+
+    def _on_reset(self, repo_id):
+        """
+        Cancel the round of a repo whose state was reset, on every reset path
+        (stopped session, dashboard left, no nodes left, `/reset_state`...).
+
+        NOTE: The cancellation is queued on the reactor before the results
+        of the job that reset the state, so it can't cancel the round of the
+        next session.
+        """
+        reactor.callFromThread(self.cancel_round, repo_id)
 
     def _make_no_nodes_left_message(self, repo_id):
         """
@@ -99,7 +192,7 @@ class CloudNodeFactory(WebSocketServerFactory):
             dict: The error message to send.
         """
         error_message = "All nodes in this round dropped out!"
-        client_list = self.clients[repo_id][ClientType.DASHBOARD]
+        client_list = self.get_clients(repo_id)[ClientType.DASHBOARD]
         return make_error_results(error_message, ErrorType.NO_NODES_LEFT, \
             action=ActionType.BROADCAST, client_list=client_list)
 
@@ -116,5 +209,6 @@ class CloudNodeFactory(WebSocketServerFactory):
         Returns:
             bool: Returns whether client is in the list of clients.
         """
-        return repo_id in self.clients \
-            and client in self.clients[repo_id][client_type]
+        with self.clients_lock:
+            return repo_id in self.clients \
+                and client in self.clients[repo_id][client_type]
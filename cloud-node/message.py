@@ -3,6 +3,10 @@ import base64
 import numpy as np
 from enum import Enum
 
+from update_encoding import check_encoding, DEFAULT_UPDATE_ENCODING, \
+    UPDATE_ENCODING_DTYPES
+from server_optimizer import check_server_optimizer
+
 
 class MessageType(Enum):
     """
@@ -13,6 +17,9 @@ class MessageType(Enum):
     NEW_UPDATE = "NEW_UPDATE"
     NO_DATASET = "NO_DATASET"
     TRAINING_ERROR = "TRAINING_ERROR"
+    UPDATE_BEGIN = "UPDATE_BEGIN"
+    UPDATE_CHUNK = "UPDATE_CHUNK"
+    UPDATE_COMMIT = "UPDATE_COMMIT"
 
 class ClientType(Enum):
     """ 
@@ -46,6 +53,7 @@ class LibraryActionType(Enum):
     REGISTRATION_SUCCESS = "REGISTRATION_SUCCESS"
     TRAIN = "TRAIN"
     STOP = "STOP"
+    UPLOAD_STATUS = "UPLOAD_STATUS"
 
 class ErrorType(Enum):
     """ 
@@ -63,9 +71,16 @@ class ErrorType(Enum):
     NEW_UPDATE = "NEW_UPDATE"
     NO_DATASET = "NO_DATASET"
     TRAINING_ERROR = "TRAINING_ERROR"
+    UPLOAD = "UPLOAD"
     UNKNOWN_MESSAGE_TYPE = "UNKNOWN_MESSAGE_TYPE"
     OTHER = "OTHER"
 
+class LateUpdateError(Exception):
+    """
+    Raised when an update arrives for a round that's already closed (or for
+    a session that isn't active), so it's dropped before being decoded.
+    """
+
 class Message:
     """
     Base class for messages received by the service.
@@ -84,7 +99,11 @@ class RegistrationMessage(Message):
     The type of message initially sent by a node with information of what type
     of node they are.
 
-    `client_type` should be one of DASHBOARD or LIBRARY.
+    `client_type` should be one of DASHBOARD or LIBRARY. `binary_frames` is
+    set if the node can send and receive binary tensor frames (see
+    `tensor_frames.py`). `client_id` is an optional ID that the node keeps
+    across reconnections, so its performance history is kept too (see
+    `client_stats.py`).
 
     Args:
         serialized_message (dict): The serialized message to register a new
@@ -96,12 +115,16 @@ class RegistrationMessage(Message):
         self.client_type = serialized_message["node_type"].upper()
         self.repo_id = serialized_message["repo_id"]
         self.api_key = serialized_message["api_key"]
+        self.binary_frames = serialized_message.get("binary_frames", False)
+        self.client_id = serialized_message.get("client_id", None)
 
     def __repr__(self):
         return json.dumps({
             "client_type": self.client_type,
             "repo_id": self.repo_id,
             "api_key": self.api_key, 
+            "binary_frames": self.binary_frames,
+            "client_id": self.client_id,
         })
 
 
@@ -121,10 +144,20 @@ class NewSessionMessage(Message):
         self.dataset_id = serialized_message.get("dataset_id", None)
         self.session_id = serialized_message["session_id"]
         self.hyperparams = serialized_message["hyperparams"]
+        self.update_encoding = self.hyperparams.get("update_encoding", \
+            DEFAULT_UPDATE_ENCODING)
+        check_encoding(self.update_encoding)
+        self.update_sparsity = self.hyperparams.get("update_sparsity", None)
+        if self.update_sparsity is not None \
+                and not 0 < self.update_sparsity <= 1:
+            raise ValueError("Update sparsity must be in (0, 1]!")
         self.selection_criteria = serialized_message["selection_criteria"]
         self.continuation_criteria = serialized_message["continuation_criteria"]
         self.termination_criteria = serialized_message["termination_criteria"]
         self.checkpoint_frequency = serialized_message.get("checkpoint_frequency", 1)
+        self.aggregation_config = serialized_message.get("aggregation_config", {})
+        if "server_optimizer" in self.aggregation_config:
+            check_server_optimizer(self.aggregation_config["server_optimizer"])
         self.ios_config = serialized_message["ios_config"]
         self.library_type = serialized_message["library_type"]
         self.client_type = ClientType.DASHBOARD
@@ -137,6 +170,7 @@ class NewSessionMessage(Message):
             "continuation_criteria": self.continuation_criteria,
             "termination_criteria": self.termination_criteria,
             "checkpoint_frequency": self.checkpoint_frequency,
+            "aggregation_config": self.aggregation_config,
             "ios_config": self.ios_config,
             "library_type": self.library_type,
         })
@@ -145,7 +179,8 @@ class NewSessionMessage(Message):
 class NewUpdateMessage(Message):
     """
     The update message sent by the Library. Indicates new weights or gradients
-    to be averaged after training.
+    to be averaged after training, encoded with the session's update encoding
+    (see `update_encoding.py`).
 
     Args:
         serialized_message (dict): The serialized message to provide the new
@@ -157,21 +192,51 @@ class NewUpdateMessage(Message):
         self.repo_id = serialized_message["repo_id"]
         self.session_id = serialized_message["session_id"]
         self.round = serialized_message["round"]
-        if "gradients" in serialized_message["results"]:
-            if isinstance(serialized_message["results"], str):
-                serialized_message["results"] = json.loads(serialized_message["results"])
-            gradients = serialized_message["results"]["gradients"]
-            self.gradients = [np.array(gradient) for gradient in gradients]
-            self.binary_weights = serialized_message["results"].get("binary_gradients", None)
-        elif "weights" in serialized_message["results"]:
-            self.weights = np.array(
-                serialized_message["results"]["weights"],
-                dtype=np.dtype(float),
-            )
+        if isinstance(serialized_message["results"], str):
+            serialized_message["results"] = json.loads(serialized_message["results"])
+        results = serialized_message["results"]
+        self.encoding = results.get("encoding", DEFAULT_UPDATE_ENCODING)
+        check_encoding(self.encoding)
+        self.scales, self.zero_points = None, None
+        if self.encoding == "int8":
+            self.scales = results.get("scales", None)
+            self.zero_points = results.get("zero_points", None)
+            if self.scales is None or self.zero_points is None:
+                raise Exception("No scales or zero-points received!")
+
+        # NOTE: Sparse updates only send the top-k entries of every layer of
+        # the gradients, as (index, value) pairs.
+        self.indices, self.shapes = None, None
+        if "indices" in results:
+            if "gradients" not in results:
+                raise Exception("Only gradients can be sparse!")
+            self.indices = [np.asarray(indices, dtype=np.intp) \
+                for indices in results["indices"]]
+            self.shapes = [tuple(shape) for shape in results["shapes"]]
+
+        dtype = UPDATE_ENCODING_DTYPES[self.encoding]
+        self.binary_weights = None
+        if "gradients" in results:
+            self.gradients = [np.asarray(gradient, dtype=dtype) \
+                for gradient in results["gradients"]]
+            # NOTE: The binary weights are base64 encoded in JSON messages,
+            # and raw bytes in binary tensor frames.
+            binary_weights = results.get("binary_gradients", None)
+            if isinstance(binary_weights, str):
+                self.binary_weights = base64.b64decode(binary_weights)
+            elif binary_weights is not None:
+                self.binary_weights = np.asarray(binary_weights, \
+                    dtype=np.uint8).tobytes()
+        elif "weights" in results:
+            self.weights = np.asarray(results["weights"], dtype=dtype)
         else:
             raise Exception(("No update received!"))
         self.omega = serialized_message["results"]["omega"]
+        self.metrics = results.get("metrics", None) or {}
         self.dataset_id = serialized_message.get("dataset_id", None)
+        # NOTE: The timings the library measured itself, in seconds (see
+        # `client_stats.py`).
+        self.timings = serialized_message.get("timings", {})
         self.client_type = ClientType.LIBRARY
 
     def __repr__(self):
@@ -180,6 +245,7 @@ class NewUpdateMessage(Message):
             "session_id": self.session_id,
             "round": self.round,
             "weights": "omitted",
+            "encoding": self.encoding,
             "omega": self.omega,
         })
 
@@ -235,6 +301,85 @@ class TrainingErrorMessage(Message):
             "round": self.round,
         })
 
+class UpdateBeginMessage(Message):
+    """
+    The message sent by the Library to start (or resume) uploading a
+    `NEW_UPDATE` message in chunks, instead of in a single message.
+
+    Args:
+        serialized_message (dict): The serialized message to start the
+            upload.
+    """
+    type = MessageType.UPDATE_BEGIN.value
+
+    def __init__(self, serialized_message):
+        self.repo_id = serialized_message["repo_id"]
+        self.sha256 = serialized_message["sha256"]
+        self.total_size = int(serialized_message["total_size"])
+        self.chunk_size = int(serialized_message["chunk_size"])
+        self.binary = serialized_message.get("binary", False)
+        self.client_type = ClientType.LIBRARY
+
+    def __repr__(self):
+        return json.dumps({
+            "repo_id": self.repo_id,
+            "sha256": self.sha256,
+            "total_size": self.total_size,
+            "chunk_size": self.chunk_size,
+            "binary": self.binary,
+        })
+
+class UpdateChunkMessage(Message):
+    """
+    A chunk of an update being uploaded. The data is base64 encoded in JSON
+    messages, and raw bytes in binary tensor frames.
+
+    Args:
+        serialized_message (dict): The serialized message with the chunk.
+    """
+    type = MessageType.UPDATE_CHUNK.value
+
+    def __init__(self, serialized_message):
+        self.repo_id = serialized_message["repo_id"]
+        self.sha256 = serialized_message["sha256"]
+        self.index = int(serialized_message["index"])
+        data = serialized_message["data"]
+        if isinstance(data, str):
+            self.data = base64.b64decode(data)
+        else:
+            self.data = np.asarray(data, dtype=np.uint8)
+        self.client_type = ClientType.LIBRARY
+
+    def __repr__(self):
+        return json.dumps({
+            "repo_id": self.repo_id,
+            "sha256": self.sha256,
+            "index": self.index,
+            "data": "omitted",
+        })
+
+class UpdateCommitMessage(Message):
+    """
+    The message sent by the Library once all the chunks of an update have
+    been sent.
+
+    Args:
+        serialized_message (dict): The serialized message to commit the
+            upload.
+    """
+    type = MessageType.UPDATE_COMMIT.value
+
+    def __init__(self, serialized_message):
+        self.repo_id = serialized_message["repo_id"]
+        self.sha256 = serialized_message["sha256"]
+        self.client_type = ClientType.LIBRARY
+
+    def __repr__(self):
+        return json.dumps({
+            "repo_id": self.repo_id,
+            "sha256": self.sha256,
+        })
+
 def make_error_results(error_message, error_type, action=ActionType.UNICAST, \
         client_list=None):
     """
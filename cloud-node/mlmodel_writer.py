@@ -0,0 +1,121 @@
+import numpy as np
+import coremltools
+
+
+# NOTE: Packed repeated fields are length-delimited on the wire.
+WIRETYPE_LENGTH_DELIMITED = 2
+
+class MLModelWriter(object):
+    """
+    Writes MLModels for image data straight from numpy weights, reusing the
+    updatable spec built at the beginning of the session.
+
+    Only the weights change between rounds, so instead of reconverting the
+    Keras model, the `weights` / `bias` fields of the spec's layers are
+    patched in place and the spec is serialized once.
+
+    Supported layers are dense (`innerProduct`), convolution (no groups, no
+    deconvolution) and embedding layers, with their weights in Keras layout.
+
+    Args:
+        mlmodel_path (str): Path to the updatable MLModel of the session.
+    """
+
+    def __init__(self, mlmodel_path):
+        self.spec = coremltools.utils.load_spec(mlmodel_path)
+        neural_network = getattr(self.spec, self.spec.WhichOneof("Type"))
+        self.layers = {layer.name: layer for layer in neural_network.layers}
+
+    def supports(self, layer_names):
+        """
+        Whether the weights of all the given layers can be patched.
+
+        Args:
+            layer_names (list): The names of the Keras layers with weights.
+
+        Returns:
+            bool: Returns `True` if every layer can be patched.
+        """
+        return all(_layer_params(self.layers.get(name)) is not None \
+            for name in layer_names)
+
+    def write(self, layer_weights, mlmodel_path):
+        """
+        Patch the weights of the spec and save it as a new MLModel.
+
+        Args:
+            layer_weights (dict): The Keras weights of every layer, keyed by
+                layer name.
+            mlmodel_path (str): The path to save the MLModel to.
+        """
+        for layer_name, weights in layer_weights.items():
+            layer = self.layers[layer_name]
+            params = _layer_params(layer)
+            kernel = _to_coreml_layout(layer.WhichOneof("layer"), weights[0])
+            _set_float_values(params.weights, kernel)
+            if len(weights) > 1:
+                _set_float_values(params.bias, weights[1])
+
+        coremltools.utils.save_spec(self.spec, mlmodel_path)
+
+def _layer_params(layer):
+    """
+    Get the parameters of a layer whose weights can be patched, if any.
+    """
+    if layer is None:
+        return None
+
+    layer_type = layer.WhichOneof("layer")
+    if layer_type in ("innerProduct", "embedding"):
+        return getattr(layer, layer_type)
+    if layer_type == "convolution" and not layer.convolution.isDeconvolution \
+            and layer.convolution.nGroups <= 1:
+        return layer.convolution
+    return None
+
+def _to_coreml_layout(layer_type, kernel):
+    """
+    Convert a Keras kernel into the layout CoreML stores it in (same as the
+    Keras converter).
+    """
+    kernel = np.asarray(kernel, dtype=np.float32)
+    if layer_type == "convolution":
+        # (height, width, input channels, output channels) ->
+        # (output channels, input channels, height, width)
+        return kernel.transpose((3, 2, 0, 1))
+    # (input channels, output channels) -> (output channels, input channels)
+    return kernel.T
+
+def _set_float_values(weight_params, values):
+    """
+    Replace the `floatValue` field of a `WeightParams` message.
+
+    Instead of converting the values into Python floats one by one, the
+    float32 buffer is written in one go as the wire encoding of the packed
+    field and parsed back into the message.
+    """
+    values = np.asarray(values, dtype="<f4").ravel()
+    if len(weight_params.floatValue) != values.size:
+        raise ValueError("Expected {0} values, got {1}!".format(
+            len(weight_params.floatValue), values.size))
+    field = weight_params.DESCRIPTOR.fields_by_name["floatValue"]
+    payload = values.tobytes()
+    weight_params.ClearField("floatValue")
+    weight_params.MergeFromString(b"".join([
+        _encode_varint(field.number << 3 | WIRETYPE_LENGTH_DELIMITED),
+        _encode_varint(len(payload)),
+        payload,
+    ]))
+
+def _encode_varint(value):
+    """
+    Encode a non-negative integer as a protobuf varint.
+    """
+    encoded = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if not value:
+            encoded.append(bits)
+            return bytes(encoded)
+        encoded.append(bits | 0x80)
@@ -3,30 +3,19 @@ import uuid
 import json
 import base64
 from functools import reduce
-import shutil
 
 import boto3
-from keras import backend as K
-from keras.models import load_model
-from keras.losses import categorical_crossentropy, mean_squared_error
-from keras.optimizers import SGD, Adam
 import numpy as np
-import tensorflowjs as tfjs
-import coremltools
-from coremltools.converters import keras as keras_converter
-from coremltools.proto import FeatureTypes_pb2 as _FeatureTypes_pb2
-from coremltools.models.neural_network import SgdParams, AdamParams
-from coremltools.models import MLModel
-import tensorflow as tf
-tf.compat.v1.disable_v2_behavior()
-
-import state
+
+import artifacts
+import converter_pool
 from message import LibraryType
 from parse_weights import calculate_new_weights
+from weightstore import H5WeightStore
+from tfjs_writer import TFJSWriter, reorder_weights
 
 
 TEMP_FOLDER = 'temp'
-UNLIMITED_EPOCHS = 100000
 
 def convert_and_save_b64model(base64_h5_model):
     """
@@ -45,13 +34,16 @@ def convert_and_save_b64model(base64_h5_model):
     # Convert and save model for serving
     _convert_and_save_model(h5_model_path)
 
-def fetch_keras_model():
+def fetch_keras_model(repo_state):
     """
     Download the initial Keras model.
 
     This function is to be called at the beginning of a DML Session.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
     """
-    model_path = _fetch_model_folder()
+    model_path = _fetch_model_folder(repo_state)
 
     # Create directory if necessary
     if not os.path.exists(model_path):
@@ -60,8 +52,8 @@ def fetch_keras_model():
     # Save model on disk
     h5_model_path = model_path + '/model.h5'
     try:
-        repo_id = state.state["repo_id"]
-        session_id = state.state["session_id"]
+        repo_id = repo_state["repo_id"]
+        session_id = repo_state["session_id"]
         s3 = boto3.resource("s3")
         model_s3_key = "{0}/{1}/{2}/model.h5"
         model_s3_key = model_s3_key.format(repo_id, session_id, 0)
@@ -70,19 +62,24 @@ def fetch_keras_model():
     except Exception as e:
         print("S3 Error: {0}".format(e))
 
-    state.state['h5_model_path'] = h5_model_path
+    repo_state['h5_model_path'] = h5_model_path
+    if repo_state["library_type"] == LibraryType.PYTHON.value:
+        _publish_artifact(repo_state, h5_model_path)
     
-    return state.state['h5_model_path']
+    return repo_state['h5_model_path']
 
-def fetch_mlmodel():
+def fetch_mlmodel(repo_state):
     """
     Download the MLModel converted from a Keras model.
 
     This function is to be called at the beginning of a DML Session.
 
     NOTE: This function is only for text models to be used with iOS libraries.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
     """
-    model_path = _fetch_model_folder()
+    model_path = _fetch_model_folder(repo_state)
 
     # Create directory if necessary
     if not os.path.exists(model_path):
@@ -91,8 +88,8 @@ def fetch_mlmodel():
     # Save model on disk
     mlmodel_path = model_path + '/my_model.mlmodel'
     try:
-        repo_id = state.state["repo_id"]
-        session_id = state.state["session_id"]
+        repo_id = repo_state["repo_id"]
+        session_id = repo_state["session_id"]
         s3 = boto3.resource("s3")
         model_s3_key = "{0}/{1}/{2}/model.mlmodel"
         model_s3_key = model_s3_key.format(repo_id, session_id, 0)
@@ -101,11 +98,11 @@ def fetch_mlmodel():
     except Exception as e:
         print("S3 Error: {0}".format(e))
 
-    state.state['mlmodel_path'] = h5_model_path
+    repo_state['mlmodel_path'] = h5_model_path
     
-    return state.state['mlmodel_path']
+    return repo_state['mlmodel_path']
     
-def save_mlmodel_weights(binary_weights):
+def save_mlmodel_weights(repo_state, binary_weights):
     """
     Save the provided binary weights from the iOS Library so that gradient
     calculation can be done.
@@ -113,42 +110,44 @@ def save_mlmodel_weights(binary_weights):
     Only called after round 1 of training with the iOS Library for text data.
     
     Args:
-        binary_weights (str): The binary weights to be saved.
+        repo_state (RepoState): The state of the repo.
+        binary_weights (bytes): The binary weights to be saved.
     """
-    mlmodel_path = _fetch_model_folder()
+    mlmodel_folder_path = _fetch_model_folder(repo_state)
+    if not os.path.isdir(mlmodel_folder_path):
+        os.makedirs(mlmodel_folder_path)
     mlmodel_weights_path = os.path.join(mlmodel_folder_path, "weights")
-    with open(mlmodel_folder_path, "rb") as f:
+    with open(mlmodel_weights_path, "wb") as f:
         f.write(binary_weights)
-        state.state["mlmodel_weights_path"] = mlmodel_weights_path
+    repo_state["mlmodel_weights_path"] = mlmodel_weights_path
 
-def get_encoded_h5_model():
+def get_encoded_h5_model(repo_state):
     """
     Get the encoded string of the h5 Keras model.
 
+    Args:
+        repo_state (RepoState): The state of the repo.
+
     Returns:
         str: Returns a base64 string of the h5 Keras model
     """
-    with open(state.state["h5_model_path"], mode='rb') as file:
+    with open(repo_state["h5_model_path"], mode='rb') as file:
         file_content = file.read()
         encoded_content = base64.encodebytes(file_content)
         h5_model = encoded_content.decode('ascii')
         return h5_model
 
-def get_keras_model():
-    """
-    Load the Keras model from the `.h5` file.
-
-    Returns:
-        keras.engine.Model: Returns the loaded Keras model.
-    """
-    return load_model(state.state["h5_model_path"])
-
-def convert_keras_model_to_tfjs():
+def convert_keras_model_to_tfjs(repo_state):
     """
     Retrieves the current Keras model, converts it (from the path) into a
     tf.js model, extracts metadata from the model, and prepares the temp 
     folder where this new converted model will be served from.
 
+    The Keras model is only converted at the beginning of the session. For
+    the following rounds, the session's `TFJSWriter` reuses the converted
+    topology and only rewrites the weight shards from the weights committed
+    in the last round.
+
     The new converted model gets stored in:
         `<TEMP_FOLDER>/<repo_id>/<session_id>/<current_round>`
 
@@ -156,87 +155,128 @@ def convert_keras_model_to_tfjs():
         - `group1.-shard1of1.bin`
         - `model.json`
         - `metadata.json`
+
+    Args:
+        repo_state (RepoState): The state of the repo.
     """
-    model_path = _fetch_model_folder()
-    session_id = state.state["session_id"]
-    current_round = state.state["current_round"]
+    model_path = _fetch_model_folder(repo_state)
+    session_id = repo_state["session_id"]
+    current_round = repo_state["current_round"]
     tfjs_model_path = os.path.join(model_path, str(current_round))
-    state.state["tfjs_model_path"] = tfjs_model_path
-
-    _keras_2_tfjs()
+    repo_state["tfjs_model_path"] = tfjs_model_path
+
+    tfjs_writer = repo_state.get("tfjs_writer")
+    if tfjs_writer is None:
+        converter_pool.run("keras_to_tfjs", repo_state["h5_model_path"], \
+            tfjs_model_path)
+        model_json_path = repo_state["tfjs_model_path"] + "/model.json"
+        tfjs_writer = TFJSWriter(model_json_path)
+        repo_state["tfjs_writer"] = tfjs_writer
+    else:
+        weights = reorder_weights(_get_committed_weights(repo_state), \
+            get_weight_store(repo_state).weight_names, tfjs_writer.weight_names)
+        tfjs_writer.write(weights, tfjs_model_path)
 
-    model_json_path = state.state["tfjs_model_path"] + "/model.json"
-    with open(model_json_path, 'r') as fp:
-        model_json = json.loads(fp.read())
-        state.state["weights_shape"] = model_json["weightsManifest"][0]["weights"]
+    repo_state["weights_shape"] = tfjs_writer.weights_shape
 
-    metadata_path = state.state["tfjs_model_path"] + '/metadata.json'
+    metadata_path = repo_state["tfjs_model_path"] + '/metadata.json'
     metadata = {
         "session_id": session_id,
         "current_round": current_round,
     }
     with open(metadata_path, 'w') as fp:
         json.dump(metadata, fp, sort_keys=True, indent=4)
+    _publish_artifact(repo_state, tfjs_model_path)
 
-def convert_keras_model_to_mlmodel():
+def convert_keras_model_to_mlmodel(repo_state):
     """
     Retrieves the current Keras model, converts it (from the path) into a
     MLModel and prepares the temp folder where this new converted model will
     be served from.
 
+    The Keras model is only converted at the beginning of the session. For
+    the following rounds, the updatable spec of that first MLModel is reused
+    and only the weights of its layers are patched with the weights
+    committed in the last round.
+
+    The conversion runs in the converter pool (see `converter_pool.py`).
+
     The new converted model gets stored in:
         `<TEMP_FOLDER>/<repo_id>/<session_id>/<current_round>`
 
     Where the following files get created:
         - `my_model.mlmodel`
+
+    Args:
+        repo_state (RepoState): The state of the repo.
     """
-    model_path = _fetch_model_folder()
-    current_round = state.state["current_round"]
+    model_path = _fetch_model_folder(repo_state)
+    current_round = repo_state["current_round"]
     mlmodel_folder_path = os.path.join(model_path, str(current_round))
     if not os.path.exists(mlmodel_folder_path):
         os.makedirs(mlmodel_folder_path)
-    state.state["mlmodel_path"] = os.path.join(mlmodel_folder_path, "my_model.mlmodel")
+    repo_state["mlmodel_path"] = os.path.join(mlmodel_folder_path, "my_model.mlmodel")
 
-    _keras_2_mlmodel_image()
+    spec_mlmodel_path = repo_state.get("mlmodel_spec_path")
+    converter_pool.run("keras_to_mlmodel_image", repo_state["h5_model_path"], \
+        repo_state["mlmodel_path"], repo_state["ios_config"], \
+        repo_state["hyperparams"], spec_mlmodel_path)
+    if spec_mlmodel_path is None:
+        repo_state["mlmodel_spec_path"] = repo_state["mlmodel_path"]
+    _publish_artifact(repo_state, repo_state["mlmodel_path"])
 
-def swap_weights():
+def swap_weights(repo_state):
     """
-    For most libraries, load the stored h5 model, swap the weights with the 
-    aggregated weights currently in the global state, then saves the new model 
-    in <TEMP_FOLDER>/<repo_id>/<session_id>/model<round>.h5.
+    For most libraries, copy the stored h5 model, write the aggregated weights
+    currently in the global state directly into the copy's datasets, then
+    save it in <TEMP_FOLDER>/<repo_id>/<session_id>/model<round>.h5. Keras
+    isn't loaded for this.
 
     For iOS libraries, read the binary weights file at the old weights path,
     and write to a new binary weights file at 
     <TEMP_FOLDER>/<repo_id>/<session_id>/weights.
 
-    For Javascript libraries, this function also reconverts the Keras model
-    to a TFJS model.
+    For Javascript and iOS (image) libraries, the model served in the next
+    round is written from the committed weights when that round starts.
 
-    For iOS libraries (image), this function also reconverts the Keras model
-    to a iOS model.
-    """
-    model = get_keras_model()
-    _clear_checkpoint()
+    NOTE: This is expensive, so it's only called once per round (when the
+    round's averaged weights are committed).
 
-    base_model_path = _fetch_model_folder()
-    current_round = state.state["current_round"]
+    Args:
+        repo_state (RepoState): The state of the repo.
+    """
+    base_model_path = _fetch_model_folder(repo_state)
+    current_round = repo_state["current_round"]
+    old_h5_model_path = repo_state['h5_model_path']
     new_h5_model_path = base_model_path + '/model{0}.h5'.format(current_round)
-    state.state['h5_model_path'] = new_h5_model_path
-
-    if state.state["library_type"] == LibraryType.PYTHON.value:
-        gradients = state.state["current_gradients"]
-        learning_rate = model.optimizer.lr
-        weights = model.get_weights()
-        new_weights = np.subtract(weights, gradients)
-        model.set_weights(new_weights)
-        model.save(new_h5_model_path)
-    elif state.state["library_type"] == LibraryType.IOS_IMAGE.value:
-        gradients = state.state["current_gradients"]
-        learning_rate = K.eval(model.optimizer.lr)
+
+    if repo_state["library_type"] == LibraryType.IOS_TEXT.value:
+        old_mlmodel_weights_path = repo_state["mlmodel_weights_path"]
+        new_mlmodel_weights_path = base_model_path + '/weights{0}'.format(current_round)
+        learning_rate = 1
+        if old_h5_model_path:
+            learning_rate = get_weight_store(repo_state).learning_rate or learning_rate
+        _ = calculate_new_weights(old_mlmodel_weights_path, \
+                new_mlmodel_weights_path, repo_state["current_gradients"], \
+                lr=learning_rate)
+        artifacts.remove(old_mlmodel_weights_path)
+        repo_state["mlmodel_weights_path"] = new_mlmodel_weights_path
+        _publish_artifact(repo_state, new_mlmodel_weights_path)
+        return
+
+    weight_store = get_weight_store(repo_state)
+
+    if repo_state["library_type"] == LibraryType.PYTHON.value:
+        gradients = repo_state["current_gradients"]
+        weights = weight_store.get_weights(old_h5_model_path)
+        new_weights = [np.subtract(weight, gradient) \
+            for weight, gradient in zip(weights, gradients)]
+    elif repo_state["library_type"] == LibraryType.IOS_IMAGE.value:
+        gradients = repo_state["current_gradients"]
         new_weights = []
-        k = 0
 
-        for old_weight, grad in zip(model.get_weights(), gradients):
+        for old_weight, grad in zip(weight_store.get_weights(old_h5_model_path), \
+                gradients):
             num_params = np.prod(old_weight.shape)
             if len(grad) > num_params:
                 grad = grad[:num_params]
@@ -245,119 +285,115 @@ def swap_weights():
             if len(old_weight.shape) > 1:
                 grad = np.transpose(grad)
             new_weights.append(old_weight - grad)
-
-        model.set_weights(new_weights)
-        model.save(new_h5_model_path)
-        convert_keras_model_to_mlmodel()
-    elif state.state["library_type"] == LibraryType.IOS_TEXT.value:
-        old_mlmodel_weights_path = state.state["mlmodel_weights_path"]
-        new_mlmodel_weights_path = base_model_path + '/weights{0}'.format(current_round)
-        gradients = state.state["current_gradients"]
-        learning_rate = K.eval(model.optimizer.lr)
-        _ = calculate_new_weights(old_mlmodel_weights_path, \
-                new_mlmodel_weights_path, lr=learning_rate)
-        state.state["mlmodel_weights_path"] = new_mlmodel_weights_path
     else:
-        weights_flat = state.state["current_weights"]
-        weights_shape = state.state["weights_shape"]
-        weights, start = [], 0
+        weights_flat = repo_state["current_weights"]
+        weights_shape = repo_state["weights_shape"]
+        new_weights, start = [], 0
         for shape_data in weights_shape:
             shape = shape_data["shape"]
-            size = reduce(lambda x, y: x*y, shape)
+            size = reduce(lambda x, y: x*y, shape, 1)
             weights_np = np.array(weights_flat[start:start+size])
             weights_np.resize(tuple(shape))
-            weights.append(weights_np)
+            new_weights.append(weights_np)
             start += size
-        model.set_weights(weights)
-        model.save(new_h5_model_path)
-        convert_keras_model_to_tfjs()
+        # NOTE: The weights are averaged in manifest order.
+        new_weights = reorder_weights(new_weights, \
+            [shape_data["name"] for shape_data in weights_shape], \
+            weight_store.weight_names)
+
+    weight_store.save_weights(old_h5_model_path, new_h5_model_path, new_weights)
+    _clear_checkpoint(repo_state)
+    repo_state['h5_model_path'] = new_h5_model_path
+    repo_state["committed_weights"] = new_weights
+    if repo_state["library_type"] == LibraryType.PYTHON.value:
+        _publish_artifact(repo_state, new_h5_model_path)
+
+def get_weight_store(repo_state):
+    """
+    Get the h5 weight store of this session, reading the layer -> dataset
+    mapping of the model the first time it's needed.
 
-    K.clear_session()
+    Args:
+        repo_state (RepoState): The state of the repo.
 
-def _clear_checkpoint():
+    Returns:
+        H5WeightStore: The weight store of this session.
     """
-    Removes the current model.
+    if repo_state.get("weight_store") is None:
+        repo_state["weight_store"] = H5WeightStore(repo_state["h5_model_path"])
+    return repo_state["weight_store"]
 
-    NOTE: Only call when model no longer needed!
+def _get_committed_weights(repo_state):
     """
-    os.remove(state.state["h5_model_path"])
-    if state.state["library_type"] == LibraryType.JS.value:
-        shutil.rmtree(state.state['tfjs_model_path'])
+    Get the weights of the current model, as committed by the last call to
+    `swap_weights(repo_state)` (or read from the h5 model if there was none),
+    in the order of the h5 model's datasets (see `H5WeightStore`).
+
+    Args:
+        repo_state (RepoState): The state of the repo.
 
-def _keras_2_tfjs():
+    Returns:
+        list: The weights of the current model.
     """
-    Converts a Keras h5 model into a tf.js model and saves it on disk.
+    if repo_state.get("committed_weights") is None:
+        weight_store = get_weight_store(repo_state)
+        repo_state["committed_weights"] = \
+            weight_store.get_weights(repo_state["h5_model_path"])
+    return repo_state["committed_weights"]
+
+def get_committed_flat_weights(repo_state):
     """
-    model = get_keras_model()
-    tfjs.converters.save_keras_model(model, state.state["tfjs_model_path"], np.uint16)
-    K.clear_session()
+    Get the weights of the current model as the single flat array (in
+    manifest order) that the libraries averaging weights send, e.g. for the
+    Javascript library.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
 
-def _keras_2_mlmodel_image():
+    Returns:
+        np.ndarray: The flat weights of the current model.
     """
-    Converts a Keras h5 model into ML Model for image data and saves it on 
-    disk.
+    weights = reorder_weights(_get_committed_weights(repo_state), \
+        get_weight_store(repo_state).weight_names, \
+        [shape_data["name"] for shape_data in repo_state["weights_shape"]])
+    return np.concatenate([np.ravel(weight) for weight in weights])
 
-    NOTE: Image configuration must be specified from Explora. 
+def _publish_artifact(repo_state, path):
+    """
+    Publish an artifact served to the libraries (see `artifacts.py`), so
+    it's hashed and precompressed before the round's downloads start.
 
-    NOTE: Currently, only categorical cross entropy loss is supported.
+    Args:
+        repo_state (RepoState): The state of the repo.
+        path (str): The path of the artifact (or folder of artifacts).
     """
-    model = get_keras_model()
-    ios_config = state.state["ios_config"]
-    class_labels = ios_config["class_labels"]
-    mlmodel = keras_converter.convert(model, input_names=['image'],
-                                output_names=['output'],
-                                class_labels=class_labels,
-                                predicted_feature_name='label')
-    mlmodel.save(state.state["mlmodel_path"])
-
-    image_config = ios_config["image_config"]
-    spec = coremltools.utils.load_spec(state.state["mlmodel_path"])
-    builder = coremltools.models.neural_network.NeuralNetworkBuilder(spec=spec)
-
-    dims = image_config["dims"]
-    spec.description.input[0].type.imageType.width = dims[0]
-    spec.description.input[0].type.imageType.height = dims[1]
-
-    cs = _FeatureTypes_pb2.ImageFeatureType.ColorSpace.Value(image_config["color_space"])
-    spec.description.input[0].type.imageType.colorSpace = cs
-
-    trainable_layer_names = [layer.name for layer in model.layers if layer.get_weights()]
-    builder.make_updatable(trainable_layer_names)
-
-    builder.set_categorical_cross_entropy_loss(name='loss', input='output')
-
-    if isinstance(model.optimizer, SGD):
-        params = SgdParams(
-            lr=K.eval(model.optimizer.lr), 
-            batch=state.state["hyperparams"]["batch_size"],
-        )
-        builder.set_sgd_optimizer(params)
-    elif isinstance(model.optimizer, Adam):
-        params = AdamParams(
-            lr=K.eval(model.optimizer.lr), 
-            batch_size=state.state["hyperparams"]["batch_size"],
-            beta1=model.optimizer.beta1,
-            beta2=model.optimizer.beta2,
-            eps=model.optimizer.eps,    
-        )
-        builder.set_adam_optimizer(params)
-    else:
-        raise Exception("iOS optimizer must be SGD or Adam!")
+    try:
+        artifacts.publish(path, repo_state["current_round"])
+    except Exception as e:
+        print("Error publishing artifact: {0}".format(e))
 
-    builder.set_epochs(UNLIMITED_EPOCHS)
-    builder.set_shuffle(state.state["hyperparams"]["shuffle"])  
+def _clear_checkpoint(repo_state):
+    """
+    Removes the current model, along with its precompressed variants.
 
-    mlmodel_updatable = MLModel(spec)
-    mlmodel_updatable.save(state.state["mlmodel_path"])
+    NOTE: Only call when model no longer needed!
 
-    K.clear_session()
+    Args:
+        repo_state (RepoState): The state of the repo.
+    """
+    artifacts.remove(repo_state["h5_model_path"])
+    if repo_state["library_type"] == LibraryType.JS.value:
+        artifacts.remove(repo_state['tfjs_model_path'])
 
-def _fetch_model_folder():
+def _fetch_model_folder(repo_state):
     """
     Retreive the model folder for this session.
+
+    Args:
+        repo_state (RepoState): The state of the repo.
     """
-    repo_id = state.state["repo_id"]
-    session_id = state.state["session_id"]
+    repo_id = repo_state["repo_id"]
+    session_id = repo_state["session_id"]
     return os.path.join(TEMP_FOLDER, repo_id, session_id)
 
 
@@ -3,34 +3,145 @@ import os
 
 import state
 from message import Message, MessageType, ClientType, ErrorType, ActionType, \
-    LibraryActionType,  make_error_results
-from coordinator import start_new_session, stop_session
+    LibraryActionType, LateUpdateError, make_error_results
+from coordinator import start_new_session, stop_session, hand_out_version
 from aggregator import handle_new_update, handle_no_dataset
+from tensor_frames import decode_frame
 
 
-def validate_new_message(payload):
+def validate_new_message(payload, is_binary=False):
     """
     Convert received message to JSON, classify the message, and sanity
     check received information.
 
     Args:
         payload (str): Received message.
+        is_binary (bool, optional): Whether the message is a binary tensor
+            frame (see `tensor_frames.py`) instead of JSON.
 
     Returns:
         `Message`: Returns a `Message` object that holds the type of the new
             message along with all relevant information.
     """
-    serialized_message = json.loads(payload)
+    if is_binary:
+        serialized_message = decode_frame(payload)
+    else:
+        serialized_message = json.loads(payload)
+    return _make_message(serialized_message)
+
+def validate_streamed_message(decoder):
+    """
+    Finish decoding a JSON message that was fed to the decoder chunk by
+    chunk, classify the message, and sanity check received information.
+
+    Args:
+        decoder (UpdateStreamDecoder): The decoder the message was fed to.
+
+    Returns:
+        `Message`: Returns a `Message` object that holds the type of the new
+            message along with all relevant information.
+    """
+    return _make_message(decoder.close())
+
+def _make_message(serialized_message):
+    """
+    Classify the deserialized message, dropping updates that arrived after
+    their round was closed.
+    """
+    if serialized_message.get("type") == MessageType.NEW_UPDATE.value \
+            and not state.accepts_round(serialized_message.get("session_id"), \
+                serialized_message.get("round")):
+        raise LateUpdateError("Update for round {} arrived too late!".format(
+            serialized_message.get("round")))
     message = Message.make(serialized_message)
     print("Message ({0}) contents: {1}".format(message.type, message))
     return message
 
-def process_new_message(message, factory, client):
+def process_upload_message(message, factory, client):
+    """
+    Process a message of an update uploaded in chunks (`UPDATE_BEGIN`,
+    `UPDATE_CHUNK` or `UPDATE_COMMIT`), staging the chunks in the factory's
+    upload store.
+
+    Doesn't need the state of the repo, so chunks of different nodes can be
+    staged concurrently. Once an upload is committed and complete, the
+    reassembled `NEW_UPDATE` message is decoded, to be processed like any
+    other message.
+
+    Args:
+        message (Message): `Message` object to process.
+        factory (CloudNodeFactory): Factory that manages WebSocket clients.
+
+    Returns:
+        tuple: The reassembled `NEW_UPDATE` message (`None` if the upload
+            isn't committed yet), and the results to send otherwise.
+    """
+    if not factory.is_registered(client, message.client_type, \
+            message.repo_id):
+        return None, make_error_results("This client is not registered!", \
+            ErrorType.NOT_REGISTERED)
+
+    uploads = factory.uploads
+    try:
+        if message.type == MessageType.UPDATE_BEGIN.value:
+            upload = uploads.begin(message.repo_id, message.sha256, \
+                message.total_size, message.chunk_size, message.binary)
+            return None, _make_upload_status(upload)
+
+        upload = uploads.get(message.repo_id, message.sha256)
+        if upload is None:
+            return None, make_error_results("Unknown upload!", \
+                ErrorType.UPLOAD)
+
+        if message.type == MessageType.UPDATE_CHUNK.value:
+            upload.write(message.index, message.data)
+            return None, {"action": ActionType.DO_NOTHING, "error": False}
+
+        # Let the node know which chunks it still has to send.
+        if not upload.complete:
+            return None, _make_upload_status(upload)
+
+        try:
+            payload = upload.payload()
+        finally:
+            uploads.discard(message.repo_id, message.sha256)
+    except ValueError as e:
+        return None, make_error_results(str(e), ErrorType.UPLOAD)
+
+    try:
+        update_message = validate_new_message(payload, upload.is_binary)
+    except LateUpdateError as e:
+        return None, make_error_results(str(e), ErrorType.NEW_UPDATE)
+    except Exception as e:
+        error_message = "Error deserializing upload: {}".format(e)
+        return None, make_error_results(error_message, \
+            ErrorType.DESERIALIZATION)
+    if update_message.type != MessageType.NEW_UPDATE.value:
+        return None, make_error_results("Only updates can be uploaded!", \
+            ErrorType.UPLOAD)
+    return update_message, None
+
+def _make_upload_status(upload):
+    """
+    Make the results with the chunks of the upload that are still missing.
+    """
+    return {
+        "action": ActionType.UNICAST,
+        "message": {
+            "action": LibraryActionType.UPLOAD_STATUS.value,
+            "sha256": upload.sha256,
+            "missing_chunks": upload.missing(),
+            "error": False,
+        },
+    }
+
+def process_new_message(repo_state, message, factory, client):
     """
     Process the new message and take the correct action with the appropriate
     clients.
 
     Args:
+        repo_state (RepoState): The state of the repo.
         message (Message): `Message` object to process.
         factory (CloudNodeFactory): Factory that manages WebSocket clients.
     
@@ -65,11 +176,12 @@ def process_new_message(message, factory, client):
                 ErrorType.REGISTRATION)
 
         if client_type == ClientType.DASHBOARD and is_demo:
-            if not factory.clients.get(DEMO_REPO_ID, {}).get(ClientType.LIBRARY, []):
+            demo_clients = factory.get_clients(DEMO_REPO_ID) or {}
+            if not demo_clients.get(ClientType.LIBRARY, []):
                 error_message = "An internal demo device error occurred."
                 return make_error_results(error_message, \
                     ErrorType.REGISTRATION)
-            demo_client = factory.clients[DEMO_REPO_ID][ClientType.LIBRARY][0]
+            demo_client = demo_clients[ClientType.LIBRARY][0]
             if not factory.is_registered(demo_client, ClientType.LIBRARY, \
                     message.repo_id):
                 error_message = factory.register(demo_client, ClientType.LIBRARY, \
@@ -79,21 +191,29 @@ def process_new_message(message, factory, client):
                         ErrorType.REGISTRATION)               
         
         print("Registered node as type: {}".format(message.client_type))
+        client.binary_frames = message.binary_frames
+        client.client_id = message.client_id
 
         results["action"] = ActionType.UNICAST
 
-        if client_type == ClientType.LIBRARY and state.state["busy"] is True:
+        if client_type == ClientType.LIBRARY and repo_state["busy"] is True:
             # There's a session active, we should incorporate the just
             # added node into the session!
             print("Adding the new library node to this round!")
-            state.state["num_nodes_chosen"] += 1
-            last_message = state.state["last_message_sent_to_library"]
-            results["message"] = last_message
+            repo_state["num_nodes_chosen"] += 1
+            repo_state["chosen_clients"].append(client)
+            if repo_state["asynchronous"]:
+                results["message"] = hand_out_version(repo_state)["message"]
+            else:
+                last_message = repo_state["last_message_sent_to_library"]
+                results["message"] = last_message
         else:
             results["message"] = {
                 "action": LibraryActionType.REGISTRATION_SUCCESS.value,
                 "error": False,
             }
+            if message.binary_frames:
+                results["message"]["binary_frames"] = True
             
 
     elif message.type == MessageType.NEW_SESSION.value:
@@ -103,14 +223,15 @@ def process_new_message(message, factory, client):
             return make_error_results("This client is not registered!", \
                 ErrorType.NOT_REGISTERED)
 
-        repo_clients = factory.clients[message.repo_id]
+        repo_clients = factory.get_clients(message.repo_id)
 
         # Start new DML Session
-        if state.state["busy"]:
+        if repo_state["busy"]:
             print("Aborting because the server is busy.")
             return make_error_results("Server is already busy working.", \
                 ErrorType.SERVER_BUSY) 
-        return start_new_session(message, repo_clients[ClientType.LIBRARY])
+        return start_new_session(repo_state, message, \
+            repo_clients[ClientType.LIBRARY])
 
     elif message.type == MessageType.NEW_UPDATE.value:
         # Verify this node has been registered
@@ -119,16 +240,16 @@ def process_new_message(message, factory, client):
             return make_error_results("This client is not registered!", \
                 ErrorType.NOT_REGISTERED)
 
-        repo_clients = factory.clients[message.repo_id]
+        repo_clients = factory.get_clients(message.repo_id)
 
         if repo_clients[ClientType.DASHBOARD]: 
             # Handle new weights (average, move to next round, terminate session)
             print("Averaged new weights!")
-            return handle_new_update(message, repo_clients)
+            return handle_new_update(repo_state, message, repo_clients)
         else:
             # Stopping session as the session starter has disconnected.
             print("Disconnected from dashboard client, stopping session.")
-            return stop_session(message.repo_id, repo_clients)
+            return stop_session(repo_state, repo_clients)
 
     elif message.type == MessageType.NO_DATASET.value:
         # Verify this node has been registered
@@ -137,18 +258,18 @@ def process_new_message(message, factory, client):
             return make_error_results("This client is not registered!", \
                 ErrorType.NOT_REGISTERED)
 
-        repo_clients = factory.clients[message.repo_id]
+        repo_clients = factory.get_clients(message.repo_id)
 
         if repo_clients[ClientType.DASHBOARD]: 
             # Handle `NO_DATASET` message (reduce # of chosen nodes, analyze 
             # continuation and termination criteria accordingly)
             print("Handled `NO_DATASET` message!")
-            return handle_no_dataset(message, repo_clients)
+            return handle_no_dataset(repo_state, message, repo_clients)
             
         else:
             # Stopping session as the session starter has disconnected.
             print("Disconnected from dashboard client, stopping session.")
-            return stop_session(message.repo_id, repo_clients)
+            return stop_session(repo_state, repo_clients)
     
     elif message.type == MessageType.TRAINING_ERROR.value:
         # Verify this node has been registered
@@ -157,7 +278,7 @@ def process_new_message(message, factory, client):
             return make_error_results("This client is not registered!", \
                 ErrorType.NOT_REGISTERED)
 
-        repo_clients = factory.clients[message.repo_id]
+        repo_clients = factory.get_clients(message.repo_id)
 
         if repo_clients[ClientType.DASHBOARD]: 
             # Handle `TRAINING_ERROR` message (reduce # of chosen nodes, analyze 
@@ -170,7 +291,7 @@ def process_new_message(message, factory, client):
                 action=ActionType.BROADCAST, client_list=client_list)
         else:
             # Stopping session as the session starter has disconnected.
-            return stop_session(message.repo_id, repo_clients)
+            return stop_session(repo_state, repo_clients)
             print("Disconnected from dashboard client, stopping session.")
 
     else:
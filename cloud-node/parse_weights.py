@@ -1,76 +1,44 @@
-import os
-import struct
+import shutil
 
 import numpy as np
 
-import state
 
+HEADER_SIZE_BYTES = 8
+LAYER_HEADER_SIZE_BYTES = 16
 
-def calculate_new_weights(old_weights_path, new_weights_path, lr=1):
+def calculate_new_weights(old_weights_path, new_weights_path, gradients, lr=1):
     """
     Calculate the new weights given the path to the old weights file. Also
     write the weights with the given the new weights path.
 
+    The old weights file is copied to the new weights path, which is then
+    memory-mapped so the gradients can be applied in place, layer by layer.
+
     Only called for iOS Library sessions for text data.
-    
+
     Args:
         old_weights_path (str): Path to old weights file.
         new_weights_path (str): Path to write new weights.
+        gradients (list): The averaged gradients of the trainable layers.
         lr (int, optional): The learning rate of the model. Defaults to 1.
-    
+
     Returns:
         list: A list of the calculated new weights, used for testing/debugging.
     """
-    layers_bytes = []
-    layers_data = {}
-
-    def read_write(bytes_to_read, data_format=None):
-        data = f_read.read(bytes_to_read)
-        f_write.write(data)
-        if data_format:
-            return struct.unpack(data_format, data)
-    
-    with open(new_weights_path, "wb") as f_write:
-        with open(old_weights_path, "rb") as f_read:
-            layers_arr = read_write(4, "<i")
-            num_layers = layers_arr[0]
-            
-            read_write(4) # padding bytes
-
-            while len(layers_bytes) < num_layers:
-                layer_bytes = read_write(16, "<iiii")
-                layers_bytes.append(layer_bytes)
-
-            weights = []
-            layers_data = []
-            
-            for layer_num, _, num_bytes, _ in layers_bytes:
-                data = struct.unpack("f" * int(num_bytes / 4), f_read.read(num_bytes))
-                layers_data.append(data)
-
-                if layer_num % 2 == 0:
-                    continue
-
-                if (layer_num + 1) % 4 == 0:
-                    weights.append(data)
-                    weights.append(bias)
-                else:
-                    bias = data
-
-            old_weights = [np.array(weight) for weight in weights]
-            new_weights = old_weights - lr * state.state["current_gradients"]
-
-            for layer_data, layer_bytes in zip(layers_data, layers_bytes):
-                layer_num, _, num_bytes, _ = layer_bytes
-                if layer_num % 2 != 0:
-                    if layer_num % 4 == 1:
-                        layer_data = new_weights[int(layer_num/2) + 1] # bias
-                    else:
-                        layer_data = new_weights[int(layer_num/2) - 1] # kernel
-                f_write.write(struct.pack("f" * int(num_bytes / 4), *layer_data))
+    shutil.copyfile(old_weights_path, new_weights_path)
+    weights_map = np.memmap(new_weights_path, dtype=np.uint8, mode="r+")
+
+    weights = _trainable_layers(_map_layers(weights_map))
+    for weight, gradient in zip(weights, gradients):
+        # NOTE: Computed in float64 and rounded to float32 when written.
+        np.subtract(weight, lr * np.ravel(gradient), out=weight, \
+            casting="unsafe")
+    weights_map.flush()
+
+    new_weights = [np.array(weight) for weight in weights]
+    del weights, weights_map
     return new_weights
 
-                
 def read_compiled_weights(weights_path):
     """
     Read the weights at the given path.
@@ -78,41 +46,61 @@ def read_compiled_weights(weights_path):
     Worked off of: https://gist.github.com/ghop02/9b09dcf7c5ee73f5dce6ba0e7c6f41d0#file-_read_compiled_coreml_weights-py
 
     NOTE: Only used for testing, may possibly have use in the future.
-    
+
     Args:
         weights_path (str): Path to the weights.
-    
+
     Returns:
         list: A list of the calculated new weights, used for testing/debugging.
     """
-    layer_bytes = []
-    layer_data = {}
-    with open(weights_path, "rb") as f:
-        # First byte of the file is an integer with how many
-        # sections there are.  This lets us iterate through each section
-        # and get the map for how to read the rest of the file.
-        num_layers = struct.unpack("<i", f.read(4))[0]
-
-        f.read(4)  # padding bytes
-
-        # The next section defines the number of bytes each layer contains.
-        # It has a format of
-        # | Layer Number | <padding> | Bytes in layer | <padding> |
-        while len(layer_bytes) < num_layers:
-            layer_num, _, num_bytes, _ = struct.unpack("<iiii", f.read(16))
-            layer_bytes.append((layer_num, num_bytes))
-
-        weights = []
-        # Read actual layer weights.  Weights are floats as far as I can tell.
-        for layer_num, num_bytes in layer_bytes:
-            data = struct.unpack("f" * int(num_bytes / 4), f.read(num_bytes))
-            if layer_num % 2 == 0:
-                continue
-
-            if (layer_num + 1) % 4 == 0:
-                weights.append(data)
-                weights.append(bias)
-            else:
-                bias = data
-
-        return [np.array(weight) for weight in weights]
+    weights_map = np.memmap(weights_path, dtype=np.uint8, mode="r")
+    weights = [np.array(weight) for weight \
+        in _trainable_layers(_map_layers(weights_map))]
+    del weights_map
+    return weights
+
+def _map_layers(weights_map):
+    """
+    Index the header of a compiled weights file and return a float32 view of
+    every layer.
+
+    The first integer of the file is the number of layers, followed by 4
+    padding bytes. Then, every layer has a header of the format:
+        | Layer Number | <padding> | Bytes in layer | <padding> |
+    and the data of the layers follows the headers, in the same order.
+
+    Args:
+        weights_map (np.memmap): The file, mapped as bytes.
+
+    Returns:
+        list: The `(layer number, float32 view)` of every layer.
+    """
+    num_layers = int(weights_map[:4].view("<i4")[0])
+    data_start = HEADER_SIZE_BYTES + num_layers * LAYER_HEADER_SIZE_BYTES
+    header = weights_map[HEADER_SIZE_BYTES:data_start].view("<i4") \
+        .reshape(num_layers, 4)
+    layer_nums = header[:, 0]
+    ends = data_start + np.cumsum(header[:, 2], dtype=np.int64)
+    starts = np.concatenate(([data_start], ends[:-1]))
+
+    return [(int(layer_num), weights_map[start:end].view("<f4")) \
+        for layer_num, start, end in zip(layer_nums, starts, ends)]
+
+def _trainable_layers(layers):
+    """
+    Get the views of the trainable layers, ordered as (kernel, bias) pairs.
+
+    Even layers aren't trainable. Odd layers alternate between biases and
+    kernels, with every bias stored before its kernel.
+    """
+    weights = []
+    for layer_num, data in layers:
+        if layer_num % 2 == 0:
+            continue
+
+        if (layer_num + 1) % 4 == 0:
+            weights.append(data)
+            weights.append(bias)
+        else:
+            bias = data
+    return weights
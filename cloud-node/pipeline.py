@@ -0,0 +1,136 @@
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_QUEUE_DEPTH = 1000
+
+class MessagePipeline(object):
+    """
+    Runs the stages of message processing (decoding, processing) in a bounded
+    pool of worker threads so that the reactor thread only does I/O.
+
+    Jobs submitted to a stage with the same key run one after the other, in
+    the order they were submitted, while jobs with different keys run
+    concurrently. The results are delivered back on the reactor thread
+    through the returned `Deferred`.
+
+    Bookkeeping (queues, counters) only ever happens on the reactor thread.
+
+    Args:
+        max_workers (int, optional): The maximum number of worker threads.
+        max_queue_depth (int, optional): The maximum number of jobs that can
+            be pending in a single stage.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, \
+            max_queue_depth=DEFAULT_MAX_QUEUE_DEPTH):
+        self.max_queue_depth = max_queue_depth
+        self._pool = ThreadPool(minthreads=1, maxthreads=max_workers, \
+            name="MessagePipeline")
+        self._queues = {}
+        self._stats = {}
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger("during", "shutdown", self._pool.stop)
+
+    def submit(self, stage, key, func, *args):
+        """
+        Queue `func(*args)` to run in a worker thread after every job that was
+        previously submitted to `stage` with the same `key`.
+
+        Args:
+            stage (str): The name of the stage.
+            key (object): The ordering key (e.g. the client or the repo ID).
+            func (callable): The function to run in a worker thread.
+
+        Returns:
+            Deferred: Fires on the reactor thread with the result of `func`.
+        """
+        stats = self._stage_stats(stage)
+        if stats["queue_depth"] >= self.max_queue_depth:
+            error_message = "Too many pending messages in stage {}!"
+            return defer.fail(Exception(error_message.format(stage)))
+
+        d = defer.Deferred()
+        queue = self._queues.setdefault((stage, key), deque())
+        queue.append((func, args, d, time.time()))
+        stats["queue_depth"] += 1
+        stats["max_queue_depth"] = max(stats["max_queue_depth"], \
+            stats["queue_depth"])
+
+        if len(queue) == 1:
+            self._run_next(stage, key)
+        return d
+
+    def stats(self):
+        """
+        Get the queue depth and latency counters of every stage.
+
+        NOTE: Must only be called from the reactor thread.
+
+        Returns:
+            dict: The counters, keyed by stage.
+        """
+        return {stage: dict(stats) for stage, stats in self._stats.items()}
+
+    def record(self, stage, started):
+        """
+        Record the latency of work done outside of the pool (e.g. sending the
+        results on the reactor thread).
+
+        Args:
+            stage (str): The name of the stage.
+            started (float): When the work started.
+        """
+        stats = self._stage_stats(stage)
+        latency = time.time() - started
+        stats["processed"] += 1
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        stats["last_latency"] = latency
+
+    def _run_next(self, stage, key):
+        """
+        Run the job at the head of the `(stage, key)` queue.
+        """
+        queue = self._queues[(stage, key)]
+        func, args, d, enqueued = queue[0]
+        started = time.time()
+        self._stage_stats(stage)["total_wait"] += started - enqueued
+
+        def done(result):
+            self.record(stage, started)
+            self._stage_stats(stage)["queue_depth"] -= 1
+            queue.popleft()
+            if queue:
+                self._run_next(stage, key)
+            else:
+                del self._queues[(stage, key)]
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        job = deferToThreadPool(reactor, self._pool, func, *args)
+        job.addBoth(done)
+
+    def _stage_stats(self, stage):
+        """
+        Get (or create) the counters of a stage.
+        """
+        if stage not in self._stats:
+            self._stats[stage] = {
+                "queue_depth": 0,
+                "max_queue_depth": 0,
+                "processed": 0,
+                "total_wait": 0.0,
+                "total_latency": 0.0,
+                "max_latency": 0.0,
+                "last_latency": 0.0,
+            }
+        return self._stats[stage]
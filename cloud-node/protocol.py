@@ -1,19 +1,40 @@
 import json
+import time
 
 from autobahn.twisted.websocket import WebSocketServerProtocol
 from twisted.internet import reactor
 
 import state
-from message import ActionType, ErrorType, make_error_results
-from new_message import validate_new_message, process_new_message
+import client_stats
+from message import MessageType, ActionType, ErrorType, LateUpdateError, \
+    make_error_results
+from new_message import validate_new_message, validate_streamed_message, \
+    process_new_message, process_upload_message
+from aggregator import handle_round_deadline, handle_session_deadline
+from stream_decoder import UpdateStreamDecoder
 
 
+UNREGISTER_KEY = "UNREGISTER"
+STREAM_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MESSAGE_TYPES = (MessageType.UPDATE_BEGIN.value, \
+    MessageType.UPDATE_CHUNK.value, MessageType.UPDATE_COMMIT.value)
+
 class CloudNodeProtocol(WebSocketServerProtocol):
     """
     Class that implements part of the Cloud Node networking logic (what happens
     when a new node connects, sends a message, disconnects). The networking 
     here happens through Websockets using the autobahn library.
+
+    Messages with tensors (gradients, weights) are sent as binary tensor
+    frames (see `tensor_frames.py`) to the nodes that registered with
+    `binary_frames`, and as JSON to the others.
+
+    JSON messages are decoded while they arrive (see `stream_decoder.py`),
+    binary ones once they're complete.
     """
+    binary_frames = False
+    client_id = None
+    _streamDecoder = None
 
     def doPing(self):
         if self.run:
@@ -45,13 +66,87 @@ class CloudNodeProtocol(WebSocketServerProtocol):
         """
         self.run = False
         print("WebSocket connection closed: {}".format(reason))
-        success, messages = self.factory.unregister(self)
-        for results in messages:
-            self._broadcastMessage(
-                payload=results["message"],
-                client_list=results["client_list"],
-                isBinary=False,
-            )
+        self.factory.broadcaster.discard(self)
+        client_stats.discard(self)
+        d = self.factory.pipeline.submit("process", UNREGISTER_KEY, \
+            self.factory.unregister, self)
+        d.addCallback(self._broadcastUnregisterMessages)
+        d.addErrback(self._logFailure, "Error unregistering client: ")
+
+    def onMessageBegin(self, isBinary):
+        """
+        Starts decoding a JSON message as its data arrives, and timing it.
+        """
+        WebSocketServerProtocol.onMessageBegin(self, isBinary)
+        self._messageStarted = time.time()
+        self._messageSize = 0
+        if not isBinary:
+            self._streamDecoder = UpdateStreamDecoder(state.get_update_layout, \
+                state.accepts_round)
+            self._streamChunks = []
+            self._streamChunksLength = 0
+
+    def onMessageFrameData(self, payload):
+        """
+        Feeds the data of a JSON message to its decoder in the factory's
+        message pipeline, `STREAM_CHUNK_SIZE` bytes at a time, instead of
+        buffering the whole message.
+        """
+        self._messageSize += len(payload)
+        if self._streamDecoder is None:
+            WebSocketServerProtocol.onMessageFrameData(self, payload)
+            return
+
+        self._streamChunks.append(payload)
+        self._streamChunksLength += len(payload)
+        if self._streamChunksLength >= STREAM_CHUNK_SIZE:
+            self._feedStreamDecoder()
+
+    def onMessageEnd(self):
+        """
+        Finishes decoding a JSON message and processes it (see `onMessage()`).
+
+        The time it took to arrive counts towards the upload throughput of
+        the node (see `client_stats.py`).
+        """
+        client_stats.record_message(self, self._messageStarted, time.time(), \
+            self._messageSize)
+        if self._streamDecoder is None:
+            WebSocketServerProtocol.onMessageEnd(self)
+            return
+
+        decoder = self._streamDecoder
+        self._feedStreamDecoder()
+        self._streamDecoder = None
+        self.message_data = None
+        if self.failedByMe:
+            return
+
+        print("Got payload!")
+        d = self.factory.pipeline.submit("decode", self, \
+            validate_streamed_message, decoder)
+        d.addCallbacks(self._processMessage, self._sendDeserializationError)
+
+    def _feedStreamDecoder(self):
+        """
+        Queues the data received so far to be fed to the message's decoder.
+        """
+        if not self._streamChunks:
+            return
+
+        decoder = self._streamDecoder
+        data = b"".join(self._streamChunks)
+        self._streamChunks = []
+        self._streamChunksLength = 0
+        d = self.factory.pipeline.submit("decode", self, decoder.feed, data)
+        d.addErrback(self._failStreamDecoder, decoder)
+
+    def _failStreamDecoder(self, failure, decoder):
+        """
+        Makes the decoder fail (and the message be rejected when it ends) if
+        some of its data couldn't be fed.
+        """
+        decoder.error = failure.value
 
     def onMessage(self, payload, isBinary):
         """
@@ -60,57 +155,284 @@ class CloudNodeProtocol(WebSocketServerProtocol):
         Messages are ignored unless the message is of type "REGISTER" or the
         node has already been registered (by sending a "REGISTER" type message).
 
+        The payload is decoded and then processed in the factory's message
+        pipeline (in order for each client and for each repo respectively), so
+        that the reactor thread only has to send the results.
         """
         print("Got payload!")
-        if isBinary:
-            print("Binary message not supported.")
-            return
+        d = self.factory.pipeline.submit("decode", self, \
+            validate_new_message, payload, isBinary)
+        d.addCallbacks(self._processMessage, self._sendDeserializationError)
 
-        try:
-            received_message = validate_new_message(payload)
-        except Exception as e:
-            if isinstance(e, json.decoder.JSONDecodeError):
-                error_message = "Error while converting JSON."
-            else:
-                error_message = "Error deserializing message: {}"
-                error_message = error_message.format(e)
-            message = {
-                "error": True,
-                "error_message": error_message,
-                "type": ErrorType.DESERIALIZATION.value
-            }
-            self.sendMessage(json.dumps(message).encode(), isBinary)
-            print(error_message)
+    def _processMessage(self, received_message):
+        """
+        Queues the decoded message to be processed after every message
+        previously received for the same repo.
+
+        The messages of chunked uploads are processed in their own stage
+        (in order for each client), without the state of the repo.
+        """
+        if received_message.type in UPLOAD_MESSAGE_TYPES:
+            d = self.factory.pipeline.submit("upload", self, \
+                process_upload_message, received_message, self.factory, self)
+            d.addCallback(self._processUploadResults)
+            d.addErrback(self._logFailure, "Error processing upload: ")
             return
 
-        # Process message
+        if received_message.type == MessageType.NEW_UPDATE.value:
+            client_stats.record_update(self, received_message.timings)
+
+        d = self.factory.pipeline.submit("process", received_message.repo_id, \
+            self._processWithState, received_message)
+        d.addCallback(self._scheduleFlush, received_message.repo_id)
+        d.addCallback(self._sendResults)
+        d.addErrback(self._logFailure, "Error sending results: ")
+
+    def _processUploadResults(self, upload_results):
+        """
+        Processes the update once its upload is committed, or sends the
+        results of processing a chunked upload message.
+        """
+        update_message, results = upload_results
+        if update_message is not None:
+            self._processMessage(update_message)
+        else:
+            self._sendResults(results)
+
+    def _processWithState(self, received_message):
+        """
+        Processes the message while holding the state of its repo.
+
+        NOTE: Runs in a worker thread of the message pipeline.
+        """
+        repo_state = state.start_state(received_message.repo_id)
         try:
-            state.start_state(received_message.repo_id)
-            results = process_new_message(received_message, self.factory, self)
-            state.stop_state()
+            results = process_new_message(repo_state, received_message, \
+                self.factory, self)
+            self._addFlushDeadline(results, repo_state)
         except Exception as e:
-            state.stop_state()
             error_message = "Error processing new message: " + str(e)
             print(error_message)
-            raise e
             results = make_error_results(error_message, ErrorType.OTHER)
-        
+        finally:
+            state.stop_state(repo_state)
+        return results
+
+    def _addFlushDeadline(self, results, repo_state):
+        """
+        Adds when the staged updates of the repo have to be flushed (see
+        `batch_timeout_ms` in the aggregation config) to the results, if any
+        are staged.
+        """
+        accumulator = repo_state["accumulator"]
+        if accumulator is not None and accumulator.flush_deadline is not None:
+            results["flush_deadline"] = accumulator.flush_deadline
+
+    def _scheduleFlush(self, results, repo_id):
+        """
+        Schedules the staged updates of a repo to be flushed once the oldest
+        one times out, unless a flush is already scheduled.
+        """
+        flush_deadline = results.pop("flush_deadline", None)
+        timer = self.factory.flush_timers.get(repo_id)
+        if flush_deadline is not None and (timer is None or not timer.active()):
+            self.factory.flush_timers[repo_id] = reactor.callLater( \
+                max(flush_deadline - time.time(), 0), \
+                self._flushStagedUpdates, repo_id)
+        return results
+
+    def _flushStagedUpdates(self, repo_id):
+        """
+        Queues the staged updates of a repo to be flushed, after every message
+        previously received for the same repo, so the reactor never does the
+        reduction itself.
+        """
+        d = self.factory.pipeline.submit("process", repo_id, \
+            self._flushWithState, repo_id)
+        d.addCallback(self._scheduleFlush, repo_id)
+        d.addErrback(self._logFailure, "Error flushing staged updates: ")
+
+    def _flushWithState(self, repo_id):
+        """
+        Flushes the staged updates of a repo that timed out while holding its
+        state. The results only say when to flush again, if updates that
+        didn't time out yet are still staged.
+
+        NOTE: Runs in a worker thread of the message pipeline.
+        """
+        results = {}
+        repo_state = state.start_state(repo_id)
+        try:
+            accumulator = repo_state["accumulator"]
+            if accumulator is not None:
+                accumulator.flush_if_due()
+            self._addFlushDeadline(results, repo_state)
+        finally:
+            state.stop_state(repo_state)
+        return results
+
+    def _sendDeserializationError(self, failure):
+        """
+        Lets the node know that its message couldn't be deserialized (or that
+        it was a late update, dropped before being decoded).
+        """
+        e = failure.value
+        error_type = ErrorType.DESERIALIZATION
+        if isinstance(e, LateUpdateError):
+            error_message = str(e)
+            error_type = ErrorType.NEW_UPDATE
+        elif isinstance(e, json.decoder.JSONDecodeError):
+            error_message = "Error while converting JSON."
+        else:
+            error_message = "Error deserializing message: {}"
+            error_message = error_message.format(e)
+        message = {
+            "error": True,
+            "error_message": error_message,
+            "type": error_type.value
+        }
+        self.sendMessage(json.dumps(message).encode())
+        print(error_message)
+
+    def _sendResults(self, results):
+        """
+        Sends the results of processing a message to the right clients.
+        """
+        started = time.time()
         print(results)
 
-        if results["action"] == ActionType.BROADCAST:
+        if results["action"] == ActionType.BROADCAST and "waves" in results:
+            self.factory.broadcaster.dispatch(
+                payload=results["message"],
+                waves=results["waves"],
+                key=results["message"]["repo_id"],
+            )
+        elif results["action"] == ActionType.BROADCAST:
+            # NOTE: If the session stopped, its round was already cancelled
+            # when the state of the repo was reset (see
+            # `CloudNodeFactory.cancel_round()`).
             self._broadcastMessage(
                 payload=results["message"],
                 client_list=results["client_list"],
-                isBinary=isBinary,
             )
         elif results["action"] == ActionType.UNICAST:
-            message = json.dumps(results["message"]).encode()
-            self.sendMessage(message, isBinary)
+            self._broadcastMessage(
+                payload=results["message"],
+                client_list=[self],
+            )
+
+        if "round_deadlines" in results:
+            self._armRoundDeadlines(results["message"], \
+                results["round_deadlines"])
+        if "session_deadlines" in results:
+            self._armSessionDeadlines(results["message"], \
+                results["session_deadlines"])
+
+        self.factory.pipeline.record("send", started)
+
+    def _armRoundDeadlines(self, message, deadlines):
+        """
+        Schedules the deadlines of the round that was just started (see
+        `ROUND_DEADLINE` in the continuation criteria), replacing the ones of
+        the previous round of the repo.
+        """
+        repo_id = message["repo_id"]
+        self.factory.cancel_round_deadlines(repo_id)
+        self.factory.round_timers[repo_id] = [reactor.callLater( \
+                max(deadline - time.time(), 0), self._expireRoundDeadline, \
+                repo_id, message["session_id"], message["round"]) \
+            for deadline in deadlines]
+
+    def _expireRoundDeadline(self, repo_id, session_id, round):
+        """
+        Queues the round to be closed with whatever has been aggregated, after
+        every message previously received for the same repo.
+        """
+        d = self.factory.pipeline.submit("process", repo_id, \
+            self._closeRoundWithState, repo_id, session_id, round)
+        d.addCallback(self._sendResults)
+        d.addErrback(self._logFailure, "Error closing round: ")
 
-    def _broadcastMessage(self, payload, client_list, isBinary):
+    def _closeRoundWithState(self, repo_id, session_id, round):
+        """
+        Closes the round whose deadline expired while holding the state of
+        its repo.
+
+        NOTE: Runs in a worker thread of the message pipeline.
+        """
+        repo_state = state.start_state(repo_id)
+        try:
+            results = handle_round_deadline(repo_state, session_id, round, \
+                self.factory.get_clients(repo_id))
+        except Exception as e:
+            print("Error closing round: " + str(e))
+            results = {"action": ActionType.DO_NOTHING, "error": False}
+        finally:
+            state.stop_state(repo_state)
+        return results
+
+    def _armSessionDeadlines(self, message, deadlines):
+        """
+        Schedules the wall-clock budgets of the session that was just started
+        (see `WALL_CLOCK` in the termination criteria).
+        """
+        repo_id = message["repo_id"]
+        self.factory.session_timers[repo_id] = [reactor.callLater( \
+                max(deadline - time.time(), 0), self._expireSessionDeadline, \
+                repo_id, message["session_id"]) \
+            for deadline in deadlines]
+
+    def _expireSessionDeadline(self, repo_id, session_id):
+        """
+        Queues the session to be stopped, after every message previously
+        received for the same repo.
+        """
+        d = self.factory.pipeline.submit("process", repo_id, \
+            self._stopSessionWithState, repo_id, session_id)
+        d.addCallback(self._sendResults)
+        d.addErrback(self._logFailure, "Error stopping session: ")
+
+    def _stopSessionWithState(self, repo_id, session_id):
+        """
+        Stops the session whose wall-clock budget expired while holding the
+        state of its repo.
+
+        NOTE: Runs in a worker thread of the message pipeline.
+        """
+        repo_state = state.start_state(repo_id)
+        try:
+            results = handle_session_deadline(repo_state, session_id, \
+                self.factory.get_clients(repo_id))
+        except Exception as e:
+            print("Error stopping session: " + str(e))
+            results = {"action": ActionType.DO_NOTHING, "error": False}
+        finally:
+            state.stop_state(repo_state)
+        return results
+
+    def _broadcastUnregisterMessages(self, unregister_results):
+        """
+        Broadcasts the messages resulting from unregistering this node.
+        """
+        success, messages = unregister_results
+        for results in messages:
+            self._broadcastMessage(
+                payload=results["message"],
+                client_list=results["client_list"],
+            )
+
+    def _logFailure(self, failure, error_message):
+        """
+        Logs a failure that happened in the message pipeline.
+        """
+        print(error_message + str(failure.value))
+
+    def _broadcastMessage(self, payload, client_list):
         """
         Broadcast message (`payload`) to a `client_list`.
+
+        The message is only encoded and framed once per format (JSON or binary
+        tensor frame), no matter how many clients it's sent to, and slow
+        clients get backpressure (see `broadcast.py`).
         """
-        for c in client_list:
-            results_json = json.dumps(payload)
-            c.sendMessage(results_json.encode(), isBinary)
\ No newline at end of file
+        self.factory.broadcaster.broadcast(payload, client_list)
@@ -5,22 +5,25 @@ import io
 import os
 
 import boto3
-import tensorflow as tf
 from flask_cors import CORS, cross_origin
 from twisted.python import log
 import werkzeug.formparser
 from twisted.web.server import Site
 from twisted.web.wsgi import WSGIResource
-from twisted.internet import task, reactor
-from flask import Flask, jsonify, send_from_directory, send_file
+from twisted.internet import task, reactor, threads
+from flask import Flask, Response, request, jsonify
 from autobahn.twisted.resource import WebSocketResource, WSGIRootResource
 
 from protocol import CloudNodeProtocol
+from artifact_resource import ArtifactResource
 from factory import CloudNodeFactory
-from message import LibraryType
 import state
+import converter_pool
+import client_stats
 
 
+DELTA_MAX_AGE = 24 * 60 * 60
+
 app = Flask(__name__)
 app.secret_key = str(uuid.uuid4())
 CORS(app)
@@ -33,120 +36,76 @@ def get_status(repo_id):
     The dashboard-api is the only hitting this endpoint, so it should be
     secured.
     """
-    state.start_state(repo_id)
-    try:
-        status = jsonify({"Busy": state.state["busy"]})
-    except Exception as e:
-        print("Exception getting status: " + str(e))
-        state.stop_state()
-        return
-    state.stop_state()
-    return status
+    snapshot = state.get_snapshot(repo_id)
+    return jsonify({"Busy": bool(snapshot and snapshot.busy)})
 
-@app.route('/model/<session_id>/<path:filename>', methods=["GET"])
-def serve_tfjs_model(session_id, filename):
+@app.route('/delta/<session_id>/<int:round>', methods=["GET"])
+def serve_delta(session_id, round):
     """
-    Serves the TFJS model to the user.
+    Serves the averaged gradients the libraries apply at the start of the
+    given round, as a binary tensor frame.
 
-    TODO: Should do this through ngnix for a boost in performance. Should also
-    have some auth token -> session id mapping (security fix in the future).
+    The delta of a round never changes, so it's cacheable and identified by
+    its hash (used as the ETag). Conditional (`If-None-Match`) and range
+    requests are supported.
 
     Args:
-        filename (str): The filename to serve.
+        session_id (str): The session ID.
+        round (int): The round the delta is for.
     """
-    if not state.start_state_by_session_id(session_id):
-        return "No active session!\n"
-    try:
-        if not state.state["busy"]:
-            return "No active session!\n"
-        if state.state["library_type"] != LibraryType.JS.value:
-            return "Current session is not for JAVASCRIPT!"
-        folder_path = os.path.join(app.root_path, state.state['tfjs_model_path'])
-    except Exception as e:
-        print("Exception getting TFJS model: " + str(e))
-        state.stop_state()
-        return
-    state.stop_state()
-    return send_from_directory(folder_path, filename)
-
-@app.route('/mlmodel/<session_id>', methods=["GET"])
-def serve_mlmodel(session_id):
+    snapshot = state.get_snapshot_by_session_id(session_id)
+    if not snapshot or not snapshot.busy:
+        return "No active session!\n", 404
+    delta = snapshot.delta
+    if delta is None or delta.round != round:
+        return "No delta for this round!\n", 404
+    response = Response(delta.payload, mimetype="application/octet-stream")
+    response.set_etag(delta.sha256)
+    response.cache_control.public = True
+    response.cache_control.max_age = DELTA_MAX_AGE
+    return response.make_conditional(request, accept_ranges=True, \
+        complete_length=len(delta.payload))
+
+@app.route('/stats', methods=["GET"])
+def get_stats():
     """
-    Serves the mlmodel model to the user.
-
-    TODO: Should do this through ngnix for a boost in performance. Should also
-    have some auth token -> session id mapping (security fix in the future).
+    Returns the queue depth and latency counters of the message pipeline and
+    of the converter pool, the fan-out counters of the broadcaster, the
+    performance history of the clients and how many times the model of every
+    repo was materialized (it should be once per round).
     """
-    if not state.start_state_by_session_id(session_id):
-        return "No active session!\n"
-    try:
-        if not state.state["busy"]:
-            return "No active session!\n"
-        if state.state["library_type"] != LibraryType.IOS_IMAGE.value:
-            return "Current session is not for IOS!"
-        app_path = os.path.join(app.root_path, state.state['mlmodel_path'])
-    except Exception as e:
-        print("Exception getting mlmodel: " + str(e))
-        state.stop_state()
-        return
-    state.stop_state()
-    return send_file(app_path)
-
-@app.route('/mlmodel/weights/<session_id>', methods=["GET"])
-def serve_mlmodel_weights(session_id):
+    # NOTE: The counters of the pipeline and the broadcaster are only ever
+    # changed on the reactor thread, so they're copied there.
+    stats = threads.blockingCallFromThread(reactor, _get_reactor_stats)
+    stats.update(converter_pool.stats())
+    stats.update(client_stats.get_stats())
+    stats["materializations"] = {snapshot.repo_id: snapshot.materializations \
+        for snapshot in state.get_snapshots()}
+    return jsonify(stats)
+
+def _get_reactor_stats():
     """
-    Serves the TFJS model to the user.
+    Copy the counters of the message pipeline and of the broadcaster.
 
-    TODO: Should do this through ngnix for a boost in performance. Should also
-    have some auth token -> session id mapping (security fix in the future).
+    NOTE: Must only be called from the reactor thread.
     """
-    if not state.start_state_by_session_id(session_id):
-        return "No active session!\n"
-    try:
-        if not state.state["busy"]:
-            return "No active session!\n"
-        if state.state["library_type"] != LibraryType.IOS_TEXT.value:
-            return "Current session is not for IOS!"
-        app_path = os.path.join(app.root_path, state.state['mlmodel_weights_path'])
-    except Exception as e:
-        print("Exception getting mlmodel weights: " + str(e))
-        state.stop_state()
-        return
-
-    state.stop_state()
-    return send_file(app_path)
-
-@app.route('/keras/<session_id>', methods=['POST', 'GET'])
-def serve_keras_model(session_id):
-    if not state.start_state_by_session_id(session_id):
-        return "No active session!\n"
-    try:
-        if not state.state["busy"]:
-            return "No active session!\n"
-        if state.state["library_type"] != LibraryType.PYTHON.value:
-            return "Current session is not for PYTHON!"
-        app_path = os.path.join(app.root_path, state.state['h5_model_path'])
-    except Exception as e:
-        print("Exception getting Keras model: " + str(e))
-        state.stop_state()
-        return
-    
-    state.stop_state()
-    return send_file(app_path)
+    stats = factory.pipeline.stats()
+    stats.update(factory.broadcaster.stats())
+    return stats
 
 @app.route('/reset_state/<repo_id>', methods=["GET"])
 def reset_state(repo_id):
     """
     Resets the state of the cloud node.
     """
-    state.start_state(repo_id)
+    repo_state = state.start_state(repo_id)
     try:
         state.reset_state(repo_id)
     except Exception as e:
         print("Exception resetting state: " + str(e))
-        state.stop_state()
+        state.stop_state(repo_state)
         return
-    state.stop_state()
+    state.stop_state(repo_state)
     return "State reset successfully!"
 
 @app.route('/get_state/<repo_id>')
@@ -154,19 +113,18 @@ def get_state(repo_id):
     """
     Get the state of the cloud node.
     """
-    state.start_state(repo_id)
+    repo_state = state.start_state(repo_id)
     try:
-        state_dict = repr(state.state)
+        state_dict = repr(repo_state)
     except Exception as e:
         print("Exception getting state: " + str(e))
-        state.stop_state()
+        state.stop_state(repo_state)
         return
     
-    state.stop_state()
+    state.stop_state(repo_state)
     return state_dict
 
 if __name__ == '__main__':
-    tf.compat.v1.disable_eager_execution()
     log.startLogging(sys.stdout)
 
     factory = CloudNodeFactory()
@@ -174,10 +132,19 @@ if __name__ == '__main__':
     wsResource = WebSocketResource(factory)
 
     wsgiResource = WSGIResource(reactor, reactor.getThreadPool(), app)
-    rootResource = WSGIRootResource(wsgiResource, {b'': wsResource})
+    # NOTE: The models are served by Twisted, not by the WSGI app.
+    rootResource = WSGIRootResource(wsgiResource, {
+        b'': wsResource,
+        b'model': ArtifactResource("model"),
+        b'mlmodel': ArtifactResource("mlmodel"),
+        b'keras': ArtifactResource("keras"),
+    })
     site = Site(rootResource)
 
     state.init()
 
+    converter_pool.start()
+    reactor.addSystemEventTrigger("during", "shutdown", converter_pool.stop)
+
     reactor.listenTCP(80, site)
     reactor.run()
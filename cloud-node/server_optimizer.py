@@ -0,0 +1,137 @@
+import numpy as np
+
+
+SERVER_OPTIMIZERS = ("SGD", "ADAM", "YOGI")
+MOMENT_DTYPE = np.float32
+
+DEFAULT_LEARNING_RATES = {
+    "SGD": 1.0,
+    "ADAM": 0.01,
+    "YOGI": 0.01,
+}
+
+def check_server_optimizer(config):
+    """
+    Make sure the server optimizer config is supported.
+
+    Args:
+        config (dict): The server optimizer config.
+    """
+    if config.get("type") not in SERVER_OPTIMIZERS:
+        raise ValueError("Unsupported server optimizer: {}!".format(
+            config.get("type")))
+    if not 0 <= config.get("momentum", 0) < 1:
+        raise ValueError("Server momentum must be in [0, 1)!")
+
+class ServerOptimizer(object):
+    """
+    Applies an optimizer to the aggregated update of every round, treating it
+    as a pseudo-gradient (the direction the model should move in) instead of
+    subtracting it from the model as is. Returns the step that's actually
+    subtracted from the model.
+
+    The optimizers are:
+        - `SGD`: `step = lr * m`, with `m = momentum * m + g`. With the
+          defaults (`lr` 1, no momentum), the step is the update itself.
+        - `ADAM`: `step = lr * m / (sqrt(v) + epsilon)`, with
+          `m = beta_1 * m + (1 - beta_1) * g` and
+          `v = beta_2 * v + (1 - beta_2) * g ** 2`.
+        - `YOGI`: Like `ADAM`, but with
+          `v = v - (1 - beta_2) * g ** 2 * sign(v - g ** 2)`, so `v` grows
+          more slowly when the updates get bigger.
+
+    As in the adaptive federated optimizers (FedAdam, FedYogi), there's no
+    bias correction and `epsilon` defaults to 1e-3.
+
+    The moment buffers are kept (in `float32`) for the whole session,
+    allocated the first time a step is taken and updated in place.
+
+    Args:
+        config (dict): The server optimizer config: its `type`, and
+            optionally its `learning_rate`, `momentum` (`SGD`), `beta_1`,
+            `beta_2` and `epsilon` (`ADAM` and `YOGI`).
+    """
+
+    def __init__(self, config):
+        check_server_optimizer(config)
+        self.type = config["type"]
+        self.learning_rate = float(config.get("learning_rate", \
+            DEFAULT_LEARNING_RATES[self.type]))
+        self.momentum = float(config.get("momentum", 0))
+        self.beta_1 = float(config.get("beta_1", 0.9))
+        self.beta_2 = float(config.get("beta_2", 0.99))
+        self.epsilon = float(config.get("epsilon", 1e-3))
+        self.num_steps = 0
+        self._shapes = None
+        self._m = None
+        self._v = None
+        self._scratch = None
+
+    def step(self, pseudo_gradient):
+        """
+        Take a step with the aggregated update of a round.
+
+        Args:
+            pseudo_gradient (list or np.ndarray): The aggregated update,
+                either a list of arrays (one per layer) or a single flat
+                array.
+
+        Returns:
+            list or np.ndarray: The step to subtract from the model, in the
+                same layout.
+        """
+        flat = isinstance(pseudo_gradient, np.ndarray)
+        layers = [pseudo_gradient] if flat else pseudo_gradient
+        shapes = [np.shape(layer) for layer in layers]
+        if self._shapes is None:
+            self._allocate(shapes)
+        elif shapes != self._shapes:
+            raise ValueError("Update doesn't match the server optimizer's layout!")
+
+        steps = []
+        for index, layer in enumerate(layers):
+            g = np.asarray(layer, dtype=MOMENT_DTYPE)
+            if self.type == "SGD":
+                if self.momentum:
+                    m = self._m[index]
+                    m *= self.momentum
+                    m += g
+                    g = m
+                steps.append(np.multiply(g, self.learning_rate, \
+                    dtype=MOMENT_DTYPE))
+                continue
+
+            m, v = self._m[index], self._v[index]
+            scratch = self._scratch[index]
+            m *= self.beta_1
+            m += (1 - self.beta_1) * g
+            np.square(g, out=scratch)
+            if self.type == "ADAM":
+                v *= self.beta_2
+                v += (1 - self.beta_2) * scratch
+            else:
+                sign = np.sign(v - scratch)
+                scratch *= sign
+                v -= (1 - self.beta_2) * scratch
+            np.sqrt(v, out=scratch)
+            scratch += self.epsilon
+            step = np.divide(m, scratch)
+            step *= self.learning_rate
+            steps.append(step)
+
+        self.num_steps += 1
+        return steps[0] if flat else steps
+
+    def _allocate(self, shapes):
+        """
+        Allocate the moment buffers the optimizer needs, initialized as in the
+        adaptive federated optimizers (`v` starts at `epsilon ** 2`).
+        """
+        self._shapes = shapes
+        if self.type != "SGD" or self.momentum:
+            self._m = [np.zeros(shape, dtype=MOMENT_DTYPE) for shape in shapes]
+        if self.type != "SGD":
+            self._v = [np.full(shape, self.epsilon ** 2, dtype=MOMENT_DTYPE) \
+                for shape in shapes]
+            self._scratch = [np.empty(shape, dtype=MOMENT_DTYPE) \
+                for shape in shapes]
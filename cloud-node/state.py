@@ -1,28 +1,29 @@
 from model import TEMP_FOLDER
+from update_encoding import DEFAULT_UPDATE_ENCODING
 import os
 import shutil
+import threading
+from collections import namedtuple, deque
 
+import numpy as np
 
-def init():
-    """Global state for the service."""
-    import threading
-    state_lock = threading.Lock()
-    states = {}
 
-    global state
-    state = None
+class RepoState(dict):
+    """
+    The state of a single repo, along with the lock that guards it.
 
-    global num_sessions
-    num_sessions = 0
+    Every repo has its own lock, so the messages and requests of different
+    repos can be processed concurrently. The lock is reentrant and is shared
+    by all the `RepoState`s of a repo (a new one is made every time the state
+    of the repo is reset).
 
-    global reset_state
-    def reset_state(repo_id):
-        global state
-        if state and state["busy"]:
-            global num_sessions
-            num_sessions -= 1
+    Args:
+        repo_id (str): The repo ID.
+        lock (threading.RLock): The lock of the repo.
+    """
 
-        states[repo_id] = {
+    def __init__(self, repo_id, lock):
+        dict.__init__(self, {
             "busy": False,
             "session_id": None,
             "dataset_id": None,
@@ -30,41 +31,341 @@ def init():
             "current_round": 0,
             "num_nodes_averaged": 0,
             "num_nodes_chosen": 0,
+            "asynchronous": False,
+            "max_staleness": 0,
+            "num_nodes_target": None,
+            "chosen_clients": [],
             "current_weights": None,
             "current_gradients": None,
+            "encoded_gradients": None,
+            "delta": None,
+            "update_encoding": DEFAULT_UPDATE_ENCODING,
             "sigma_omega": None,
+            "accumulator": None,
+            "server_optimizer": None,
+            "update_layout": None,
+            "num_materializations": {},
+            "materialization_stats": {
+                "rounds": 0,
+                "materializations": 0,
+                "max_per_round": 0,
+            },
             "weights_shape": None,
             "initial_message": None,
             "last_message_time": None,
+            "round_start_time": None,
+            "session_start_time": None,
+            "round_metrics": {},
+            "metric_history": None,
             "last_message_sent_to_library": None,
             "test": False,
             "h5_model_path": None,
+            "weight_store": None,
+            "committed_weights": None,
+            "tfjs_writer": None,
+            "mlmodel_spec_path": None,
             "library_type": None,
             "ios_type": None
-        }
-        
-        temp_folder = os.path.join(TEMP_FOLDER, repo_id)
-        if os.path.isdir(temp_folder):
-            shutil.rmtree(temp_folder)
+        })
+        self.lock = lock
+
+    def __repr__(self):
+        """
+        Summarize the state for debugging (see `/get_state`). Tensors, buffers
+        and collections are summarized by their size, since the weights,
+        the delta and the chosen clients can be huge.
+        """
+        return _summarize(dict(self))
+
+class ServingSnapshot(namedtuple("ServingSnapshot", ["repo_id", "session_id", \
+        "busy", "library_type", "current_round", "h5_model_path", \
+        "tfjs_model_path", "mlmodel_path", "mlmodel_weights_path", \
+        "update_layout", "delta", "max_staleness", "materializations"])):
+    """
+    What the HTTP endpoints need to know about a repo to serve its models
+    (and what the stream decoder needs to know about the updates it expects),
+    along with how many times its model was materialized.
+
+    Snapshots are immutable. A new one is published every time a repo's lock
+    is released, so the endpoints can read them without taking any lock.
+    """
+    __slots__ = ()
+
+class ModelDelta(namedtuple("ModelDelta", ["round", "sha256", "payload"])):
+    """
+    The averaged gradients the libraries apply at the start of a round,
+    encoded as a binary tensor frame (see `tensor_frames.py`) and served over
+    HTTP instead of being inlined in the `TRAIN` message.
+    """
+    __slots__ = ()
+
+class RoundMetrics(namedtuple("RoundMetrics", ["round", "num_updates", \
+        "loss", "accuracy", "update_norm", "elapsed"])):
+    """
+    A row of the metric history of a session: the training loss and
+    accuracy reported for a round (averaged with the omegas of the updates,
+    `None` if none were reported), the norm of the aggregated update and the
+    time since the session started.
+    """
+    __slots__ = ()
+
+def _make_snapshot(repo_state):
+    """
+    Make the serving snapshot of the given state.
+    """
+    return ServingSnapshot(
+        repo_id=repo_state["repo_id"],
+        session_id=repo_state["session_id"],
+        busy=repo_state["busy"],
+        library_type=repo_state["library_type"],
+        current_round=repo_state["current_round"],
+        h5_model_path=repo_state.get("h5_model_path"),
+        tfjs_model_path=repo_state.get("tfjs_model_path"),
+        mlmodel_path=repo_state.get("mlmodel_path"),
+        mlmodel_weights_path=repo_state.get("mlmodel_weights_path"),
+        update_layout=repo_state.get("update_layout"),
+        delta=repo_state.get("delta"),
+        max_staleness=repo_state["max_staleness"],
+        materializations=dict(repo_state["materialization_stats"]),
+    )
+
+def _summarize(value):
+    """
+    Get a short representation of a value of the state: scalars, short
+    objects and dictionaries as they are, anything big by its size.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return "<{} bytes>".format(len(value))
+    elif isinstance(value, np.ndarray):
+        return "<{} array of shape {}>".format(value.dtype, value.shape)
+    elif isinstance(value, tuple) and hasattr(value, "_fields"):
+        return "{}({})".format(type(value).__name__, ", ".join( \
+            "{}={}".format(field, _summarize(item)) \
+            for field, item in zip(value._fields, value)))
+    elif isinstance(value, dict):
+        return "{" + ", ".join("{!r}: {}".format(key, _summarize(item)) \
+            for key, item in value.items()) + "}"
+    elif isinstance(value, (list, tuple, set, deque)):
+        return "<{} of {} items>".format(type(value).__name__, len(value))
+    return repr(value)
+
+def get_staleness(current_round, round, max_staleness=0):
+    """
+    Get how many rounds (versions of the model) behind the current round an
+    update for the given round is.
+
+    Args:
+        current_round (int): The current round.
+        round (int): The round the update was trained in.
+        max_staleness (int, optional): The maximum staleness accepted, `None`
+            for no limit. Synchronous sessions only accept 0.
+
+    Returns:
+        int: The staleness, or `None` if the update isn't accepted.
+    """
+    if not isinstance(round, int) or round > current_round:
+        return None
+    staleness = current_round - round
+    if max_staleness is not None and staleness > max_staleness:
+        return None
+    return staleness
+
+_reset_hooks = []
+
+def add_reset_hook(hook):
+    """
+    Register a function to be called with the repo ID every time the state
+    of a repo is reset (with the repo's lock held, in whatever thread reset
+    it).
+
+    Args:
+        hook (callable): The function to call.
+    """
+    _reset_hooks.append(hook)
+
+def init():
+    """Global state for the service."""
+    # NOTE: `states_lock` only guards the dictionaries below, it's never held
+    # while a repo is being worked on.
+    states_lock = threading.Lock()
+    states = {}
+    repo_locks = {}
+
+    # NOTE: Both are only ever replaced entry by entry (atomically), so they
+    # can be read without holding any lock.
+    snapshots = {}
+    session_index = {}
+
+    global num_sessions
+    num_sessions = 0
+
+    global sessions_lock
+    sessions_lock = threading.Lock()
+
+    def get_lock(repo_id):
+        with states_lock:
+            if repo_id not in repo_locks:
+                repo_locks[repo_id] = threading.RLock()
+            return repo_locks[repo_id]
+
+    global reset_state
+    def reset_state(repo_id):
+        """
+        Reset the state of the repo. Should be called with the repo's lock
+        held.
+
+        Returns:
+            RepoState: The new state of the repo.
+        """
+        lock = get_lock(repo_id)
+        with lock:
+            with states_lock:
+                old_state = states.get(repo_id)
+                new_state = RepoState(repo_id, lock)
+                states[repo_id] = new_state
+
+            if old_state and old_state["busy"]:
+                global num_sessions
+                with sessions_lock:
+                    num_sessions -= 1
+
+            temp_folder = os.path.join(TEMP_FOLDER, repo_id)
+            if os.path.isdir(temp_folder):
+                shutil.rmtree(temp_folder)
+
+            for hook in _reset_hooks:
+                hook(repo_id)
+        return new_state
 
     global start_state
     def start_state(repo_id):
-        state_lock.acquire()
-        if repo_id not in states:
-            reset_state(repo_id)
-        global state
-        state = states[repo_id]
+        """
+        Acquire the lock of the repo and get its state.
+
+        Returns:
+            RepoState: The state of the repo.
+        """
+        lock = get_lock(repo_id)
+        lock.acquire()
+        with states_lock:
+            repo_state = states.get(repo_id)
+        if repo_state is None:
+            repo_state = reset_state(repo_id)
+        return repo_state
 
     global stop_state
-    def stop_state():
-        global state
-        state = None
-        state_lock.release()
+    def stop_state(repo_state):
+        """
+        Publish the serving snapshot of the repo the given state belongs to
+        and release its lock.
+        """
+        publish_snapshot(repo_state["repo_id"])
+        repo_state.lock.release()
+
+    global publish_snapshot
+    def publish_snapshot(repo_id):
+        """
+        Publish the serving snapshot of the current state of the repo and
+        update the session -> repo index. Should be called with the repo's
+        lock held.
+        """
+        with states_lock:
+            repo_state = states.get(repo_id)
+            if repo_state is None:
+                return
+            old_snapshot = snapshots.get(repo_id)
+            snapshot = _make_snapshot(repo_state)
+
+            if old_snapshot and old_snapshot.session_id != snapshot.session_id \
+                    and session_index.get(old_snapshot.session_id) == repo_id:
+                del session_index[old_snapshot.session_id]
+            if snapshot.session_id:
+                session_index[snapshot.session_id] = repo_id
+            snapshots[repo_id] = snapshot
+
+    global get_snapshot
+    def get_snapshot(repo_id):
+        """
+        Get the last published serving snapshot of the repo, without taking
+        any lock.
+
+        Returns:
+            ServingSnapshot: The snapshot, or `None` if there's none yet.
+        """
+        return snapshots.get(repo_id)
+
+    global get_snapshots
+    def get_snapshots():
+        """
+        Get the last published serving snapshot of every repo, without taking
+        any lock.
+
+        Returns:
+            list: The snapshots.
+        """
+        return list(snapshots.values())
+
+    global get_snapshot_by_session_id
+    def get_snapshot_by_session_id(session_id):
+        """
+        Get the last published serving snapshot of the repo with the given
+        session, without taking any lock.
+
+        Returns:
+            ServingSnapshot: The snapshot, or `None` if there's no repo with
+                the given session.
+        """
+        repo_id = session_index.get(session_id)
+        snapshot = snapshots.get(repo_id)
+        if snapshot is None or snapshot.session_id != session_id:
+            return None
+        return snapshot
+
+    global get_update_layout
+    def get_update_layout(session_id):
+        """
+        Get the shapes of the updates of the given session, as folded in so
+        far, without taking any lock.
+
+        Returns:
+            tuple: The shapes, or `None` if they aren't known yet.
+        """
+        snapshot = get_snapshot_by_session_id(session_id)
+        return snapshot.update_layout if snapshot else None
+
+    global accepts_round
+    def accepts_round(session_id, round):
+        """
+        Check whether an active session accepts updates for the given round
+        (its current round, or a stale one in asynchronous sessions), without
+        taking any lock (e.g. to reject late updates before decoding them).
+
+        Returns:
+            bool: Returns `True` if updates for the round are accepted.
+        """
+        snapshot = get_snapshot_by_session_id(session_id)
+        return snapshot is not None and snapshot.busy \
+            and get_staleness(snapshot.current_round, round, \
+                snapshot.max_staleness) is not None
 
     global start_state_by_session_id
     def start_state_by_session_id(session_id):
-        for repo_id, state in states.items():
-            if state["session_id"] == session_id:
-                start_state(repo_id)
-                return repo_id
+        """
+        Acquire the lock of the repo with the given session and get its state.
+
+        Returns:
+            RepoState: The state of the repo, or `None` if there's no repo with
+                the given session.
+        """
+        repo_id = session_index.get(session_id)
+        if repo_id is None:
+            return None
+
+        repo_state = start_state(repo_id)
+        # NOTE: The session might have changed while we were waiting.
+        if repo_state["session_id"] == session_id:
+            return repo_state
+        stop_state(repo_state)
         return None
@@ -0,0 +1,422 @@
+import json
+
+import numpy as np
+
+from message import MessageType, LateUpdateError
+
+
+TENSOR_DTYPE = np.float32
+TENSOR_KEYS = {b"gradients": 1, b"weights": 0}
+NUMBER_SEPARATORS = bytes.maketrans(b",[]", b"   ")
+WHITESPACE = [b" ", b"\t", b"\r", b"\n"]
+STRING_FIELDS = (b"type", b"session_id")
+
+OPEN_BRACKET, CLOSE_BRACKET = ord("["), ord("]")
+
+class UpdateStreamDecoder(object):
+    """
+    Incrementally decodes a JSON message as its chunks arrive, so the whole
+    payload never has to be held in memory.
+
+    The numbers of the `results.gradients` (a list of nested arrays) and
+    `results.weights` (a single nested array) arrays are decoded straight
+    into float32 buffers and their text is discarded right away. Everything
+    else in the message (which is small) is kept as text and parsed with
+    `json` once the message is complete.
+
+    If the layout of the update is known (the shapes the session's previous
+    updates had), the buffers are preallocated with it. Otherwise they grow
+    as the numbers are decoded, and the shapes are inferred from the
+    brackets.
+
+    Updates for a round the session doesn't accept anymore are rejected as
+    soon as their type, session ID and round are known, so the rest of their
+    arrays is never decoded.
+
+    Chunks must be fed in order and from one thread at a time.
+
+    Args:
+        get_layout (callable, optional): Called with the session ID of the
+            message (if it comes before the arrays), returns the list of
+            expected shapes or `None` if it's not known.
+        accepts_round (callable, optional): Called with the session ID and
+            round of an update, returns whether the session accepts updates
+            for that round (see `state.accepts_round()`).
+    """
+
+    def __init__(self, get_layout=None, accepts_round=None):
+        self.get_layout = get_layout
+        self.accepts_round = accepts_round
+        self.error = None
+        self._skeleton = []
+        self._stack = []
+        self._expecting_key = False
+        self._in_string = False
+        self._escaped = False
+        self._string = None
+        self._key = None
+        self._fields = {}
+        self._round = None
+        self._region = None
+        self._regions = {}
+
+    def feed(self, data):
+        """
+        Decode the next chunk of the message.
+
+        Errors are recorded instead of raised, the chunks fed afterwards are
+        ignored and the error is raised by `close()`.
+
+        Args:
+            data (bytes): The next chunk.
+        """
+        if self.error is not None:
+            return
+        try:
+            pos = 0
+            while pos < len(data):
+                if self._region is not None:
+                    pos = self._region.feed(data, pos)
+                    if self._region.done:
+                        self._region = None
+                else:
+                    pos = self._scan(data, pos)
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        """
+        Finish decoding the message.
+
+        Returns:
+            dict: The decoded message, with the arrays as numpy arrays.
+        """
+        if self.error is not None:
+            raise self.error
+        if self._region is not None or self._in_string:
+            raise ValueError("Message ended in the middle of a value!")
+
+        message = json.loads(b"".join(self._skeleton).decode())
+        self._skeleton = None
+        for key, region in self._regions.items():
+            message["results"][key] = region.tensors()
+        return message
+
+    def _scan(self, data, pos):
+        """
+        Scan the JSON outside of the arrays, keeping track of where in the
+        message we are, until an array starts or the chunk ends.
+
+        Returns:
+            int: The position in the chunk where the scan stopped.
+        """
+        start = pos
+        end = len(data)
+        while pos < end:
+            if self._in_string:
+                pos = self._scan_string(data, pos)
+                continue
+
+            char = data[pos:pos+1]
+            if char == b'"':
+                self._in_string = True
+                self._string = [] if self._wants_string() else None
+            elif char in b"{[":
+                if char == b"[" and self._is_tensor_key():
+                    self._skeleton.append(data[start:pos] + b"null")
+                    self._start_region()
+                    return pos
+                self._stack.append([char, self._key])
+                self._key = None
+                self._expecting_key = char == b"{"
+            elif char in b"}]":
+                if not self._stack:
+                    raise ValueError("Unbalanced brackets in message!")
+                if self._ends_round():
+                    self._end_round(data[start:pos])
+                self._key = self._stack.pop()[1]
+                self._expecting_key = False
+            elif char == b",":
+                if self._ends_round():
+                    self._end_round(data[start:pos])
+                self._expecting_key = self._in_object()
+                if self._expecting_key:
+                    self._key = None
+            pos += 1
+
+        self._skeleton.append(data[start:pos])
+        return pos
+
+    def _scan_string(self, data, pos):
+        """
+        Scan a string until its closing quote or the end of the chunk.
+        """
+        end = pos
+        while end < len(data):
+            if self._escaped:
+                self._escaped = False
+                end += 1
+                continue
+            quote = data.find(b'"', end)
+            backslash = data.find(b"\\", end)
+            if quote == -1 and backslash == -1:
+                end = len(data)
+                break
+            if backslash != -1 and (quote == -1 or backslash < quote):
+                self._escaped = True
+                end = backslash + 1
+                continue
+            if self._string is not None:
+                self._string.append(data[pos:quote])
+            self._end_string()
+            return quote + 1
+
+        if self._string is not None:
+            self._string.append(data[pos:end])
+        return end
+
+    def _end_string(self):
+        """
+        Record the string that was just scanned, if it's a key, the type or
+        the session ID.
+        """
+        self._in_string = False
+        if self._string is None:
+            return
+        raw = b"".join(self._string)
+        self._string = None
+        if self._expecting_key:
+            self._key = raw
+            self._expecting_key = False
+        elif len(self._stack) == 1 and self._key in STRING_FIELDS:
+            self._fields[self._key] = json.loads(b'"' + raw + b'"')
+            self._check_round()
+
+    def _wants_string(self):
+        """
+        Whether the string that starts is a key, the type or the session ID.
+        """
+        return self._expecting_key or (len(self._stack) == 1 \
+            and self._key in STRING_FIELDS)
+
+    def _ends_round(self):
+        """
+        Whether the top-level `round` value ends at the current character.
+        """
+        return len(self._stack) == 1 and self._key == b"round" \
+            and self._round is None
+
+    def _end_round(self, scanned):
+        """
+        Record the round, whose text is at the end of the skeleton.
+        """
+        text = b"".join(self._skeleton) + scanned
+        self._round = json.loads(text[text.rindex(b":")+1:].decode())
+        self._check_round()
+
+    def _check_round(self):
+        """
+        Reject the message if it's an update for a round that isn't accepted.
+        """
+        session_id = self._fields.get(b"session_id")
+        if self.accepts_round is None or session_id is None \
+                or self._round is None \
+                or self._fields.get(b"type") != MessageType.NEW_UPDATE.value:
+            return
+        if not self.accepts_round(session_id, self._round):
+            raise LateUpdateError("Update for round {} arrived too late!" \
+                .format(self._round))
+
+    def _in_object(self):
+        return bool(self._stack) and self._stack[-1][0] == b"{"
+
+    def _is_tensor_key(self):
+        """
+        Whether the value that starts is `results.gradients` or
+        `results.weights`.
+        """
+        return len(self._stack) == 2 and self._stack[1][1] == b"results" \
+            and self._key in TENSOR_KEYS
+
+    def _start_region(self):
+        """
+        Start decoding the array of the current key.
+        """
+        key = self._key.decode()
+        layout = None
+        session_id = self._fields.get(b"session_id")
+        if self.get_layout is not None and session_id is not None:
+            layout = self.get_layout(session_id)
+        self._region = _TensorRegion(TENSOR_KEYS[self._key], layout)
+        self._regions[key] = self._region
+
+class _TensorRegion(object):
+    """
+    Decodes the numbers of a nested array (or list of them, if `list_depth`
+    is 1) chunk by chunk.
+
+    Args:
+        list_depth (int): The number of list levels above the tensors.
+        layout (list): The expected shapes of the tensors, or `None`.
+    """
+
+    def __init__(self, list_depth, layout):
+        self.list_depth = list_depth
+        self.layout = layout
+        self.done = False
+        self._depth = 0
+        self._carry = b""
+        self._tensors = []
+        self._current = None
+
+    def feed(self, data, pos):
+        """
+        Decode the array from `pos` until it ends or the chunk ends.
+
+        Returns:
+            int: The position in the chunk right after the region.
+        """
+        chars = np.frombuffer(data, dtype=np.uint8, offset=pos)
+        opens = chars == OPEN_BRACKET
+        closes = chars == CLOSE_BRACKET
+        depths = self._depth + np.cumsum(opens, dtype=np.int64) \
+            - np.cumsum(closes, dtype=np.int64)
+
+        ends = np.flatnonzero(closes & (depths == 0))
+        stop = int(ends[0]) + 1 if len(ends) else len(chars)
+        depths, opens, closes = depths[:stop], opens[:stop], closes[:stop]
+
+        tensor_depth = self.list_depth + 1
+        starts = np.flatnonzero(opens & (depths == tensor_depth))
+        finishes = np.flatnonzero(closes & (depths == tensor_depth - 1))
+        boundaries = sorted([(int(i), True) for i in starts] \
+            + [(int(i), False) for i in finishes])
+
+        segment_start = 0
+        for index, is_start in boundaries:
+            if is_start:
+                self._start_tensor()
+                segment_start = index
+            else:
+                self._feed_tensor(data, pos, segment_start, index + 1, \
+                    opens, depths)
+                self._finish_tensor()
+        if self._current is not None:
+            self._feed_tensor(data, pos, segment_start, stop, opens, depths)
+
+        self._depth = int(depths[-1]) if stop else self._depth
+        self.done = bool(len(ends))
+        return pos + stop
+
+    def tensors(self):
+        """
+        The decoded tensors (a list of them, if `list_depth` is 1).
+        """
+        if self.list_depth == 0:
+            if len(self._tensors) != 1:
+                raise ValueError("Expected a single array!")
+            return self._tensors[0]
+        return self._tensors
+
+    def _start_tensor(self):
+        index = len(self._tensors)
+        shape = None
+        if self.layout is not None and index < len(self.layout):
+            shape = tuple(self.layout[index])
+        self._current = _Tensor(shape)
+
+    def _feed_tensor(self, data, pos, start, stop, opens, depths):
+        """
+        Decode the numbers of the current tensor in `[start, stop)` and count
+        its brackets per level.
+        """
+        tensor_opens = opens[start:stop]
+        if tensor_opens.any():
+            levels = depths[start:stop][tensor_opens] - self.list_depth
+            self._current.count_opens(levels)
+
+        text = self._carry + data[pos+start:pos+stop]
+        text = text.translate(NUMBER_SEPARATORS)
+        final = bool(len(depths[start:stop])) \
+            and depths[stop-1] < self.list_depth + 1
+        if final:
+            self._carry = b""
+        else:
+            # The last number might continue in the next chunk.
+            cut = max(text.rfind(char) for char in WHITESPACE) + 1
+            self._carry = text[cut:]
+            text = text[:cut]
+
+        tokens = text.split()
+        if tokens:
+            self._current.append(np.array(tokens, dtype=TENSOR_DTYPE))
+
+    def _finish_tensor(self):
+        self._tensors.append(self._current.finish())
+        self._current = None
+
+class _Tensor(object):
+    """
+    The buffer of a tensor being decoded.
+
+    The shape is inferred from the number of opening brackets at each level:
+    level `k + 1` has `shape[0] * ... * shape[k-1]` of them.
+
+    Args:
+        shape (tuple): The expected shape, or `None` if it's not known.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self._opens = np.zeros(1, dtype=np.int64)
+        self._size = 0
+        if shape is not None:
+            self._buffer = np.empty(int(np.prod(shape)), dtype=TENSOR_DTYPE)
+        else:
+            self._pieces = []
+
+    def count_opens(self, levels):
+        counts = np.bincount(levels)
+        if len(counts) > len(self._opens):
+            counts[:len(self._opens)] += self._opens
+            self._opens = counts
+        else:
+            self._opens[:len(counts)] += counts
+
+    def append(self, numbers):
+        if self.shape is not None:
+            if self._size + len(numbers) > len(self._buffer):
+                raise ValueError("Update doesn't match the shape {}!".format(
+                    self.shape))
+            self._buffer[self._size:self._size+len(numbers)] = numbers
+        else:
+            self._pieces.append(numbers)
+        self._size += len(numbers)
+
+    def finish(self):
+        """
+        Returns:
+            np.ndarray: The decoded tensor.
+        """
+        shape = self._inferred_shape()
+        if self.shape is None:
+            buffer = np.concatenate(self._pieces) if self._pieces \
+                else np.zeros(0, dtype=TENSOR_DTYPE)
+            self._pieces = None
+            return buffer.reshape(shape)
+
+        if shape != self.shape:
+            raise ValueError("Update has shape {0}, expected {1}!".format(
+                shape, self.shape))
+        return self._buffer.reshape(shape)
+
+    def _inferred_shape(self):
+        opens = [int(count) for count in self._opens[1:]]
+        if not opens:
+            raise ValueError("Expected an array!")
+        shape = []
+        for parent, child in zip(opens, opens[1:] + [self._size]):
+            if child % parent:
+                raise ValueError("Update arrays are ragged!")
+            shape.append(child // parent)
+        return tuple(shape)
@@ -0,0 +1,165 @@
+import json
+import struct
+
+import numpy as np
+
+
+# NOTE: The datacenter library keeps a copy of this module
+# (`datacenter/core/utils/tensor_frames.py`), since the two are deployed
+# separately. Keep them in sync: `tests/test_tensor_frames.py` checks that
+# frames round trip between both copies.
+TENSOR_DTYPE = np.dtype("<f4")
+TENSOR_DTYPES = {np.dtype(dtype).str for dtype in ["<f4", "<f2", "i1", "u1", \
+    "<i4", "<i8"]}
+HEADER_LENGTH_FORMAT = "<I"
+ALIGNMENT = 8
+
+def encode_frame(message):
+    """
+    Encode a message into a binary tensor frame.
+
+    Every value of the message (or of its nested dictionaries) that is a
+    numpy array, or a list of numpy arrays, is written as raw little-endian
+    bytes instead of JSON (float16, int8, uint8 and int32/64 arrays as they
+    are, the others as float32). The frame has the format:
+
+        | header length (uint32) | JSON header | tensor blocks |
+
+    The JSON header holds the rest of the message and a shape table, with the
+    path, shape, dtype and offset of every tensor block. The header is padded
+    so that every block is 8-byte aligned.
+
+    Args:
+        message (dict): The message to encode.
+
+    Returns:
+        bytes: The binary frame.
+    """
+    tensors = []
+    header = {
+        "message": _extract_tensors(message, [], tensors),
+        "tensors": [],
+    }
+
+    blocks, offset = [], 0
+    for path, index, tensor in tensors:
+        dtype = tensor.dtype.newbyteorder("<")
+        if dtype.str not in TENSOR_DTYPES:
+            dtype = TENSOR_DTYPE
+        tensor = np.ascontiguousarray(tensor, dtype=dtype)
+        header["tensors"].append({
+            "path": path,
+            "index": index,
+            "shape": list(tensor.shape),
+            "dtype": dtype.str,
+            "offset": offset,
+        })
+        blocks.append(memoryview(tensor).cast("B"))
+        padding = _padding(tensor.nbytes)
+        if padding:
+            blocks.append(b"\0" * padding)
+        offset += tensor.nbytes + padding
+
+    header_bytes = encode_json(header)
+    data_start = struct.calcsize(HEADER_LENGTH_FORMAT) + len(header_bytes)
+    header_bytes += b" " * _padding(data_start)
+    header_length = struct.pack(HEADER_LENGTH_FORMAT, len(header_bytes))
+    return b"".join([header_length, header_bytes] + blocks)
+
+def decode_frame(payload):
+    """
+    Decode a binary tensor frame (see `encode_frame()`).
+
+    The tensors are read-only views into `payload`, nothing gets copied.
+
+    Args:
+        payload (bytes): The binary frame.
+
+    Returns:
+        dict: The decoded message, with the tensors as numpy arrays.
+    """
+    header_length, = struct.unpack_from(HEADER_LENGTH_FORMAT, payload)
+    data_start = struct.calcsize(HEADER_LENGTH_FORMAT) + header_length
+    header_bytes = bytes(payload[data_start-header_length:data_start])
+    header = json.loads(header_bytes.decode())
+
+    message = header["message"]
+    for entry in header["tensors"]:
+        shape = entry["shape"]
+        dtype = np.dtype(entry.get("dtype", TENSOR_DTYPE.str))
+        tensor = np.frombuffer(payload, dtype=dtype, \
+            count=int(np.prod(shape)), offset=data_start + entry["offset"])
+        tensor = tensor.reshape(shape)
+
+        parent = message
+        for key in entry["path"][:-1]:
+            parent = parent.setdefault(key, {})
+        key = entry["path"][-1]
+        if entry["index"] is None:
+            parent[key] = tensor
+        else:
+            parent.setdefault(key, []).append(tensor)
+    return message
+
+def has_tensors(message):
+    """
+    Check whether a message has any values that would be encoded as tensor
+    blocks.
+
+    Args:
+        message (dict): The message to check.
+
+    Returns:
+        bool: Returns `True` if the message has tensors.
+    """
+    return any(_is_tensor(value) or _is_tensor_list(value) \
+            or (isinstance(value, dict) and has_tensors(value)) \
+        for value in message.values())
+
+def encode_json(message):
+    """
+    Encode a message into JSON, converting its numpy values into lists.
+
+    Args:
+        message (dict): The message to encode.
+
+    Returns:
+        bytes: The JSON payload.
+    """
+    return json.dumps(message, default=_to_serializable).encode()
+
+def _extract_tensors(message, path, tensors):
+    """
+    Copy the message without its tensors, appending them (along with their
+    path and their index in their list, if any) to `tensors`.
+    """
+    rest = {}
+    for key, value in message.items():
+        if _is_tensor(value):
+            tensors.append((path + [key], None, value))
+        elif _is_tensor_list(value):
+            for index, tensor in enumerate(value):
+                tensors.append((path + [key], index, tensor))
+        elif isinstance(value, dict):
+            rest[key] = _extract_tensors(value, path + [key], tensors)
+        else:
+            rest[key] = value
+    return rest
+
+def _is_tensor(value):
+    return isinstance(value, np.ndarray) and value.dtype != object
+
+def _is_tensor_list(value):
+    return isinstance(value, (list, tuple)) and len(value) > 0 \
+        and all(_is_tensor(item) for item in value)
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+def _to_serializable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(value).__name__))
@@ -4,6 +4,9 @@ from copy import deepcopy
 import pytest
 import boto3
 
+# NOTE: Run the model conversions in the test process.
+os.environ.setdefault("CONVERTER_POOL_SIZE", "0")
+
 import context
 import state
 from message import Message, ClientType, ActionType, LibraryActionType
@@ -12,12 +15,12 @@ from protocol import CloudNodeProtocol
 
 
 @pytest.fixture(autouse=True)
-def reset_state(repo_id, api_key):
-    state.start_state(repo_id)
-    state.state["test"] = True
-    yield
+def repo_state(repo_id, api_key):
+    repo_state = state.start_state(repo_id)
+    repo_state["test"] = True
+    yield repo_state
     state.reset_state(repo_id)
-    state.stop_state()
+    state.stop_state(repo_state)
 
 @pytest.fixture(scope="session")
 def library_client():
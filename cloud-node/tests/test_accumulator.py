@@ -0,0 +1,181 @@
+import pytest
+import numpy as np
+
+from accumulator import WeightedAccumulator
+from protocol import CloudNodeProtocol
+from update_encoding import encode_update
+
+
+@pytest.fixture
+def layer_updates():
+    first = [np.ones((3, 2)), np.full(2, 4.0)]
+    second = [np.full((3, 2), 3.0), np.zeros(2)]
+    return first, second
+
+def test_weighted_average(layer_updates):
+    """
+    Test that the accumulator returns the weighted average of the layers in
+    the configured dtype.
+    """
+    first, second = layer_updates
+    accumulator = WeightedAccumulator()
+    accumulator.add(first, 1)
+    accumulator.add(second, 3)
+
+    average = accumulator.average()
+
+    assert accumulator.sigma_omega == 4, "Sum of omegas is incorrect!"
+    assert average[0].dtype == np.float32, "Average has the wrong dtype!"
+    assert np.allclose(average[0], 2.5), "Kernel average is incorrect!"
+    assert np.allclose(average[1], 1.0), "Bias average is incorrect!"
+
+def test_flat_weighted_average():
+    """
+    Test that flat updates are averaged and returned as a flat array.
+    """
+    accumulator = WeightedAccumulator(dtype="float64")
+    accumulator.add(np.array([1.0, 2.0]), 2)
+    accumulator.add(np.array([4.0, 8.0]), 1)
+
+    average = accumulator.average()
+
+    assert isinstance(average, np.ndarray) and average.shape == (2,), \
+        "Flat layout not preserved!"
+    assert np.allclose(average, [2.0, 4.0]), "Flat average is incorrect!"
+
+def test_reset_keeps_buffers(layer_updates):
+    """
+    Test that resetting the accumulator zeroes the sum without reallocating.
+    """
+    first, second = layer_updates
+    accumulator = WeightedAccumulator()
+    accumulator.add(first, 1)
+    buffers = accumulator._buffers
+
+    accumulator.reset()
+    assert accumulator.average() is None, "Accumulator should be empty!"
+
+    accumulator.add(second, 1)
+    assert accumulator._buffers is buffers, "Buffers were reallocated!"
+    assert np.allclose(accumulator.average()[0], 3.0), "Average is incorrect!"
+
+def test_discounted_update(layer_updates):
+    """
+    Test that a discounted update shrinks the average instead of only
+    reweighting it.
+    """
+    first, second = layer_updates
+    accumulator = WeightedAccumulator()
+    accumulator.add(first, 1)
+    accumulator.add(second, 1, discount=0.5)
+
+    assert accumulator.sigma_omega == 2, "Discount shouldn't count as omega!"
+    assert np.allclose(accumulator.average()[0], 1.25), \
+        "Discounted average is incorrect!"
+
+def test_mismatched_update(layer_updates):
+    """
+    Test that updates with a different layout are rejected.
+    """
+    first, _ = layer_updates
+    accumulator = WeightedAccumulator()
+    accumulator.add(first, 1)
+
+    with pytest.raises(ValueError):
+        accumulator.add([np.ones((2, 3)), np.ones(2)], 1)
+
+def test_batched_weighted_average(layer_updates):
+    """
+    Test that staged updates are flushed once the batch is full and that the
+    batched average matches the sequential one.
+    """
+    first, second = layer_updates
+    sequential = WeightedAccumulator()
+    batched = WeightedAccumulator(batch_size=2)
+
+    sequential.add(first, 1)
+    batched.add(first, 1)
+    assert batched._num_staged == 1, "Update should have been staged!"
+
+    sequential.add(second, 3)
+    batched.add(second, 3)
+    assert batched._num_staged == 0, "Full batch should have been flushed!"
+
+    for expected, actual in zip(sequential.average(), batched.average()):
+        assert np.allclose(expected, actual), "Batched average is incorrect!"
+
+def test_batch_flushed_on_read(layer_updates):
+    """
+    Test that reading the average flushes a partially filled batch.
+    """
+    first, _ = layer_updates
+    batched = WeightedAccumulator(batch_size=10, batch_timeout_ms=60000)
+    batched.add(first, 2)
+
+    assert not batched.flush_if_due(), "Batch shouldn't have timed out!"
+    assert np.allclose(batched.average()[0], 1.0), "Average is incorrect!"
+    assert batched._num_staged == 0, "Batch should have been flushed!"
+
+def test_timed_out_batch_flushed(layer_updates, repo_state):
+    """
+    Test that a batch that timed out is flushed by the flush job of its repo,
+    which says when to flush again while updates are still staged.
+    """
+    first, _ = layer_updates
+    batched = WeightedAccumulator(batch_size=10, batch_timeout_ms=60000)
+    assert batched.flush_deadline is None, "Nothing should be staged!"
+    batched.add(first, 2)
+    repo_state["accumulator"] = batched
+
+    protocol = CloudNodeProtocol()
+    results = protocol._flushWithState(repo_state["repo_id"])
+    assert batched._num_staged == 1, "Batch flushed before its timeout!"
+    assert results["flush_deadline"] == batched.flush_deadline, \
+        "Flush not rescheduled!"
+
+    batched._staged_since -= 60
+    results = protocol._flushWithState(repo_state["repo_id"])
+    assert batched._num_staged == 0, "Timed out batch not flushed!"
+    assert "flush_deadline" not in results, "Nothing left to flush!"
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_quantized_weighted_average(layer_updates, batch_size):
+    """
+    Test that int8 updates are dequantized while they're folded in.
+    """
+    accumulator = WeightedAccumulator(batch_size=batch_size)
+    for update, omega in zip(layer_updates, [1, 3]):
+        quantized, params = encode_update(update, "int8")
+        accumulator.add(quantized, omega, params["scales"], \
+            params["zero_points"])
+
+    average = accumulator.average()
+
+    assert np.allclose(average[0], 2.5, atol=0.02), "Kernel average is incorrect!"
+    assert np.allclose(average[1], 1.0, atol=0.02), "Bias average is incorrect!"
+
+def test_sparse_weighted_average(layer_updates):
+    """
+    Test that sparse updates are scatter-added into the weighted sum.
+    """
+    first, _ = layer_updates
+    accumulator = WeightedAccumulator()
+    accumulator.add(first, 1)
+    accumulator.add_sparse([np.array([0, 5]), np.array([1])], \
+        [np.array([7.0, 3.0]), np.array([-4.0])], [(3, 2), (2,)], 1)
+
+    average = accumulator.average()
+
+    assert accumulator.sigma_omega == 2, "Sum of omegas is incorrect!"
+    assert np.allclose(average[0].ravel(), [4, 0.5, 0.5, 0.5, 0.5, 2]), \
+        "Kernel average is incorrect!"
+    assert np.allclose(average[1], [2, 0]), "Bias average is incorrect!"
+
+def test_sparse_index_out_of_bounds(layer_updates):
+    """
+    Test that sparse updates with out of bounds indices are rejected.
+    """
+    accumulator = WeightedAccumulator()
+    with pytest.raises(ValueError):
+        accumulator.add_sparse([np.array([6]), np.array([0])], \
+            [np.array([1.0]), np.array([1.0])], [(3, 2), (2,)], 1)
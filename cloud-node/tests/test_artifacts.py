@@ -0,0 +1,71 @@
+import gzip
+import os
+import time
+
+import pytest
+
+import artifacts
+
+
+@pytest.fixture
+def artifact_path(tmpdir):
+    path = str(tmpdir.join("model.json"))
+    with open(path, "w") as f:
+        f.write('{"weights": [' + ", ".join(["0.5"] * 1000) + "]}")
+    return path
+
+def test_publish_artifact(artifact_path):
+    """
+    Test that a published artifact has a strong ETag for its round and
+    content, and a gzip variant.
+    """
+    artifact = artifacts.publish_file(artifact_path, 3)
+    assert artifact.etag.startswith("3-"), "ETag should have the round!"
+    assert artifacts.get_artifact(artifact_path) == artifact, \
+        "Artifact not published!"
+
+    with open(artifact_path, "rb") as f, \
+            gzip.open(artifact.variants["gzip"], "rb") as variant:
+        assert variant.read() == f.read(), "Wrong gzip variant!"
+
+    other = artifacts.publish_file(artifact_path, 4)
+    assert other.etag != artifact.etag, "ETag should change with the round!"
+
+def test_changed_artifact(artifact_path):
+    """
+    Test that an artifact has to be published again once it changes.
+    """
+    artifacts.publish(os.path.dirname(artifact_path), 1)
+    assert artifacts.get_artifact(artifact_path) is not None, \
+        "Folder not published!"
+    assert not os.path.exists(artifact_path + ".gz.gz"), \
+        "Variants shouldn't be published!"
+
+    time.sleep(0.01)
+    with open(artifact_path, "a") as f:
+        f.write(" ")
+    assert artifacts.get_artifact(artifact_path) is None, \
+        "Changed artifact shouldn't be served!"
+
+def test_removed_artifact(tmpdir):
+    """
+    Test that only the variants of the current round's model are left on
+    disk once the model of the previous round is removed.
+    """
+    folder = str(tmpdir)
+    for round in (1, 2):
+        path = os.path.join(folder, "model{}.h5".format(round))
+        with open(path, "w") as f:
+            f.write("0.5 " * 1000)
+        artifacts.publish_file(path, round)
+        if round > 1:
+            old_path = os.path.join(folder, "model{}.h5".format(round - 1))
+            artifacts.remove(old_path)
+            assert artifacts._artifacts.get(old_path) is None, \
+                "Removed artifact still published!"
+
+    assert all(filename.startswith("model2.h5") \
+        for filename in os.listdir(folder)), \
+        "Variants of the removed model left on disk!"
+    assert os.path.exists(os.path.join(folder, "model2.h5.gz")), \
+        "Variants of the current model removed!"
@@ -0,0 +1,106 @@
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+import state
+from aggregator import handle_new_update
+from coordinator import hand_out_version
+from message import Message, ActionType
+
+
+@pytest.fixture
+def async_state(repo_state, factory, session_message, session_id, repo_id):
+    message = deepcopy(session_message)
+    message["library_type"] = "PYTHON"
+    message["aggregation_config"] = {
+        "mode": "ASYNC",
+        "buffer_size": 3,
+        "max_staleness": 2,
+        "staleness_exponent": 1,
+    }
+    repo_state.update({
+        "busy": True,
+        "asynchronous": True,
+        "max_staleness": 2,
+        "session_id": session_id,
+        "current_round": 4,
+        "num_nodes_chosen": 2,
+        "initial_message": Message.make(message),
+        "library_type": "PYTHON",
+        "use_gradients": True,
+        "last_message_sent_to_library": {
+            "session_id": session_id,
+            "repo_id": repo_id,
+            "round": 4,
+            "action": "TRAIN",
+            "delta_url": "/delta/{}/4".format(session_id),
+            "delta_hash": "hash",
+        },
+    })
+    return repo_state
+
+def _make_update(repo_id, session_id, round):
+    return Message.make({
+        "type": "NEW_UPDATE",
+        "repo_id": repo_id,
+        "session_id": session_id,
+        "round": round,
+        "results": {
+            "omega": 1,
+            "gradients": [np.ones(3, dtype=np.float32).tolist()],
+        },
+    })
+
+def test_get_staleness():
+    """
+    Test that synchronous sessions only accept the current round, and
+    asynchronous ones accept stale rounds up to their maximum staleness.
+    """
+    assert state.get_staleness(4, 4) == 0, "Current round not accepted!"
+    assert state.get_staleness(4, 3) is None, "Stale round accepted!"
+    assert state.get_staleness(4, 2, 2) == 2, "Stale round not accepted!"
+    assert state.get_staleness(4, 1, 2) is None, "Too stale round accepted!"
+    assert state.get_staleness(4, 1, None) == 3, "Staleness should be unbounded!"
+    assert state.get_staleness(4, 5, None) is None, "Future round accepted!"
+
+def test_hand_out_version(async_state):
+    """
+    Test that an idle node only gets the delta if it has the previous
+    version, and reloads the model if it's older.
+    """
+    message = hand_out_version(async_state, 3)["message"]
+    assert "delta_url" in message and message["asynchronous"], \
+        "Delta should be sent!"
+
+    message = hand_out_version(async_state, 4)["message"]
+    assert "delta_url" not in message and "reload_model" not in message, \
+        "Latest version shouldn't be sent again!"
+
+    for base_round in (2, None):
+        message = hand_out_version(async_state, base_round)["message"]
+        assert "delta_url" not in message and message["reload_model"], \
+            "Model should be reloaded!"
+
+def test_stale_update(async_state, factory, repo_id, session_id):
+    """
+    Test that stale updates are buffered with their discount, and that the
+    node that sent them gets the latest version right away.
+    """
+    clients_dict = factory.clients[repo_id]
+    results = handle_new_update(async_state, \
+        _make_update(repo_id, session_id, 4), clients_dict)
+    assert results["action"] == ActionType.UNICAST, "Version not handed out!"
+    assert results["message"]["round"] == 4, "Wrong version handed out!"
+
+    handle_new_update(async_state, _make_update(repo_id, session_id, 2), \
+        clients_dict)
+    accumulator = async_state["accumulator"]
+    assert async_state["num_nodes_averaged"] == 2, "Update not buffered!"
+    assert np.allclose(accumulator.average()[0], (1 + 1 / 3) / 2), \
+        "Stale update not discounted!"
+
+    results = handle_new_update(async_state, \
+        _make_update(repo_id, session_id, 1), clients_dict)
+    assert results["message"]["error"], "Too stale update accepted!"
+    assert async_state["current_round"] == 4, "Version shouldn't change!"
@@ -0,0 +1,55 @@
+import base64
+import os
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+from aggregator import handle_new_update
+from message import Message, ActionType
+
+
+@pytest.fixture
+def ios_text_state(repo_state, session_message, session_id, dataset_id):
+    message = deepcopy(session_message)
+    message["library_type"] = "IOS_TEXT"
+    repo_state.update({
+        "busy": True,
+        "session_id": session_id,
+        "dataset_id": dataset_id,
+        "current_round": 1,
+        "num_nodes_chosen": 4,
+        "initial_message": Message.make(message),
+        "library_type": "IOS_TEXT",
+        "use_gradients": True,
+    })
+    return repo_state
+
+def test_binary_weights(ios_text_state, factory, repo_id, session_id, \
+        dataset_id):
+    """
+    Test that the binary weights sent along with an update are saved for the
+    next round.
+    """
+    binary_weights = np.arange(16, dtype=np.float32).tobytes()
+    message = Message.make({
+        "type": "NEW_UPDATE",
+        "repo_id": repo_id,
+        "session_id": session_id,
+        "dataset_id": dataset_id,
+        "round": 1,
+        "results": {
+            "omega": 1,
+            "gradients": [np.ones(3, dtype=np.float32).tolist()],
+            "binary_gradients": base64.b64encode(binary_weights).decode(),
+        },
+    })
+    results = handle_new_update(ios_text_state, message, \
+        factory.get_clients(repo_id))
+    assert results["action"] == ActionType.DO_NOTHING, \
+        "Round shouldn't be closed!"
+
+    mlmodel_weights_path = ios_text_state["mlmodel_weights_path"]
+    assert os.path.isfile(mlmodel_weights_path), "Binary weights not saved!"
+    with open(mlmodel_weights_path, "rb") as f:
+        assert f.read() == binary_weights, "Wrong binary weights saved!"
@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+from autobahn.twisted.websocket import WebSocketServerFactory
+from twisted.internet.abstract import FileDescriptor
+from twisted.internet.task import Clock
+
+from broadcast import Broadcaster, DEFERRED_RETRY_INTERVAL, \
+    outbound_buffer_size
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.dataBuffer = b""
+        self.offset = 0
+        self._tempDataLen = 0
+
+class FakeClient(object):
+    def __init__(self, binary_frames=False):
+        self.binary_frames = binary_frames
+        self.transport = FakeTransport()
+        self.peer = "fake"
+        self.sent = []
+        self.dropped = False
+
+    def sendPreparedMessage(self, prepared):
+        self.sent.append(prepared)
+
+    def dropConnection(self, abort=False):
+        self.dropped = True
+
+class FakeReactor(object):
+    def addWriter(self, writer):
+        pass
+
+    def removeWriter(self, writer):
+        pass
+
+class SlowFileDescriptor(FileDescriptor):
+    """
+    A Twisted transport that only sends 10 bytes at a time.
+    """
+    connected = True
+
+    def writeSomeData(self, data):
+        return min(len(data), 10)
+
+@pytest.fixture
+def prepared_messages():
+    return []
+
+@pytest.fixture
+def prepare_message(prepared_messages):
+    factory = WebSocketServerFactory()
+    def prepare_message(payload, isBinary):
+        prepared_messages.append(isBinary)
+        return factory.prepareMessage(payload, isBinary)
+    return prepare_message
+
+def test_prepared_once_per_format(prepare_message, prepared_messages):
+    """
+    Test that a message is only prepared once per format, no matter how many
+    clients it's sent to.
+    """
+    broadcaster = Broadcaster(prepare_message, clock=Clock())
+    clients = [FakeClient(binary_frames=i % 2 == 0) for i in range(10)]
+    message = {"action": "TRAIN", "gradients": [np.ones(4, dtype=np.float32)]}
+    broadcaster.broadcast(message, clients)
+
+    assert sorted(prepared_messages) == [False, True], \
+        "Message should be prepared once per format!"
+    assert all(len(client.sent) == 1 for client in clients), \
+        "Message not sent to every client!"
+    assert clients[0].sent[0] is clients[2].sent[0], \
+        "Clients should share the prepared message!"
+
+    stats = broadcaster.stats()["broadcast"]
+    assert stats["messages_sent"] == 10, "Wrong number of messages sent!"
+    assert stats["last_bytes"] == sum(len(client.sent[0].payloadHybi) \
+        for client in clients), "Wrong number of bytes sent!"
+
+def test_deferred_slow_client(prepare_message):
+    """
+    Test that messages to a slow client are deferred, in order, until its
+    buffer drains.
+    """
+    clock = Clock()
+    broadcaster = Broadcaster(prepare_message, max_buffer_size=100, \
+        clock=clock)
+    fast, slow = FakeClient(), FakeClient()
+    slow.transport.dataBuffer = b"x" * 101
+
+    broadcaster.broadcast({"round": 1}, [fast, slow])
+    broadcaster.broadcast({"round": 2}, [fast, slow])
+    assert len(fast.sent) == 2, "Fast client shouldn't be deferred!"
+    assert not slow.sent, "Slow client should be deferred!"
+    assert broadcaster.pending(slow) == 2, "Messages not deferred!"
+
+    clock.advance(DEFERRED_RETRY_INTERVAL)
+    assert not slow.sent, "Messages sent before the buffer drained!"
+
+    slow.transport.offset = 101
+    clock.advance(DEFERRED_RETRY_INTERVAL)
+    assert [m.payload for m in slow.sent] == [m.payload for m in fast.sent], \
+        "Deferred messages not sent in order!"
+    assert not broadcaster.pending(slow), "Deferred messages not cleared!"
+
+def test_dropped_slow_client(prepare_message):
+    """
+    Test that slow clients are dropped with the drop policy, and once too
+    many messages are deferred with the defer policy.
+    """
+    slow = FakeClient()
+    slow.transport.dataBuffer = b"x" * 101
+    broadcaster = Broadcaster(prepare_message, policy="drop", \
+        max_buffer_size=100, clock=Clock())
+    broadcaster.broadcast({"round": 1}, [slow])
+    assert slow.dropped and not slow.sent, "Slow client not dropped!"
+
+    slow = FakeClient()
+    slow.transport.dataBuffer = b"x" * 101
+    broadcaster = Broadcaster(prepare_message, max_buffer_size=100, \
+        max_deferred=1, clock=Clock())
+    broadcaster.broadcast({"round": 1}, [slow])
+    assert not slow.dropped, "Slow client dropped too early!"
+    broadcaster.broadcast({"round": 2}, [slow])
+    assert slow.dropped, "Slow client not dropped!"
+    assert broadcaster.stats()["broadcast"]["clients_dropped"] == 1, \
+        "Dropped client not counted!"
+
+def test_dispatch_waves(prepare_message):
+    """
+    Test that a message dispatched in waves is sent to every wave after its
+    delay, and that the waves not sent yet can be cancelled.
+    """
+    clock = Clock()
+    broadcaster = Broadcaster(prepare_message, clock=clock)
+    clients = [FakeClient() for _ in range(3)]
+    waves = [
+        {"delay": 0, "clients": clients[:2]},
+        {"delay": 1.5, "clients": clients[2:]},
+    ]
+    broadcaster.dispatch({"round": 1}, waves, "repo")
+
+    clock.advance(0)
+    assert [len(client.sent) for client in clients] == [1, 1, 0], \
+        "First wave not sent!"
+    clock.advance(1.5)
+    assert [len(client.sent) for client in clients] == [1, 1, 1], \
+        "Second wave not sent!"
+
+    stats = broadcaster.stats()["dispatch"]
+    assert [timing["clients"] for timing in stats["last_dispatch"]] == [2, 1], \
+        "Waves not timed!"
+    assert stats["last_dispatch"][1]["delay"] == 1.5, "Wrong wave delay!"
+    assert not stats["pending_dispatches"], "Dispatch should be done!"
+
+    broadcaster.dispatch({"round": 2}, waves, "repo")
+    clock.advance(0)
+    broadcaster.cancel_dispatch("repo")
+    clock.advance(1.5)
+    assert [len(client.sent) for client in clients] == [2, 2, 1], \
+        "Cancelled wave sent!"
+
+def test_twisted_transport_buffer():
+    """
+    Test that the outbound buffer of a real Twisted transport is measured
+    while it fills and drains, since it's read from its private attributes.
+    """
+    client = FakeClient()
+    client.transport = SlowFileDescriptor(reactor=FakeReactor())
+    assert outbound_buffer_size(client) == 0, "Buffer should be empty!"
+
+    client.transport.write(b"x" * 100)
+    assert outbound_buffer_size(client) == 100, "Written bytes not counted!"
+
+    client.transport.doWrite()
+    client.transport.write(b"x" * 30)
+    assert outbound_buffer_size(client) == 120, "Sent bytes still counted!"
+
+    while outbound_buffer_size(client):
+        client.transport.doWrite()
+    assert client.transport.dataBuffer == b"", "Buffer not drained!"
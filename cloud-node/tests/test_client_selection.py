@@ -0,0 +1,125 @@
+import time
+from collections import Counter
+from copy import deepcopy
+
+import pytest
+
+import client_stats
+from aggregator import check_continuation_criteria
+from coordinator import _choose_clients
+from message import Message, LibraryActionType
+
+
+class FakeClient(object):
+    peer = "fake"
+
+@pytest.fixture
+def clients():
+    clients = [FakeClient() for _ in range(10)]
+    yield clients
+    for client in clients:
+        client_stats.discard(client)
+
+def _finish_round(client, turnaround, download_time):
+    """
+    Make a client look like it went through a round in `turnaround` seconds.
+    """
+    client_stats.record_sent(client, \
+        {"action": LibraryActionType.TRAIN.value})
+    record = client_stats._records[client_stats._key(client)]
+    record.sent_at -= turnaround
+    client_stats.record_message(client, record.sent_at + turnaround - 1, \
+        record.sent_at + turnaround, 1000)
+    client_stats.record_update(client, {"download": download_time})
+
+def test_client_stats(clients):
+    """
+    Test that the download time, training time and upload throughput of a
+    client are derived from the timestamps of its round.
+    """
+    client = clients[0]
+    assert client_stats.expected_round_time(client) is None, \
+        "Client without history should have no expected round time!"
+
+    _finish_round(client, 10, 2)
+    record = client_stats._records[client]
+    assert record.download_time == pytest.approx(2), "Wrong download time!"
+    assert record.train_time == pytest.approx(7), "Wrong training time!"
+    assert record.upload_throughput == pytest.approx(1000), \
+        "Wrong upload throughput!"
+    assert client_stats.expected_round_time(client) == pytest.approx(10), \
+        "Wrong expected round time!"
+
+    client_stats.record_message(client, time.time(), time.time(), 1000)
+    assert record.bytes_received == 1000, \
+        "Messages outside of a round shouldn't count!"
+
+def test_stable_client_id(clients):
+    """
+    Test that the history of a client with a `client_id` is kept across its
+    connections, until it expires.
+    """
+    connection = FakeClient()
+    connection.client_id = "stable"
+    _finish_round(connection, 10, 2)
+    client_stats.discard(connection)
+
+    reconnection = FakeClient()
+    reconnection.client_id = "stable"
+    assert client_stats.expected_round_time(reconnection) \
+        == pytest.approx(10), "History not kept across connections!"
+
+    client_stats._records["stable"].last_seen -= client_stats.STATS_TTL + 1
+    client_stats.get_stats()
+    assert client_stats.expected_round_time(reconnection) is None, \
+        "History didn't expire!"
+
+def test_uniform_selection(clients):
+    """
+    Test that uniform selection chooses `value` distinct clients, and that
+    over-selection chooses extra clients but only needs `value` of them.
+    """
+    chosen, target = _choose_clients({"type": "UNIFORM", "value": 4}, clients)
+    assert len(set(chosen)) == 4 and target is None, "Wrong uniform selection!"
+
+    chosen, target = _choose_clients({"type": "OVER_SELECTION", "value": 4}, \
+        clients)
+    assert len(set(chosen)) == 6 and target == 4, "Wrong over-selection!"
+
+    chosen, target = _choose_clients({"type": "ALL_NODES"}, clients)
+    assert chosen == clients and chosen is not clients, \
+        "Every client should be chosen!"
+
+def test_speed_weighted_selection(clients):
+    """
+    Test that faster clients are chosen more often.
+    """
+    for index, client in enumerate(clients):
+        _finish_round(client, 1 if index < 5 else 50, 0)
+
+    counts = Counter()
+    for _ in range(200):
+        chosen, _ = _choose_clients({"type": "SPEED_WEIGHTED", "value": 3}, \
+            clients)
+        counts.update(clients.index(client) < 5 for client in chosen)
+    assert counts[True] > 10 * counts[False], \
+        "Fast clients should be chosen more often!"
+
+def test_over_selection_cutoff(repo_state, session_message):
+    """
+    Test that an over-selected round only waits for the nodes it needs.
+    """
+    message = deepcopy(session_message)
+    message["library_type"] = "PYTHON"
+    message["continuation_criteria"] = {"type": "PERCENTAGE_AVERAGED", \
+        "value": 1.0}
+    repo_state.update({
+        "initial_message": Message.make(message),
+        "num_nodes_chosen": 6,
+        "num_nodes_target": 4,
+        "num_nodes_averaged": 3,
+    })
+    assert not check_continuation_criteria(repo_state), "Round closed early!"
+    repo_state["num_nodes_averaged"] = 4
+    assert check_continuation_criteria(repo_state), \
+        "Round should only wait for the nodes it needs!"
@@ -0,0 +1,63 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+import state
+from coordinator import _make_delta
+from server import app
+from tensor_frames import decode_frame
+from update_encoding import encode_update
+
+
+@pytest.fixture
+def gradients():
+    return [np.arange(6, dtype=np.float32).reshape(2, 3), \
+        np.ones(4, dtype=np.float32)]
+
+@pytest.fixture
+def delta(repo_state, repo_id, session_id, gradients):
+    repo_state.update({
+        "busy": True,
+        "session_id": session_id,
+        "current_round": 2,
+        "encoded_gradients": encode_update(gradients, "float32"),
+    })
+    repo_state["delta"] = _make_delta(repo_state)
+    state.publish_snapshot(repo_id)
+    return repo_state["delta"]
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def test_serve_delta(client, delta, session_id, gradients):
+    """
+    Test that the delta of the round is served and matches its hash.
+    """
+    response = client.get("/delta/{}/2".format(session_id))
+    assert response.status_code == 200, "Delta not served!"
+    assert hashlib.sha256(response.data).hexdigest() == delta.sha256, \
+        "Delta doesn't match its hash!"
+
+    message = decode_frame(response.data)
+    assert message["encoding"] == "float32", "Wrong encoding!"
+    for layer, gradient in zip(message["gradients"], gradients):
+        assert np.array_equal(layer, gradient), "Gradients not equal!"
+
+    response = client.get("/delta/{}/1".format(session_id))
+    assert response.status_code == 404, "Delta of another round served!"
+
+def test_conditional_delta(client, delta, session_id):
+    """
+    Test that the delta is cacheable by its hash and can be fetched in
+    ranges.
+    """
+    url = "/delta/{}/2".format(session_id)
+    response = client.get(url, headers={"If-None-Match": '"{}"' \
+        .format(delta.sha256)})
+    assert response.status_code == 304, "Cached delta sent again!"
+
+    response = client.get(url, headers={"Range": "bytes=10-"})
+    assert response.status_code == 206, "Range not supported!"
+    assert response.data == delta.payload[10:], "Wrong range served!"
@@ -0,0 +1,46 @@
+import pytest
+
+import coordinator
+from state import ModelDelta
+
+
+@pytest.fixture
+def results():
+    return {"client_list": list(range(10)), "message": {}}
+
+@pytest.fixture
+def python_state(repo_state):
+    repo_state.update({
+        "library_type": "PYTHON",
+        "current_round": 2,
+        "delta": ModelDelta(round=2, sha256="", payload=b"\0" * 1000),
+    })
+    return repo_state
+
+def test_staggered_dispatch(monkeypatch, python_state, results):
+    """
+    Test that the clients are split into waves that fit in the egress
+    bandwidth budget, one wave interval apart.
+    """
+    monkeypatch.setattr(coordinator, "EGRESS_BANDWIDTH", 4000)
+    monkeypatch.setattr(coordinator, "DISPATCH_WAVE_INTERVAL", 2.0)
+    monkeypatch.setattr(coordinator, "DISPATCH_JITTER", 0.5)
+    coordinator._stagger_dispatch(python_state, results)
+
+    waves = results["waves"]
+    assert [wave["clients"] for wave in waves] == [[0, 1, 2, 3, 4, 5, 6, 7], \
+        [8, 9]], "Wrong waves!"
+    assert waves[0]["delay"] == 0, "First wave shouldn't be delayed!"
+    assert 2.0 <= waves[1]["delay"] <= 3.0, "Wrong wave delay!"
+
+def test_unstaggered_dispatch(monkeypatch, python_state, results):
+    """
+    Test that nothing is staggered without a bandwidth budget, or when a
+    single wave is enough.
+    """
+    coordinator._stagger_dispatch(python_state, results)
+    assert "waves" not in results, "Dispatch shouldn't be staggered!"
+
+    monkeypatch.setattr(coordinator, "EGRESS_BANDWIDTH", 10 ** 6)
+    coordinator._stagger_dispatch(python_state, results)
+    assert "waves" not in results, "Dispatch shouldn't be staggered!"
@@ -35,15 +35,15 @@ def manage_test_object(repo_id, s3_object, ios_s3_object, h5_model_path, \
     state.reset_state(repo_id)    
 
 def test_session_while_busy(python_session_message, factory, \
-        dashboard_client):
+        dashboard_client, repo_state):
     """
     Test that new session cannot be started while server is busy.
     """
-    state.state["busy"] = True
+    repo_state["busy"] = True
     state.num_sessions = 1
 
-    results = process_new_message(python_session_message, factory, 
-        dashboard_client)
+    results = process_new_message(repo_state, python_session_message, \
+        factory, dashboard_client)
     message = results["message"]
 
     assert message["error"], "Error should have occurred!"
@@ -51,55 +51,55 @@ def test_session_while_busy(python_session_message, factory, \
     assert state.num_sessions == 1, "Number of sessions should be 1!"
 
 def test_new_python_session(python_session_message, factory, \
-        broadcast_message, dashboard_client):
+        broadcast_message, dashboard_client, repo_state):
     """
     Test that new session with Python library produces correct `BROADCAST`
     message and that model is successfully saved.
     """
-    results = process_new_message(python_session_message, factory, \
-        dashboard_client)
+    results = process_new_message(repo_state, python_session_message, \
+        factory, dashboard_client)
 
-    assert state.state["h5_model_path"], "h5 model path not set!"
-    assert os.path.isfile(state.state["h5_model_path"]), "Model not saved!"
+    assert repo_state["h5_model_path"], "h5 model path not set!"
+    assert os.path.isfile(repo_state["h5_model_path"]), "Model not saved!"
 
     assert results == broadcast_message, "Resulting message is incorrect!"
     assert state.num_sessions == 1, "Number of sessions should be 1!"
     
 
 def test_new_js_session(js_session_message, factory, broadcast_message, \
-        dashboard_client):
+        dashboard_client, repo_state):
     """
     Test that new session with Javascript library produces correct `BROADCAST`
     message and that model is successfully saved and converted.
     """
-    results = process_new_message(js_session_message, factory, \
-        dashboard_client)
+    results = process_new_message(repo_state, js_session_message, \
+        factory, dashboard_client)
 
-    assert state.state["h5_model_path"], "h5 model path not set!"
-    assert os.path.isfile(state.state["h5_model_path"]), "Model not saved!"
+    assert repo_state["h5_model_path"], "h5 model path not set!"
+    assert os.path.isfile(repo_state["h5_model_path"]), "Model not saved!"
     
-    assert state.state["tfjs_model_path"], "TFJS model path not set."
-    assert os.path.isdir(state.state["tfjs_model_path"]) \
-        and len(os.listdir(state.state["tfjs_model_path"])) > 0, \
+    assert repo_state["tfjs_model_path"], "TFJS model path not set."
+    assert os.path.isdir(repo_state["tfjs_model_path"]) \
+        and len(os.listdir(repo_state["tfjs_model_path"])) > 0, \
         "TFJS model conversion failed!"
 
     assert results == broadcast_message, "Resulting message is incorrect!"
     assert state.num_sessions == 1, "Number of sessions should be 1!"
 
 def test_new_ios_session(ios_session_message, factory, ios_broadcast_message, \
-        dashboard_client):
+        dashboard_client, repo_state):
     """
     Test that new session with Javascript library produces correct `BROADCAST`
     message and that model is successfully saved and converted.
     """
-    results = process_new_message(ios_session_message, factory, \
-        dashboard_client)
+    results = process_new_message(repo_state, ios_session_message, \
+        factory, dashboard_client)
 
-    assert state.state["h5_model_path"], "h5 model path not set!"
-    assert os.path.isfile(state.state["h5_model_path"]), "Model not saved!"
+    assert repo_state["h5_model_path"], "h5 model path not set!"
+    assert os.path.isfile(repo_state["h5_model_path"]), "Model not saved!"
     
-    assert state.state["mlmodel_path"], "MLModel path not set."
-    assert os.path.isfile(state.state["mlmodel_path"]), \
+    assert repo_state["mlmodel_path"], "MLModel path not set."
+    assert os.path.isfile(repo_state["mlmodel_path"]), \
         "iOS model conversion failed!"
 
     assert results == ios_broadcast_message, "Resulting message is incorrect!"
@@ -9,11 +9,12 @@ import state
 from message import Message, MessageType, ClientType, ActionType, \
     LibraryActionType, ErrorType
 from new_message import process_new_message
+from tensor_frames import decode_frame
 
 
 @pytest.fixture(autouse=True)
-def set_training_state(repo_id, session_id, python_session_message, \
-        h5_model_path):
+def set_training_state(repo_state, repo_id, session_id, \
+        python_session_message, h5_model_path):
     session_h5_model_folder = os.path.join("temp", repo_id, session_id)
     session_h5_model_path = os.path.join(session_h5_model_folder, "model.h5")
 
@@ -22,7 +23,7 @@ def set_training_state(repo_id, session_id, python_session_message, \
     old_model = load_model(h5_model_path)
     old_model.save(session_h5_model_path)
 
-    state.state = {
+    repo_state.update({
         "busy": True,
         "session_id": session_id,
         "repo_id": repo_id,
@@ -38,7 +39,7 @@ def set_training_state(repo_id, session_id, python_session_message, \
         "library_type": "PYTHON",
         "checkpoint_frequency": 1,
         "test": True
-    }
+    })
 
     state.num_sessions = 1
     
@@ -78,18 +79,26 @@ def broadcast_message(simple_gradients, factory, repo_id, train_message):
     }
 
 def test_simple_aggregation(simple_new_update_message, factory, \
-        library_client, simple_gradients, broadcast_message):
+        library_client, simple_gradients, broadcast_message, repo_state):
     """
     Test that aggregation after one round succeeds and continues to the next
     round.
     """
-    results = process_new_message(simple_new_update_message, factory, \
-        library_client)
+    results = process_new_message(repo_state, simple_new_update_message, \
+        factory, library_client)
     
-    message_gradients = results["message"].pop("gradients")
+    delta = repo_state["delta"]
+    assert results["message"].pop("delta_hash") == delta.sha256, \
+        "Wrong delta hash!"
+    assert results["message"].pop("delta_url") == \
+        "/delta/{0}/{1}".format(repo_state["session_id"], delta.round), \
+        "Wrong delta URL!"
+    message_gradients = decode_frame(delta.payload)["gradients"]
     simple_gradients = [gradient.tolist() for gradient in simple_gradients]
     
     assert broadcast_message == results, "Resulting message is incorrect!"
+    assert repo_state["num_materializations"] == {1: 1}, \
+        "Model should be materialized once per round!"
     
     for simple_gradient, message_gradient in zip(simple_gradients, message_gradients):
         assert np.allclose(message_gradient, simple_gradient), \
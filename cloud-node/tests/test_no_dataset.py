@@ -70,31 +70,31 @@ def ios_broadcast_message(ios_train_message, factory, repo_id):
     }
 
 def test_simple_no_dataset_message(simple_training_state, no_dataset_message, \
-        factory, library_client, no_action_message):
+        factory, library_client, no_action_message, repo_state):
     """
     Test that a client sending a `NO_DATASET` message reduces the number of
     chosen nodes and results in no further action taken when the continuation
     criteria is not fulfilled.
     """
     state.num_sessions = 1
-    state.state = simple_training_state
-    results = process_new_message(no_dataset_message, factory, \
-        library_client)
+    repo_state.update(simple_training_state)
+    results = process_new_message(repo_state, no_dataset_message, \
+        factory, library_client)
 
-    assert state.state["num_nodes_chosen"] == 1
+    assert repo_state["num_nodes_chosen"] == 1
     assert results == no_action_message, "Resulting message is incorrect!"
 
 def test_complex_no_dataset_message(complex_training_state, no_dataset_message, \
-        factory, library_client, ios_broadcast_message):
+        factory, library_client, ios_broadcast_message, repo_state):
     """
     Test that a client sending a `NO_DATASET` message reduces the number of
     chosen nodes and results in the next round when the continuation
     criteria is fulfilled.
     """
     state.num_sessions = 1
-    state.state = complex_training_state
-    results = process_new_message(no_dataset_message, factory, \
-        library_client)
+    repo_state.update(complex_training_state)
+    results = process_new_message(repo_state, no_dataset_message, \
+        factory, library_client)
 
-    assert state.state["num_nodes_chosen"] == 1
+    assert repo_state["num_nodes_chosen"] == 1
     assert results == ios_broadcast_message, "Resulting message is incorrect!"
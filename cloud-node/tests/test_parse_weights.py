@@ -4,7 +4,6 @@ import json
 import pytest
 import numpy as np
 
-import state
 from parse_weights import calculate_new_weights, read_compiled_weights
 
 
@@ -56,9 +55,8 @@ def remove_weights(new_weights_path):
 
 def test_parse_simple_weights(simple_gradients, old_simple_weights_path, \
         new_simple_weights_path, new_weights_path):
-    state.state["current_gradients"] = simple_gradients
     new_weights = calculate_new_weights(old_simple_weights_path, \
-        new_weights_path, lr=0.01)
+        new_weights_path, simple_gradients, lr=0.01)
     
     new_expected_weights = read_compiled_weights(new_simple_weights_path)
     new_actual_weights = read_compiled_weights(new_weights_path)
@@ -72,9 +70,8 @@ def test_parse_simple_weights(simple_gradients, old_simple_weights_path, \
 
 def test_parse_complex_weights(complex_gradients, old_complex_weights_path, \
         new_complex_weights_path, new_weights_path):
-    state.state["current_gradients"] = complex_gradients
     new_weights = calculate_new_weights(old_complex_weights_path, \
-        new_weights_path, lr=0.01)
+        new_weights_path, complex_gradients, lr=0.01)
     
     new_expected_weights = read_compiled_weights(new_complex_weights_path)
     new_actual_weights = read_compiled_weights(new_weights_path)
@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 
 import pytest
 
@@ -95,13 +96,14 @@ def unregister(factory, repo_id, dummy_client):
         clients.remove(dummy_client)
 
 def test_basic_register(library_registration_message, factory, dummy_client, \
-        registration_success, original_client_count):
+        registration_success, original_client_count, \
+        repo_state):
     """
     Test that a basic `LIBRARY` registration succeeds.
     """
     repo_id = library_registration_message.repo_id
-    results = process_new_message(library_registration_message, factory, \
-        dummy_client)
+    results = process_new_message(repo_state, library_registration_message, \
+        factory, dummy_client)
     new_client_count = _client_count(factory, repo_id)
     
     assert results == registration_success, \
@@ -110,14 +112,15 @@ def test_basic_register(library_registration_message, factory, dummy_client, \
         "Client count is incorrect!"
 
 def test_failed_authentication(bad_registration_message, factory, \
-        dummy_client, failed_authentication_error, original_client_count):
+        dummy_client, failed_authentication_error, original_client_count, \
+        repo_state):
     """
     Test that registration fails with an invalid API key
     """
     repo_id = bad_registration_message.repo_id
     bad_registration_message.api_key = "bad-api-key"
-    results = process_new_message(bad_registration_message, factory, \
-        dummy_client)
+    results = process_new_message(repo_state, bad_registration_message, \
+        factory, dummy_client)
     new_client_count = _client_count(factory, repo_id)
 
     assert results.get("message") == failed_authentication_error, \
@@ -126,15 +129,16 @@ def test_failed_authentication(bad_registration_message, factory, \
         "Client count is incorrect!"
 
 def test_no_duplicate_client(library_registration_message, factory, \
-        dummy_client, duplicate_client_error, original_client_count):
+        dummy_client, duplicate_client_error, original_client_count, \
+        repo_state):
     """
     Test that a client cannot be registered twice.
     """
     repo_id = library_registration_message.repo_id
-    results = process_new_message(library_registration_message, factory, \
-        dummy_client)
-    results = process_new_message(library_registration_message, factory, \
-        dummy_client)
+    results = process_new_message(repo_state, library_registration_message, \
+        factory, dummy_client)
+    results = process_new_message(repo_state, library_registration_message, \
+        factory, dummy_client)
     new_client_count = _client_count(factory, repo_id)
     
     assert results.get("message") == duplicate_client_error, \
@@ -143,14 +147,15 @@ def test_no_duplicate_client(library_registration_message, factory, \
         "Client count is incorrect!"
 
 def test_only_one_dashboard_client(dashboard_registration_message, factory, \
-        dummy_client, only_one_dashboard_client_error, original_client_count):
+        dummy_client, only_one_dashboard_client_error, original_client_count, \
+        repo_state):
     """
     Test that more than one dashboard client cannot be registered at a time.
     """
     repo_id = dashboard_registration_message.repo_id
     assert _client_count(factory, repo_id) == original_client_count
-    results = process_new_message(dashboard_registration_message, factory, \
-        dummy_client)
+    results = process_new_message(repo_state, dashboard_registration_message, \
+        factory, dummy_client)
     new_client_count = _client_count(factory, repo_id)
 
     assert results.get("message") == only_one_dashboard_client_error, \
@@ -158,6 +163,32 @@ def test_only_one_dashboard_client(dashboard_registration_message, factory, \
     assert new_client_count == original_client_count, \
         "Client count is incorrect!"
 
+def test_concurrent_registration(factory, repo_id, original_client_count):
+    """
+    Test that clients can be registered from several threads at once, and
+    that the clients handed out are a copy.
+    """
+    clients = [CloudNodeProtocol() for _ in range(40)]
+    threads = [threading.Thread(target=factory.register, \
+            args=(client, ClientType.LIBRARY, repo_id)) \
+        for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert _client_count(factory, repo_id) == original_client_count + 40, \
+        "Client count is incorrect!"
+
+    repo_clients = factory.get_clients(repo_id)
+    repo_clients[ClientType.LIBRARY].clear()
+    assert _client_count(factory, repo_id) == original_client_count + 40, \
+        "Clients handed out should be a copy!"
+
+    for client in clients:
+        assert factory.unregister(client)[0], "Unregistration failed!"
+    assert _client_count(factory, repo_id) == original_client_count, \
+        "Client count is incorrect!"
+
 def _client_count(factory, repo_id):
     """
     Helper function to count the total number of clients in the factory.
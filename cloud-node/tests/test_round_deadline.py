@@ -0,0 +1,117 @@
+import time
+from copy import deepcopy
+
+import pytest
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+
+import state
+from aggregator import check_continuation_criteria, handle_round_deadline
+from coordinator import _round_deadlines
+from message import Message, ActionType
+
+
+@pytest.fixture
+def deadline_criteria():
+    return {
+        "type": "ANY_OF",
+        "criteria": [
+            {"type": "PERCENTAGE_AVERAGED", "value": 0.75},
+            {"type": "ROUND_DEADLINE", "value": 30},
+        ],
+    }
+
+@pytest.fixture
+def deadline_state(repo_state, session_message, session_id, deadline_criteria):
+    message = deepcopy(session_message)
+    message["library_type"] = "PYTHON"
+    message["continuation_criteria"] = deadline_criteria
+    repo_state.update({
+        "busy": True,
+        "session_id": session_id,
+        "current_round": 1,
+        "initial_message": Message.make(message),
+        "num_nodes_chosen": 8,
+        "num_nodes_averaged": 0,
+        "round_start_time": time.time(),
+    })
+    return repo_state
+
+def test_round_deadline(deadline_state):
+    """
+    Test that the round is only closed at its deadline if at least one node
+    was averaged.
+    """
+    assert not check_continuation_criteria(deadline_state), \
+        "Round closed before its deadline!"
+
+    deadline_state["round_start_time"] -= 31
+    assert not check_continuation_criteria(deadline_state), \
+        "Round closed without any update!"
+
+    deadline_state["num_nodes_averaged"] = 1
+    assert check_continuation_criteria(deadline_state), \
+        "Round not closed at its deadline!"
+
+def test_compound_criteria(deadline_state):
+    """
+    Test the `NUM_NODES_AVERAGED`, `ANY_OF` and `ALL_OF` criteria.
+    """
+    criteria = deadline_state["initial_message"].continuation_criteria
+    deadline_state["num_nodes_averaged"] = 6
+    assert check_continuation_criteria(deadline_state), \
+        "Any of the criteria should be enough!"
+
+    criteria["type"] = "ALL_OF"
+    assert not check_continuation_criteria(deadline_state), \
+        "All of the criteria should be needed!"
+
+    criteria.clear()
+    criteria.update({"type": "NUM_NODES_AVERAGED", "value": 20})
+    assert not check_continuation_criteria(deadline_state), \
+        "Round closed before every chosen node was averaged!"
+    deadline_state["num_nodes_averaged"] = 8
+    assert check_continuation_criteria(deadline_state), \
+        "Number of nodes should be capped by the nodes chosen!"
+
+def test_round_deadlines(deadline_criteria):
+    """
+    Test that the deadlines of nested criteria are found.
+    """
+    criteria = {"type": "ALL_OF", "criteria": [deadline_criteria, \
+        {"type": "ROUND_DEADLINE", "value": 60}]}
+    assert sorted(_round_deadlines(criteria)) == [30, 60], \
+        "Wrong round deadlines!"
+
+def test_stale_deadline(deadline_state, factory, repo_id, session_id):
+    """
+    Test that the deadline of another round or session is ignored.
+    """
+    deadline_state["round_start_time"] -= 31
+    deadline_state["num_nodes_averaged"] = 1
+    clients_dict = factory.clients[repo_id]
+    for stale_session_id, stale_round in [(session_id, 0), ("other", 1)]:
+        results = handle_round_deadline(deadline_state, stale_session_id, \
+            stale_round, clients_dict)
+        assert results["action"] == ActionType.DO_NOTHING, \
+            "Stale deadline closed the round!"
+        assert deadline_state["current_round"] == 1, "Round changed!"
+
+def test_reset_cancels_round(factory, repo_id, monkeypatch):
+    """
+    Test that resetting the state of a repo cancels its round deadlines and
+    the waves of its round that weren't sent yet.
+    """
+    clock = Clock()
+    monkeypatch.setattr(factory.broadcaster, "clock", clock)
+    monkeypatch.setattr(reactor, "callFromThread", \
+        lambda f, *args: f(*args))
+    factory.broadcaster.dispatch({"round": 1}, \
+        [{"delay": 1, "clients": []}], repo_id)
+    deadline = clock.callLater(30, lambda: None)
+    factory.round_timers[repo_id] = [deadline]
+
+    state.reset_state(repo_id)
+    assert not deadline.active(), "Round deadline not cancelled!"
+    assert not factory.broadcaster.stats()["dispatch"]["pending_dispatches"], \
+        "Waves not cancelled!"
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from accumulator import WeightedAccumulator
+from aggregator import _read_running_weighted_average
+from server_optimizer import ServerOptimizer, check_server_optimizer
+
+
+@pytest.fixture
+def pseudo_gradients():
+    rng = np.random.RandomState(0)
+    return [[rng.randn(3, 2).astype(np.float32), rng.randn(2).astype(np.float32)] \
+        for _ in range(3)]
+
+def _reference_steps(pseudo_gradients, optimizer_type, lr=0.01, beta_1=0.9, \
+        beta_2=0.99, epsilon=1e-3):
+    m = [np.zeros_like(layer) for layer in pseudo_gradients[0]]
+    v = [np.full_like(layer, epsilon ** 2) for layer in pseudo_gradients[0]]
+    for layers in pseudo_gradients:
+        steps = []
+        for i, g in enumerate(layers):
+            m[i] = beta_1 * m[i] + (1 - beta_1) * g
+            if optimizer_type == "ADAM":
+                v[i] = beta_2 * v[i] + (1 - beta_2) * g ** 2
+            else:
+                v[i] = v[i] - (1 - beta_2) * g ** 2 * np.sign(v[i] - g ** 2)
+            steps.append(lr * m[i] / (np.sqrt(v[i]) + epsilon))
+        yield steps
+
+def test_sgd(pseudo_gradients):
+    """
+    Test that SGD without momentum applies the update as is, and that
+    momentum accumulates the updates.
+    """
+    optimizer = ServerOptimizer({"type": "SGD"})
+    for layers in pseudo_gradients:
+        for step, layer in zip(optimizer.step(layers), layers):
+            assert np.allclose(step, layer), "Update should be applied as is!"
+
+    optimizer = ServerOptimizer({"type": "SGD", "momentum": 0.5, \
+        "learning_rate": 2})
+    first, second = pseudo_gradients[:2]
+    optimizer.step(first)
+    step = optimizer.step(second)
+    assert np.allclose(step[0], 2 * (0.5 * first[0] + second[0])), \
+        "Momentum not accumulated!"
+
+@pytest.mark.parametrize("optimizer_type", ["ADAM", "YOGI"])
+def test_adaptive(pseudo_gradients, optimizer_type):
+    """
+    Test that the adaptive optimizers match their update rules, with their
+    moments kept in float32.
+    """
+    optimizer = ServerOptimizer({"type": optimizer_type})
+    expected_steps = _reference_steps(pseudo_gradients, optimizer_type)
+    for layers, expected in zip(pseudo_gradients, expected_steps):
+        for step, expected_step in zip(optimizer.step(layers), expected):
+            assert np.allclose(step, expected_step, rtol=1e-4), \
+                "Wrong {} step!".format(optimizer_type)
+    assert all(v.dtype == np.float32 for v in optimizer._v), \
+        "Moments should be float32!"
+
+def test_averaged_weights(repo_state):
+    """
+    Test that when the libraries average weights, the optimizer steps on the
+    difference between the previous weights and the averaged ones.
+    """
+    previous_weights = np.full(4, 2, dtype=np.float32)
+    accumulator = WeightedAccumulator()
+    accumulator.add(np.ones(4, dtype=np.float32), 1)
+    repo_state.update({
+        "use_gradients": False,
+        "library_type": "JAVASCRIPT",
+        "current_weights": previous_weights,
+        "accumulator": accumulator,
+        "server_optimizer": ServerOptimizer({"type": "SGD", \
+            "learning_rate": 0.5}),
+    })
+    _read_running_weighted_average(repo_state)
+    assert np.allclose(repo_state["current_weights"], 1.5), \
+        "Optimizer step not taken from the previous weights!"
+
+def test_invalid_config(pseudo_gradients):
+    """
+    Test that unsupported optimizers and mismatched updates are rejected.
+    """
+    with pytest.raises(ValueError):
+        check_server_optimizer({"type": "RMSPROP"})
+
+    optimizer = ServerOptimizer({"type": "ADAM"})
+    optimizer.step(pseudo_gradients[0])
+    with pytest.raises(ValueError):
+        optimizer.step(pseudo_gradients[0][:1])
@@ -0,0 +1,126 @@
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+import state
+import aggregator
+from accumulator import WeightedAccumulator
+from message import Message
+
+
+@pytest.fixture
+def other_repo_id():
+    return "other-test-repo"
+
+@pytest.fixture(autouse=True)
+def reset_other_repo(other_repo_id):
+    yield
+    other_state = state.start_state(other_repo_id)
+    state.reset_state(other_repo_id)
+    state.stop_state(other_state)
+
+def test_snapshot_published_on_release(other_repo_id, session_id):
+    """
+    Test that the serving snapshot is only published once the repo's lock is
+    released, and that it can be found by session ID.
+    """
+    other_state = state.start_state(other_repo_id)
+    other_state["busy"] = True
+    other_state["session_id"] = session_id
+    other_state["library_type"] = "JAVASCRIPT"
+    other_state["tfjs_model_path"] = "temp/model"
+
+    assert state.get_snapshot_by_session_id(session_id) is None, \
+        "Snapshot shouldn't be published yet!"
+
+    state.stop_state(other_state)
+    snapshot = state.get_snapshot_by_session_id(session_id)
+
+    assert snapshot and snapshot.busy, "Snapshot not published!"
+    assert snapshot.repo_id == other_repo_id, "Wrong repo in snapshot!"
+    assert snapshot.tfjs_model_path == "temp/model", "Wrong model path!"
+
+def test_session_removed_on_reset(other_repo_id, session_id):
+    """
+    Test that the session is removed from the index when the repo is reset.
+    """
+    other_state = state.start_state(other_repo_id)
+    other_state["busy"] = True
+    other_state["session_id"] = session_id
+    state.stop_state(other_state)
+
+    other_state = state.start_state(other_repo_id)
+    state.reset_state(other_repo_id)
+    state.stop_state(other_state)
+
+    assert state.get_snapshot_by_session_id(session_id) is None, \
+        "Session should have been removed!"
+    assert not state.get_snapshot(other_repo_id).busy, \
+        "Repo shouldn't be busy!"
+
+def test_materialized_once_per_round(repo_state, factory, session_message, \
+        session_id, repo_id, monkeypatch):
+    """
+    Test that the model is materialized exactly once per round, however many
+    updates the round gets, and that the counters are published with the
+    snapshot.
+    """
+    monkeypatch.setattr(aggregator, "swap_weights", lambda repo_state: None)
+    monkeypatch.setattr(aggregator, "store_update", lambda *args: None)
+    message = deepcopy(session_message)
+    message["library_type"] = "PYTHON"
+    repo_state.update({
+        "busy": True,
+        "session_id": session_id,
+        "current_round": 1,
+        "num_nodes_chosen": 3,
+        "initial_message": Message.make(message),
+        "library_type": "PYTHON",
+        "use_gradients": True,
+        "checkpoint_frequency": 1,
+    })
+
+    for round in (1, 2):
+        for _ in range(3):
+            aggregator.handle_new_update(repo_state, Message.make({
+                "type": "NEW_UPDATE",
+                "repo_id": repo_id,
+                "session_id": session_id,
+                "round": round,
+                "results": {
+                    "omega": 1,
+                    "gradients": [np.ones(3, dtype=np.float32).tolist()],
+                },
+            }), factory.get_clients(repo_id))
+        repo_state["num_nodes_chosen"] = 3
+    state.publish_snapshot(repo_id)
+
+    assert repo_state["num_materializations"] == {1: 1, 2: 1}, \
+        "Model should be materialized once per round!"
+    assert state.get_snapshot(repo_id).materializations == {
+        "rounds": 2,
+        "materializations": 2,
+        "max_per_round": 1,
+    }, "Wrong materialization counters published!"
+
+def test_state_repr(repo_state):
+    """
+    Test that the state is summarized without the payloads of its tensors,
+    buffers and collections.
+    """
+    accumulator = WeightedAccumulator()
+    accumulator.add([np.ones((300, 300), dtype=np.float32)], 1)
+    repo_state.update({
+        "current_weights": [np.zeros((300, 300), dtype=np.float32)],
+        "delta": state.ModelDelta(round=1, sha256="abc", \
+            payload=bytes(100000)),
+        "accumulator": accumulator,
+        "session_id": "session",
+    })
+
+    summary = repr(repo_state)
+    assert len(summary) < 2000, "State not summarized!"
+    assert "'session_id': 'session'" in summary, "Scalars not kept!"
+    assert "payload=<100000 bytes>" in summary, "Delta not summarized!"
+    assert "layers=1" in summary, "Accumulator not summarized!"
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+import numpy as np
+
+from message import LateUpdateError
+from stream_decoder import UpdateStreamDecoder
+
+
+@pytest.fixture
+def gradients():
+    return [np.random.rand(30, 40).astype(np.float32), \
+        np.random.rand(40).astype(np.float32)]
+
+@pytest.fixture
+def payload(gradients):
+    message = {
+        "type": "NEW_UPDATE",
+        "session_id": "test-session",
+        "results": {
+            "omega": 2,
+            "gradients": [gradient.tolist() for gradient in gradients],
+        },
+        "round": 1,
+    }
+    return json.dumps(message).encode()
+
+def _decode(payload, chunk_size, layout=None):
+    decoder = UpdateStreamDecoder(lambda session_id: layout)
+    for i in range(0, len(payload), chunk_size):
+        decoder.feed(payload[i:i+chunk_size])
+    return decoder.close()
+
+@pytest.mark.parametrize("chunk_size", [13, 1024, 1 << 20])
+def test_streamed_gradients(payload, gradients, chunk_size):
+    """
+    Test that the gradients are decoded correctly, however the payload is
+    split, with and without a known layout.
+    """
+    layout = [gradient.shape for gradient in gradients]
+    for decoded in (_decode(payload, chunk_size), \
+            _decode(payload, chunk_size, layout)):
+        assert decoded["results"]["omega"] == 2, "Message not decoded!"
+        for expected, actual in zip(gradients, decoded["results"]["gradients"]):
+            assert actual.dtype == np.float32, "Wrong dtype!"
+            assert np.array_equal(actual, expected), "Wrong gradients!"
+
+def test_wrong_layout(payload):
+    """
+    Test that an update that doesn't match the session's layout is rejected.
+    """
+    with pytest.raises(ValueError):
+        _decode(payload, 1024, [(40, 30), (40,)])
+
+def test_late_update(payload):
+    """
+    Test that an update for a round that isn't current is rejected once its
+    round is known, before its arrays are decoded.
+    """
+    message = json.loads(payload.decode())
+    # NOTE: The round goes before the results, like the libraries send it.
+    results = message.pop("results")
+    message["results"] = results
+    payload = json.dumps(message).encode()
+
+    rounds = []
+    def accepts_round(session_id, round):
+        rounds.append((session_id, round))
+        return False
+    decoder = UpdateStreamDecoder(accepts_round=accepts_round)
+    results_start = payload.index(b'"results"')
+    decoder.feed(payload[:results_start + 20])
+    assert isinstance(decoder.error, LateUpdateError), "Late update accepted!"
+    assert decoder._regions == {}, "Late update decoded!"
+    assert rounds == [("test-session", 1)], "Wrong round checked!"
+    with pytest.raises(LateUpdateError):
+        decoder.close()
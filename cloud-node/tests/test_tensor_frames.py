@@ -0,0 +1,80 @@
+import json
+import os
+import importlib.util
+
+import numpy as np
+
+import tensor_frames
+from tensor_frames import encode_frame, decode_frame, encode_json, has_tensors
+
+
+def test_frame_round_trip():
+    """
+    Test that a message with tensors survives a binary frame round trip.
+    """
+    gradients = [np.random.rand(3, 5).astype(np.float32), \
+        np.random.rand(5).astype(np.float32)]
+    message = {
+        "type": "NEW_UPDATE",
+        "round": 1,
+        "results": {"omega": 2, "gradients": gradients},
+    }
+
+    assert has_tensors(message), "Tensors not found!"
+    decoded = decode_frame(encode_frame(message))
+
+    assert decoded["type"] == "NEW_UPDATE", "Message not decoded correctly!"
+    assert decoded["results"]["omega"] == 2, "Message not decoded correctly!"
+    for expected, actual in zip(gradients, decoded["results"]["gradients"]):
+        assert actual.shape == expected.shape, "Wrong tensor shape!"
+        assert np.array_equal(actual, expected), "Wrong tensor values!"
+
+def test_json_fallback():
+    """
+    Test that tensors are encoded as lists for JSON clients.
+    """
+    message = {"gradients": [np.ones(2, dtype=np.float32)], "round": 1}
+    decoded = json.loads(encode_json(message).decode())
+
+    assert decoded == {"gradients": [[1.0, 1.0]], "round": 1}, \
+        "Message not encoded correctly!"
+    assert not has_tensors(decoded), "Lists shouldn't be tensors!"
+
+def test_parity_with_datacenter():
+    """
+    Test that frames round trip between this module and the datacenter
+    library's copy of it, in both directions.
+    """
+    path = os.path.join(os.path.dirname(tensor_frames.__file__), "..", \
+        "datacenter", "core", "utils", "tensor_frames.py")
+    spec = importlib.util.spec_from_file_location("datacenter_tensor_frames", \
+        path)
+    datacenter_frames = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(datacenter_frames)
+
+    message = {
+        "type": "NEW_UPDATE",
+        "round": 3,
+        "results": {
+            "omega": 2,
+            "gradients": [np.random.rand(3, 5).astype(np.float32), \
+                np.random.rand(7).astype(np.float16)],
+            "quantized": np.arange(-5, 6, dtype=np.int8),
+        },
+    }
+    frame = encode_frame(message)
+    assert datacenter_frames.encode_frame(message) == frame, \
+        "The copies encode frames differently!"
+
+    for decode, other_frame in [(datacenter_frames.decode_frame, frame), \
+            (decode_frame, datacenter_frames.encode_frame(message))]:
+        decoded = decode(other_frame)
+        assert decoded["round"] == 3, "Message not decoded correctly!"
+        assert decoded["results"]["omega"] == 2, \
+            "Message not decoded correctly!"
+        for expected, actual in zip(message["results"]["gradients"], \
+                decoded["results"]["gradients"]):
+            assert actual.dtype == expected.dtype, "Wrong tensor dtype!"
+            assert np.array_equal(actual, expected), "Wrong tensor values!"
+        assert np.array_equal(decoded["results"]["quantized"], \
+            message["results"]["quantized"]), "Wrong tensor values!"
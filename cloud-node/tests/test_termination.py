@@ -0,0 +1,134 @@
+import time
+from collections import deque
+from copy import deepcopy
+
+import numpy as np
+import pytest
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+
+import state
+from aggregator import check_termination_criteria, handle_session_deadline, \
+    _record_update_metrics, _record_round_metrics, _norm
+from coordinator import _wall_clock_budgets
+from message import Message, ActionType
+
+
+@pytest.fixture
+def termination_state(repo_state, session_id):
+    repo_state.update({
+        "busy": True,
+        "session_id": session_id,
+        "current_round": 2,
+        "session_start_time": time.time(),
+        "metric_history": deque(),
+    })
+    return repo_state
+
+def _set_criteria(repo_state, session_message, termination_criteria):
+    message = deepcopy(session_message)
+    message["library_type"] = "PYTHON"
+    message["termination_criteria"] = termination_criteria
+    repo_state["initial_message"] = Message.make(message)
+
+def _add_round(repo_state, loss, update_norm=1.0):
+    repo_state["metric_history"].append(state.RoundMetrics(
+        round=len(repo_state["metric_history"]) + 1, num_updates=1, \
+        loss=loss, accuracy=None, update_norm=update_norm, elapsed=0))
+
+def test_round_metrics(termination_state):
+    """
+    Test that the metrics reported with the updates of a round are averaged
+    with their omegas into the metric history.
+    """
+    class FakeUpdate(object):
+        def __init__(self, omega, metrics):
+            self.omega, self.metrics = omega, metrics
+    _record_update_metrics(termination_state, FakeUpdate(1, {"loss": 1.0}))
+    _record_update_metrics(termination_state, FakeUpdate(3, {"loss": 2.0}))
+    _record_round_metrics(termination_state, _norm([np.full(4, 0.5)]))
+
+    row = termination_state["metric_history"][-1]
+    assert row.round == 2 and row.num_updates == 2, "Wrong round recorded!"
+    assert row.loss == pytest.approx(1.75), "Loss not averaged with omegas!"
+    assert row.accuracy is None, "Accuracy wasn't reported!"
+    assert row.update_norm == pytest.approx(1.0), "Wrong update norm!"
+    assert not termination_state["round_metrics"], "Round metrics not reset!"
+
+def test_plateau(termination_state, session_message):
+    """
+    Test that the session stops once the loss stops improving for `patience`
+    rounds.
+    """
+    _set_criteria(termination_state, session_message, \
+        {"type": "PLATEAU", "metric": "loss", "patience": 2, "min_delta": 0.01})
+    for loss in (1.0, 0.5, 0.495):
+        _add_round(termination_state, loss)
+        assert not check_termination_criteria(termination_state), \
+            "Session stopped while improving!"
+
+    _add_round(termination_state, 0.499)
+    assert check_termination_criteria(termination_state), \
+        "Session not stopped on a plateau!"
+
+def test_update_norm_and_wall_clock(termination_state, session_message):
+    """
+    Test the `UPDATE_NORM` and `WALL_CLOCK` criteria, combined with `ANY_OF`.
+    """
+    _set_criteria(termination_state, session_message, {
+        "type": "ANY_OF",
+        "criteria": [
+            {"type": "MAX_ROUND", "value": 100},
+            {"type": "UPDATE_NORM", "value": 0.1},
+            {"type": "WALL_CLOCK", "value": 60},
+        ],
+    })
+    _add_round(termination_state, None, update_norm=0.5)
+    assert not check_termination_criteria(termination_state), \
+        "Session stopped early!"
+
+    _add_round(termination_state, None, update_norm=0.05)
+    assert check_termination_criteria(termination_state), \
+        "Session not stopped on a small update!"
+
+    termination_state["metric_history"].clear()
+    termination_state["session_start_time"] -= 61
+    assert check_termination_criteria(termination_state), \
+        "Session not stopped after its wall-clock budget!"
+
+def test_wall_clock_budget(termination_state, session_message, factory, \
+        repo_id, session_id, monkeypatch):
+    """
+    Test that the session is stopped when its wall-clock budget expires,
+    without waiting for an update, and that its timers are cancelled.
+    """
+    criteria = {"type": "ALL_OF", "criteria": [
+        {"type": "ANY_OF", "criteria": [{"type": "WALL_CLOCK", "value": 60}]},
+        {"type": "WALL_CLOCK", "value": 30},
+    ]}
+    assert _wall_clock_budgets(criteria) == [30, 60], \
+        "Wrong wall-clock budgets!"
+
+    _set_criteria(termination_state, session_message, criteria)
+    monkeypatch.setattr(reactor, "callFromThread", \
+        lambda f, *args: f(*args))
+    budget = Clock().callLater(60, lambda: None)
+    factory.session_timers[repo_id] = [budget]
+    clients_dict = factory.clients[repo_id]
+
+    termination_state["session_start_time"] -= 45
+    results = handle_session_deadline(termination_state, session_id, \
+        clients_dict)
+    assert results["action"] == ActionType.DO_NOTHING, \
+        "Session stopped before all of its budgets expired!"
+
+    termination_state["session_start_time"] -= 30
+    results = handle_session_deadline(termination_state, "other", \
+        clients_dict)
+    assert results["action"] == ActionType.DO_NOTHING, \
+        "Budget of another session stopped the session!"
+
+    results = handle_session_deadline(termination_state, session_id, \
+        clients_dict)
+    assert results["message"]["action"] == "STOP", "Session not stopped!"
+    assert not budget.active(), "Wall-clock budget not cancelled!"
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from tfjs_writer import reorder_weights
+
+
+def test_reorder_weights():
+    """
+    Test that weights are matched by name, ignoring the `:0` suffix of the
+    names in h5 models.
+    """
+    kernel, bias = np.ones((3, 2)), np.zeros(2)
+    weights = reorder_weights([bias, kernel], \
+        ["dense_1/bias:0", "dense_1/kernel:0"], \
+        ["dense_1/kernel", "dense_1/bias"])
+    assert weights[0] is kernel and weights[1] is bias, \
+        "Weights not in manifest order!"
+
+def test_mismatched_weight_names():
+    """
+    Test that weights whose names don't match the manifest are rejected.
+    """
+    with pytest.raises(ValueError):
+        reorder_weights([np.ones(2), np.ones(2)], \
+            ["dense_1/kernel:0", "dense_1/bias:0"], \
+            ["dense_2/kernel", "dense_2/bias"])
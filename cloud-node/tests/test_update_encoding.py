@@ -0,0 +1,67 @@
+import os
+import importlib.util
+
+import pytest
+import numpy as np
+
+import update_encoding
+from update_encoding import encode_update, decode_update
+
+
+@pytest.fixture
+def gradients():
+    return [np.random.randn(20, 10).astype(np.float32), \
+        np.random.rand(10).astype(np.float32) + 1, np.zeros(3, np.float32)]
+
+@pytest.mark.parametrize("encoding, dtype", [("float32", np.float32), \
+    ("float16", np.float16), ("int8", np.int8)])
+def test_round_trip(gradients, encoding, dtype):
+    """
+    Test that every layer is encoded in the right dtype and decoded within
+    the precision of the encoding.
+    """
+    encoded, params = encode_update(gradients, encoding)
+    decoded = decode_update(encoded, **params)
+
+    for i, (gradient, layer) in enumerate(zip(gradients, decoded)):
+        assert encoded[i].dtype == dtype, "Layer encoded in the wrong dtype!"
+        assert layer.dtype == np.float32, "Layer decoded in the wrong dtype!"
+        tolerance = params["scales"][i] / 2 if encoding == "int8" \
+            else np.abs(gradient).max() / 1000
+        assert np.allclose(layer, gradient, rtol=0, atol=tolerance + 1e-7), \
+            "Layer not decoded correctly!"
+
+def test_unsupported_encoding(gradients):
+    """
+    Test that unknown encodings are rejected.
+    """
+    with pytest.raises(ValueError):
+        encode_update(gradients, "int4")
+
+@pytest.mark.parametrize("encoding", ["float32", "float16", "int8"])
+def test_parity_with_datacenter(gradients, encoding):
+    """
+    Test that updates round trip between this module and the datacenter
+    library's copy of it, in both directions.
+    """
+    path = os.path.join(os.path.dirname(update_encoding.__file__), "..", \
+        "datacenter", "core", "utils", "update_encoding.py")
+    spec = importlib.util.spec_from_file_location( \
+        "datacenter_update_encoding", path)
+    datacenter_encoding = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(datacenter_encoding)
+
+    encoded, params = datacenter_encoding.encode_update(gradients, encoding)
+    expected_encoded, expected_params = encode_update(gradients, encoding)
+    for layer, expected in zip(encoded, expected_encoded):
+        assert layer.tobytes() == expected.tobytes(), \
+            "The copies encode updates differently!"
+    assert params.keys() == expected_params.keys(), \
+        "The copies encode updates differently!"
+
+    decoded = decode_update(encoded, **params)
+    expected_decoded = datacenter_encoding.decode_update(expected_encoded, \
+        **expected_params)
+    for layer, expected in zip(decoded, expected_decoded):
+        assert layer.tobytes() == expected.tobytes(), \
+            "The copies decode updates differently!"
@@ -0,0 +1,70 @@
+import hashlib
+
+import pytest
+
+from uploads import UploadStore
+
+
+@pytest.fixture
+def payload():
+    return bytes(range(256)) * 10
+
+@pytest.fixture
+def sha256(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+def _chunks(payload, chunk_size):
+    return [payload[i:i+chunk_size] for i in range(0, len(payload), chunk_size)]
+
+def test_resumed_upload(repo_id, payload, sha256):
+    """
+    Test that an upload can be resumed by beginning it again, and only the
+    missing chunks have to be sent.
+    """
+    uploads = UploadStore()
+    chunks = _chunks(payload, 1000)
+    upload = uploads.begin(repo_id, sha256, len(payload), 1000, False)
+    upload.write(0, chunks[0])
+
+    upload = uploads.begin(repo_id, sha256, len(payload), 1000, False)
+    assert upload.missing() == [1, 2], "Wrong missing chunks!"
+
+    upload.write(2, chunks[2])
+    upload.write(1, chunks[1])
+    assert upload.complete, "Upload should be complete!"
+    assert bytes(upload.payload()) == payload, "Upload not reassembled!"
+
+def test_corrupted_upload(repo_id, payload, sha256):
+    """
+    Test that an upload that doesn't match its hash is rejected.
+    """
+    uploads = UploadStore()
+    upload = uploads.begin(repo_id, sha256, len(payload), len(payload), False)
+    upload.write(0, bytes(len(payload)))
+
+    with pytest.raises(ValueError):
+        upload.payload()
+
+def test_wrong_chunk_size(repo_id, payload, sha256):
+    """
+    Test that chunks of the wrong size are rejected.
+    """
+    uploads = UploadStore()
+    upload = uploads.begin(repo_id, sha256, len(payload), 1000, False)
+
+    with pytest.raises(ValueError):
+        upload.write(2, payload[:1000])
+
+def test_staged_size_cap(repo_id, payload, sha256):
+    """
+    Test that an upload is rejected if the pending uploads would hold too many
+    bytes, and accepted again once they're discarded.
+    """
+    uploads = UploadStore(max_staged_size=len(payload) + 100)
+    uploads.begin(repo_id, sha256, len(payload), 1000, False)
+
+    with pytest.raises(ValueError):
+        uploads.begin(repo_id, "other", 200, 100, False)
+
+    uploads.discard(repo_id, sha256)
+    uploads.begin(repo_id, "other", 200, 100, False)
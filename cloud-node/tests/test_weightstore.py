@@ -0,0 +1,44 @@
+import os
+
+import pytest
+import numpy as np
+from keras.models import load_model
+
+from weightstore import H5WeightStore
+
+
+@pytest.fixture(scope="module")
+def weight_store(h5_model_path):
+    return H5WeightStore(h5_model_path)
+
+def test_get_weights(weight_store, h5_model_path):
+    """
+    Test that the weights are read in the same order as Keras' `get_weights()`.
+    """
+    expected_weights = load_model(h5_model_path).get_weights()
+    actual_weights = weight_store.get_weights(h5_model_path)
+
+    assert len(expected_weights) == len(actual_weights), \
+        "Wrong number of weights!"
+    for expected_weight, actual_weight in zip(expected_weights, actual_weights):
+        assert np.array_equal(expected_weight, actual_weight), \
+            "Weights not read correctly!"
+
+def test_save_weights(weight_store, h5_model_path, tmpdir):
+    """
+    Test that new weights are written to a copy of the model that Keras can
+    load, and that the old model is left untouched.
+    """
+    old_weights = weight_store.get_weights(h5_model_path)
+    new_weights = [weight - 1 for weight in old_weights]
+    new_h5_model_path = os.path.join(str(tmpdir), "model1.h5")
+
+    weight_store.save_weights(h5_model_path, new_h5_model_path, new_weights)
+
+    saved_weights = load_model(new_h5_model_path).get_weights()
+    for new_weight, saved_weight in zip(new_weights, saved_weights):
+        assert np.allclose(new_weight, saved_weight), \
+            "Weights not written correctly!"
+    for old_weight, weight in zip(old_weights, \
+            weight_store.get_weights(h5_model_path)):
+        assert np.array_equal(old_weight, weight), "Old model was modified!"
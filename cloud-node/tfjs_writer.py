@@ -0,0 +1,185 @@
+import os
+import json
+import math
+
+import numpy as np
+
+
+SHARD_SIZE_BYTES = 4 * 1024 * 1024
+
+class TFJSWriter(object):
+    """
+    Writes tf.js models straight from numpy weights, reusing the topology and
+    the weights manifest produced by the tf.js converter at the beginning of
+    the session.
+
+    Only the binary weight shards (and the quantization parameters in
+    `model.json`) change between rounds, so the Keras model never has to be
+    loaded or reconverted after the first round.
+
+    The shards follow the layout of `tensorflowjs.write_weights`: the bytes of
+    every weight of a group are concatenated (in manifest order) and split
+    into 4MB shards. Weights that were quantized by the converter are
+    quantized the same way.
+
+    Args:
+        model_json_path (str): Path to the `model.json` produced by the
+            tf.js converter.
+    """
+
+    def __init__(self, model_json_path):
+        with open(model_json_path, 'r') as fp:
+            self.model_json = json.load(fp)
+        self.weights_manifest = self.model_json["weightsManifest"]
+
+    @property
+    def weights_shape(self):
+        """
+        The manifest entries (name, shape, dtype) of every weight, in order.
+        """
+        return [entry for group in self.weights_manifest \
+            for entry in group["weights"]]
+
+    @property
+    def weight_names(self):
+        """
+        The names of every weight, in manifest order.
+        """
+        return [entry["name"] for entry in self.weights_shape]
+
+    def write(self, weights, tfjs_model_path):
+        """
+        Write the weight shards and `model.json` of a new tf.js model.
+
+        Args:
+            weights (list or np.ndarray): The weights of the model, either as
+                a list of arrays or as a flat array, in manifest order.
+            tfjs_model_path (str): The folder to write the model to.
+        """
+        if not os.path.isdir(tfjs_model_path):
+            os.makedirs(tfjs_model_path)
+
+        weights = self._split_weights(weights)
+        for group_index, group in enumerate(self.weights_manifest):
+            group_weights = [next(weights) for _ in group["weights"]]
+            group_bytes = b"".join(
+                self._serialize_entry(entry, weight).tobytes() \
+                    for entry, weight in zip(group["weights"], group_weights))
+            group["paths"] = _write_shards(tfjs_model_path, group_index, \
+                group_bytes)
+
+        model_json_path = os.path.join(tfjs_model_path, "model.json")
+        with open(model_json_path, 'w') as fp:
+            json.dump(self.model_json, fp)
+
+    def _split_weights(self, weights):
+        """
+        Yield the weights one by one, slicing them out of a flat array if
+        necessary.
+        """
+        if isinstance(weights, np.ndarray) and weights.dtype != object:
+            start = 0
+            for entry in self.weights_shape:
+                size = int(np.prod(entry["shape"]))
+                yield weights[start:start+size]
+                start += size
+        else:
+            for weight in weights:
+                yield weight
+
+    def _serialize_entry(self, entry, weight):
+        """
+        Convert a weight into the array to write for its manifest entry,
+        quantizing it (and updating the entry) if necessary.
+        """
+        data = np.asarray(weight, dtype=np.dtype(entry["dtype"]))
+        if data.size != int(np.prod(entry["shape"])):
+            raise ValueError("Weight {0} has {1} values, expected shape {2}!" \
+                .format(entry["name"], data.size, entry["shape"]))
+
+        quantization = entry.get("quantization")
+        if not quantization:
+            return data
+
+        quantized, scale, min_val = quantize_weights(data, \
+            np.dtype(quantization["dtype"]))
+        quantization["scale"] = scale
+        quantization["min"] = min_val
+        return quantized
+
+def reorder_weights(weights, names, new_names):
+    """
+    Reorder a list of weights, matching them by name (e.g. from the order of
+    the h5 model's datasets into manifest order, or the other way around).
+
+    The names are compared without their `:0` suffix, which Keras keeps in h5
+    models and the tf.js converter drops.
+
+    Args:
+        weights (list): The weights.
+        names (list): The names of the weights, in the same order.
+        new_names (list): The names of the weights, in the new order.
+
+    Returns:
+        list: The weights in the new order.
+    """
+    weights_by_name = dict(zip(map(_base_name, names), weights))
+    if len(weights_by_name) != len(weights) \
+            or set(weights_by_name) != set(map(_base_name, new_names)):
+        raise ValueError("The names of the weights don't match: {0} vs {1}!" \
+            .format(list(names), list(new_names)))
+    return [weights_by_name[_base_name(name)] for name in new_names]
+
+def _base_name(name):
+    """
+    Strip the `:<index>` suffix of a weight name.
+    """
+    return name.rsplit(":", 1)[0]
+
+def quantize_weights(data, quantization_dtype):
+    """
+    Quantize the weights by linearly re-scaling them across the bits of
+    `quantization_dtype`, nudging the range so that 0 is represented exactly
+    (same as `tensorflowjs.quantization.quantize_weights`).
+
+    Args:
+        data (np.ndarray): The weights to quantize.
+        quantization_dtype (np.dtype): `uint8` or `uint16`.
+
+    Returns:
+        tuple: The quantized data, the scale and the minimum of the range.
+    """
+    min_val = float(data.min())
+    max_val = float(data.max())
+    if min_val == max_val:
+        return np.zeros(data.shape, dtype=quantization_dtype), 1.0, min_val
+
+    quant_max = np.iinfo(quantization_dtype).max
+    scale = (max_val - min_val) / quant_max
+    if min_val <= 0 <= max_val:
+        min_val = float(-np.round(-min_val / scale) * scale)
+        max_val = quant_max * scale + min_val
+
+    quantized = np.clip(data, min_val, max_val)
+    quantized -= min_val
+    quantized /= scale
+    return np.round(quantized).astype(quantization_dtype), scale, min_val
+
+def _write_shards(tfjs_model_path, group_index, group_bytes):
+    """
+    Split the bytes of a weight group into shards and write them to disk.
+
+    Returns:
+        list: The filenames of the shards.
+    """
+    num_shards = max(int(math.ceil(len(group_bytes) / SHARD_SIZE_BYTES)), 1)
+    group_view = memoryview(group_bytes)
+    paths = []
+    for i in range(num_shards):
+        filename = "group{0}-shard{1}of{2}.bin".format(group_index + 1, i + 1, \
+            num_shards)
+        shard = group_view[i*SHARD_SIZE_BYTES:(i+1)*SHARD_SIZE_BYTES]
+        with open(os.path.join(tfjs_model_path, filename), 'wb') as fp:
+            fp.write(shard)
+        paths.append(filename)
+    return paths
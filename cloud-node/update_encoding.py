@@ -0,0 +1,141 @@
+import numpy as np
+
+
+# NOTE: The datacenter library keeps a copy of this module
+# (`datacenter/core/utils/update_encoding.py`), since the two are deployed
+# separately. Keep them in sync: `tests/test_update_encoding.py` checks that
+# updates round trip between both copies.
+DEFAULT_UPDATE_ENCODING = "float32"
+UPDATE_ENCODING_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "int8": np.int8,
+}
+INT8_MIN, INT8_MAX = -128, 127
+
+def check_encoding(encoding):
+    """
+    Make sure the update encoding is supported.
+
+    Args:
+        encoding (str): The update encoding.
+    """
+    if encoding not in UPDATE_ENCODING_DTYPES:
+        raise ValueError("Unsupported update encoding: {}!".format(encoding))
+
+def encode_update(update, encoding=DEFAULT_UPDATE_ENCODING):
+    """
+    Encode an update (gradients or weights) to be sent over the network.
+
+    With `float16`, every layer is cast to half precision. With `int8`, every
+    layer is quantized with its own affine mapping:
+
+        value = (quantized - zero_point) * scale
+
+    where `scale` and `zero_point` are chosen so that the range of the layer
+    (including 0, which is always represented exactly) spans the 256 levels.
+
+    Args:
+        update (list or np.ndarray): The update, either a list of arrays (one
+            per layer) or a single flat array.
+        encoding (str, optional): The update encoding. Defaults to `float32`.
+
+    Returns:
+        tuple: The encoded update (in the same layout) and its encoding
+            parameters: the `encoding`, and for `int8` the `scales` and
+            `zero_points` of every layer.
+    """
+    check_encoding(encoding)
+    flat = _is_flat(update)
+    layers = [update] if flat else update
+
+    params = {"encoding": encoding}
+    if encoding == "int8":
+        encoded, params["scales"], params["zero_points"] = [], [], []
+        for layer in layers:
+            quantized, scale, zero_point = _quantize(layer)
+            encoded.append(quantized)
+            params["scales"].append(scale)
+            params["zero_points"].append(zero_point)
+    else:
+        dtype = UPDATE_ENCODING_DTYPES[encoding]
+        encoded = [np.asarray(layer, dtype=dtype) for layer in layers]
+
+    return (encoded[0] if flat else encoded), params
+
+def decode_update(update, encoding=DEFAULT_UPDATE_ENCODING, scales=None, \
+        zero_points=None):
+    """
+    Decode an update encoded with `encode_update()` back into float32.
+
+    Args:
+        update (list or np.ndarray): The encoded update.
+        encoding (str, optional): The update encoding. Defaults to `float32`.
+        scales (list, optional): The scale of every layer (for `int8`).
+        zero_points (list, optional): The zero-point of every layer (for
+            `int8`).
+
+    Returns:
+        list or np.ndarray: The decoded update, in the same layout.
+    """
+    check_encoding(encoding)
+    flat = _is_flat(update)
+    layers = [update] if flat else update
+
+    dtype = UPDATE_ENCODING_DTYPES[encoding]
+    decoded = []
+    for i, layer in enumerate(layers):
+        layer = np.asarray(layer, dtype=dtype)
+        if encoding == "int8":
+            out = np.empty(layer.shape, dtype=np.float32)
+            decoded.append(dequantize(layer, scales[i], zero_points[i], out))
+        else:
+            decoded.append(np.asarray(layer, dtype=np.float32))
+
+    return decoded[0] if flat else decoded
+
+def dequantize(layer, scale, zero_point, out):
+    """
+    Dequantize an `int8` layer into `out`, without any temporary array.
+
+    Args:
+        layer (np.ndarray): The quantized layer.
+        scale (float): The scale of the layer.
+        zero_point (int): The zero-point of the layer.
+        out (np.ndarray): The float array to write to.
+
+    Returns:
+        np.ndarray: `out`.
+    """
+    np.subtract(layer, zero_point, out=out, dtype=out.dtype)
+    np.multiply(out, scale, out=out)
+    return out
+
+def _quantize(layer):
+    """
+    Quantize a layer into `int8`.
+
+    Returns:
+        tuple: The quantized layer, its scale and its zero-point.
+    """
+    layer = np.asarray(layer, dtype=np.float32)
+    if not np.all(np.isfinite(layer)):
+        raise ValueError("Can't quantize non-finite values!")
+
+    low = min(float(layer.min()), 0.0) if layer.size else 0.0
+    high = max(float(layer.max()), 0.0) if layer.size else 0.0
+    if high == low:
+        return np.zeros(layer.shape, dtype=np.int8), 1.0, 0
+
+    scale = (high - low) / (INT8_MAX - INT8_MIN)
+    zero_point = int(round(INT8_MIN - low / scale))
+    zero_point = min(max(zero_point, INT8_MIN), INT8_MAX)
+
+    scaled = np.divide(layer, scale, dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    np.add(scaled, zero_point, out=scaled)
+    np.clip(scaled, INT8_MIN, INT8_MAX, out=scaled)
+    return scaled.astype(np.int8), scale, zero_point
+
+def _is_flat(update):
+    return isinstance(update, np.ndarray) and update.dtype != object
@@ -0,0 +1,196 @@
+import os
+import time
+import hashlib
+import threading
+
+
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 1 << 30))
+MAX_PENDING_UPLOADS = int(os.environ.get("MAX_PENDING_UPLOADS", 64))
+MAX_STAGED_SIZE = int(os.environ.get("MAX_STAGED_SIZE", 4 << 30))
+UPLOAD_TIMEOUT = 600
+
+class ChunkedUpload(object):
+    """
+    The staging buffer of an update uploaded in chunks (see `UploadStore`).
+
+    Chunks are kept as they arrive, so the buffer only grows with the data
+    that's actually been received, and they're only joined once the upload
+    is committed.
+
+    Args:
+        sha256 (str): The SHA-256 hex digest of the whole update.
+        total_size (int): The size of the update in bytes.
+        chunk_size (int): The size of every chunk (but the last one) in bytes.
+        is_binary (bool): Whether the update is a binary tensor frame (see
+            `tensor_frames.py`) instead of JSON.
+    """
+
+    def __init__(self, sha256, total_size, chunk_size, is_binary):
+        self.sha256 = sha256
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.is_binary = is_binary
+        self.num_chunks = -(-total_size // chunk_size)
+        self.last_activity = time.time()
+        self._chunks = {}
+
+    def matches(self, total_size, chunk_size, is_binary):
+        """
+        Whether the upload has the given parameters.
+        """
+        return (self.total_size, self.chunk_size, self.is_binary) \
+            == (total_size, chunk_size, is_binary)
+
+    def write(self, index, data):
+        """
+        Copy a chunk into the staging buffer. A chunk that's sent again
+        replaces the previous copy.
+
+        Args:
+            index (int): The index of the chunk.
+            data (bytes or np.ndarray): The data of the chunk.
+        """
+        if not 0 <= index < self.num_chunks:
+            raise ValueError("Chunk index {} out of bounds!".format(index))
+
+        start = index * self.chunk_size
+        size = min(self.chunk_size, self.total_size - start)
+        data = memoryview(data).cast("B")
+        if len(data) != size:
+            raise ValueError("Chunk {0} has {1} bytes, expected {2}!".format(
+                index, len(data), size))
+
+        self._chunks[index] = data.tobytes()
+        self.last_activity = time.time()
+
+    def missing(self):
+        """
+        Get the indices of the chunks that haven't been received yet.
+
+        Returns:
+            list: The indices of the missing chunks.
+        """
+        return [index for index in range(self.num_chunks) \
+            if index not in self._chunks]
+
+    @property
+    def complete(self):
+        """
+        Whether every chunk has been received.
+        """
+        return len(self._chunks) == self.num_chunks
+
+    def payload(self):
+        """
+        Get the reassembled update, after checking its hash.
+
+        Returns:
+            bytes: The update.
+        """
+        payload = b"".join(self._chunks[index] \
+            for index in range(self.num_chunks))
+        if hashlib.sha256(payload).hexdigest() != self.sha256:
+            raise ValueError("The upload doesn't match its SHA-256 hash!")
+        return payload
+
+class UploadStore(object):
+    """
+    Keeps the staging buffers of the updates being uploaded in chunks, keyed
+    by repo and hash of the update.
+
+    Since uploads aren't tied to a connection, a node that reconnects in the
+    middle of an upload can resume it, only sending the missing chunks.
+    Uploads that haven't received any chunk in `timeout` seconds are
+    discarded.
+
+    NOTE: Besides the size of every upload, the total size of the pending
+    uploads is capped too, since they can all fill up at the same time.
+
+    Args:
+        max_uploads (int, optional): The maximum number of pending uploads.
+        max_upload_size (int, optional): The maximum size of an upload in
+            bytes.
+        max_staged_size (int, optional): The maximum total size of the
+            pending uploads in bytes.
+        timeout (float, optional): How long to keep an idle upload around,
+            in seconds.
+    """
+
+    def __init__(self, max_uploads=MAX_PENDING_UPLOADS, \
+            max_upload_size=MAX_UPLOAD_SIZE, max_staged_size=MAX_STAGED_SIZE, \
+            timeout=UPLOAD_TIMEOUT):
+        self.max_uploads = max_uploads
+        self.max_upload_size = max_upload_size
+        self.max_staged_size = max_staged_size
+        self.timeout = timeout
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def begin(self, repo_id, sha256, total_size, chunk_size, is_binary):
+        """
+        Start an upload, or resume it if it's already pending.
+
+        Args:
+            repo_id (str): The repo ID.
+            sha256 (str): The SHA-256 hex digest of the whole update.
+            total_size (int): The size of the update in bytes.
+            chunk_size (int): The size of every chunk in bytes.
+            is_binary (bool): Whether the update is a binary tensor frame.
+
+        Returns:
+            ChunkedUpload: The upload.
+        """
+        if not 0 < total_size <= self.max_upload_size:
+            raise ValueError("Upload size must be between 1 and {} bytes!" \
+                .format(self.max_upload_size))
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be positive!")
+
+        key = (repo_id, sha256)
+        with self._lock:
+            self._expire()
+            upload = self._uploads.get(key)
+            if upload is not None \
+                    and upload.matches(total_size, chunk_size, is_binary):
+                upload.last_activity = time.time()
+                return upload
+
+            if upload is None and len(self._uploads) >= self.max_uploads:
+                raise ValueError("Too many pending uploads!")
+            staged_size = sum(other.total_size \
+                for other in self._uploads.values() if other is not upload)
+            if staged_size + total_size > self.max_staged_size:
+                raise ValueError("Too many bytes in pending uploads!")
+            upload = ChunkedUpload(sha256, total_size, chunk_size, is_binary)
+            self._uploads[key] = upload
+            return upload
+
+    def get(self, repo_id, sha256):
+        """
+        Get a pending upload.
+
+        Returns:
+            ChunkedUpload: The upload, or `None` if there's no such upload.
+        """
+        with self._lock:
+            return self._uploads.get((repo_id, sha256))
+
+    def discard(self, repo_id, sha256):
+        """
+        Discard an upload and its staging buffer.
+        """
+        with self._lock:
+            self._uploads.pop((repo_id, sha256), None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._uploads)
+
+    def _expire(self):
+        """
+        Discard the uploads that have been idle for too long.
+        """
+        now = time.time()
+        for key, upload in list(self._uploads.items()):
+            if now - upload.last_activity > self.timeout:
+                del self._uploads[key]
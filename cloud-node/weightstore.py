@@ -0,0 +1,121 @@
+import json
+import shutil
+
+import h5py
+import numpy as np
+
+
+class H5WeightStore(object):
+    """
+    Reads and writes the weights of a Keras `.h5` model directly with h5py, so
+    that neither TensorFlow nor Keras have to be loaded to update a model.
+
+    The layer -> dataset mapping is read once (the topology of the model
+    doesn't change during a session) and reused for every model of the
+    session. Weights are listed in the same order as `model.get_weights()`,
+    i.e. layer by layer, following the `weight_names` of each layer.
+
+    Args:
+        h5_model_path (str): Path to any `.h5` model of the session.
+    """
+
+    def __init__(self, h5_model_path):
+        self.layer_names = []
+        self.weight_names = []
+        self.dataset_paths = []
+        self.dataset_layers = []
+        self.shapes = []
+        self.learning_rate = None
+
+        with h5py.File(h5_model_path, "r") as f:
+            root = "model_weights" if "model_weights" in f else "/"
+            weights_group = f[root]
+            for layer_name in _decode_names(weights_group.attrs["layer_names"]):
+                layer_group = weights_group[layer_name]
+                weight_names = _decode_names(layer_group.attrs["weight_names"])
+                if weight_names:
+                    self.layer_names.append(layer_name)
+                for weight_name in weight_names:
+                    dataset = layer_group[weight_name]
+                    self.weight_names.append(weight_name)
+                    self.dataset_paths.append(dataset.name)
+                    self.dataset_layers.append(layer_name)
+                    self.shapes.append(dataset.shape)
+
+            if "training_config" in f.attrs:
+                self.learning_rate = _read_learning_rate(f.attrs["training_config"])
+
+    def get_weights(self, h5_model_path):
+        """
+        Read the weights of the model at the given path.
+
+        Args:
+            h5_model_path (str): Path to the `.h5` model.
+
+        Returns:
+            list: The weights of the model, as numpy arrays.
+        """
+        with h5py.File(h5_model_path, "r") as f:
+            return [f[path][()] for path in self.dataset_paths]
+
+    def get_layer_weights(self, weights):
+        """
+        Group a list of weights (in `get_weights()` order) by layer.
+
+        Args:
+            weights (list): The weights of the model.
+
+        Returns:
+            dict: The weights of every layer with weights, keyed by layer name.
+        """
+        layer_weights = {}
+        for layer_name, weight in zip(self.dataset_layers, weights):
+            layer_weights.setdefault(layer_name, []).append(weight)
+        return layer_weights
+
+    def set_weights(self, h5_model_path, weights):
+        """
+        Overwrite the weights of the model at the given path, in place.
+
+        Args:
+            h5_model_path (str): Path to the `.h5` model.
+            weights (list): The new weights, in `get_weights()` order.
+        """
+        if len(weights) != len(self.dataset_paths):
+            raise ValueError("Model has {0} weights, got {1}!".format(
+                len(self.dataset_paths), len(weights)))
+
+        with h5py.File(h5_model_path, "r+") as f:
+            for path, shape, weight in zip(self.dataset_paths, self.shapes, \
+                    weights):
+                f[path][...] = np.reshape(weight, shape)
+
+    def save_weights(self, old_h5_model_path, new_h5_model_path, weights):
+        """
+        Copy the model at `old_h5_model_path` to `new_h5_model_path` and
+        overwrite the weights of the copy, leaving the old model untouched.
+
+        Args:
+            old_h5_model_path (str): Path to the current `.h5` model.
+            new_h5_model_path (str): Path to write the updated model to.
+            weights (list): The new weights, in `get_weights()` order.
+        """
+        shutil.copyfile(old_h5_model_path, new_h5_model_path)
+        self.set_weights(new_h5_model_path, weights)
+
+def _decode_names(names):
+    """
+    Decode the (possibly byte string) names stored in an h5 attribute.
+    """
+    return [name.decode("utf8") if isinstance(name, bytes) else str(name) \
+        for name in names]
+
+def _read_learning_rate(training_config):
+    """
+    Read the learning rate of the optimizer from the model's training config.
+    """
+    if isinstance(training_config, bytes):
+        training_config = training_config.decode("utf8")
+    optimizer_config = json.loads(training_config)["optimizer_config"]["config"]
+    learning_rate = optimizer_config.get("learning_rate", optimizer_config.get("lr"))
+    return float(learning_rate) if learning_rate is not None else None
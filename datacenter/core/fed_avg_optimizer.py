@@ -8,6 +8,8 @@ from core.utils.dmljob 					import (DMLJob, DMLAverageJob, DMLCommunicateJob, DM
 												DMLInitializeJob, DMLSplitJob, DMLTrainJob, DMLValidateJob)
 from core.utils.keras 					import serialize_weights, deserialize_weights
 from core.utils.dmlresult 				import DMLResult
+from core.utils.update_encoding 		import decode_update, DEFAULT_UPDATE_ENCODING
+from core.utils.sparsify 				import sparsify_update
 
 import logging
 import os
@@ -54,7 +56,10 @@ class FederatedAveragingOptimizer(object):
 	def received_new_message(self, serialized_job):
 		session_id = serialized_job.get("session_id")
 		round = serialized_job.get("round")
-		if self.job_data.get("curr_round", 0) >= round:
+		# NOTE: In asynchronous sessions, we may train in the same round
+		# (version of the model) more than once.
+		if not serialized_job.get("asynchronous") \
+				and self.job_data.get("curr_round", 0) >= round:
 			self.logger.error("Received job for unexpected round {}, ignoring...".format(round))
 			return {"success": False}
 
@@ -69,7 +74,13 @@ class FederatedAveragingOptimizer(object):
 			return self.new_job(serialized_job, session_id)
 
 	def _continue_training(self, serialized_job, session_id):
-		self.job_data["gradients"] = serialized_job.get("gradients")
+		gradients = serialized_job.get("gradients")
+		if gradients is not None:
+			gradients = decode_update(gradients,
+									  serialized_job.get("encoding", DEFAULT_UPDATE_ENCODING),
+									  serialized_job.get("scales"),
+									  serialized_job.get("zero_points"))
+		self.job_data["gradients"] = gradients
 		return self.kickoff(session_id)
 
 	def new_job(self, serialized_job, session_id):
@@ -84,6 +95,7 @@ class FederatedAveragingOptimizer(object):
 		self.logger.info("We are communicating with gradients!")
 		self.job_data["h5_model_folder"] = None
 		self.job_data["gradients"] = None
+		self.job_data["residual"] = None
 		return self.kickoff(session_id)
 		
 
@@ -149,15 +161,27 @@ class FederatedAveragingOptimizer(object):
 		"LEVEL 2" Callback for a training job that just completed. Returns a
 		DML Job of type communication and modifies the current state of the job.
 
+		If the session sets `update_sparsity`, only that fraction of the
+		gradients (the largest ones of every layer) is sent, and the rest is
+		kept in a residual that is added to the next round's gradients.
+
 		NOTE: Assumes that the training succeeded. In the future, we may care
 		about a degree of accuracy needing to be reached before updating the
 		weights.
 		"""
 		results = dmlresult_obj.results
+		sparsity = self.job_data["hyperparams"].get("update_sparsity")
+		if sparsity:
+			sparse_update, self.job_data["residual"] = sparsify_update(
+				results["gradients"], sparsity, self.job_data.get("residual"))
+			results["gradients"] = sparse_update["values"]
+			results["indices"] = sparse_update["indices"]
+			results["shapes"] = sparse_update["shapes"]
 		results["success"] = True
 		return results
 
 	def clear_session(self):
+		self.job_data["residual"] = None
 		h5_model_folder = self.job_data["h5_model_folder"]
 		if h5_model_folder:
 			h5_model_filepath = os.path.join(h5_model_folder, 'model.h5')
@@ -117,9 +117,12 @@ class DMLRunner(object):
                 model = load_model(h5_model_filepath)
                 gradients = job.gradients
                 learning_rate = model.optimizer.lr
-                new_weights = np.subtract(model.get_weights(), gradients)
-                model.set_weights(new_weights)
-                model.save(h5_model_filepath)
+                # NOTE: There are no gradients if the model is still the latest
+                # one, or was just reloaded (in asynchronous sessions).
+                if gradients is not None:
+                    new_weights = np.subtract(model.get_weights(), gradients)
+                    model.set_weights(new_weights)
+                    model.save(h5_model_filepath)
             else:
                 h5_model_folder = os.path.join('sessions', job.session_id)
                 h5_model_filepath = os.path.join(h5_model_folder, 'model.h5')
@@ -182,7 +185,7 @@ class DMLRunner(object):
             "Model type '{0}' is not supported.".format(job.framework_type)
 
         if job.framework_type == 'keras':
-            trained_model, result_val = train_keras_model(
+            trained_model, result_val, train_metrics = train_keras_model(
                 job.model,
                 dataset_iterator,
                 data_count_mappings['train.csv'],
@@ -208,6 +211,7 @@ class DMLRunner(object):
 
         train_results = {
             'omega': omega,
+            'metrics': train_metrics,
         }
 
         train_results['gradients'] = result_val
@@ -19,19 +19,29 @@ def train_keras_model(model, dataset_iterator, data_count,
     logger.info('Keras training just started.')
     accumulated_gradients = None
     total_loss = 0
+    total_accuracy = 0
     batch = 1
     for X, y in dataset_iterator:
         learning_rate = model.optimizer.lr
         loss, accuracy = model.train_on_batch(X, y)
         print("Finished training on batch {0} with loss {1} and accuracy {2}".format(batch, loss, accuracy))
+        total_loss += float(loss)
+        total_accuracy += float(accuracy)
         gradients = calculate_gradients(model, X, y)
         if accumulated_gradients is None:
             accumulated_gradients = np.zeros(gradients.shape)
         accumulated_gradients = np.add(accumulated_gradients, np.multiply(gradients, learning_rate))
         batch += 1
-    accumulated_gradients = [K.eval(gradient).tolist() for gradient in accumulated_gradients]
+    accumulated_gradients = [np.asarray(K.eval(gradient), dtype=np.float32) for gradient in accumulated_gradients]
+    num_batches = max(batch - 1, 1)
+    # NOTE: Reported to the cloud node, which stops the session early once
+    # they plateau.
+    metrics = {
+        'loss': total_loss / num_batches,
+        'accuracy': total_accuracy / num_batches,
+    }
     logger.info('Keras training complete.')
-    return model, accumulated_gradients
+    return model, accumulated_gradients, metrics
 
 def calculate_gradients(model, X, y):
     weights = model.trainable_weights # weight tensors
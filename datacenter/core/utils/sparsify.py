@@ -0,0 +1,43 @@
+import math
+
+import numpy as np
+
+
+def sparsify_update(gradients, ratio, residual=None):
+    """
+    Keep only the top-k magnitude entries of every layer of an update, with
+    error feedback: the entries that aren't sent are carried over in a
+    residual and added to the next round's update.
+
+    Args:
+        gradients (list): The update, one array per layer.
+        ratio (float): The fraction of the entries of every layer to keep.
+        residual (list, optional): The residual of the previous rounds, one
+            flat array per layer.
+
+    Returns:
+        tuple: The sparse update (a dict with the `indices`, `values` and
+            `shapes` of every layer) and the new residual.
+    """
+    sparse_update = {"indices": [], "values": [], "shapes": []}
+    new_residual = []
+    for i, gradient in enumerate(gradients):
+        gradient = np.asarray(gradient, dtype=np.float32)
+        flat = gradient.ravel().copy()
+        if residual is not None:
+            flat += residual[i]
+
+        k = min(max(int(math.ceil(ratio * flat.size)), 1), flat.size)
+        indices = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:] \
+            if k else np.zeros(0, dtype=np.int64)
+        indices.sort()
+        index_dtype = np.int32 if flat.size < 2**31 else np.int64
+
+        sparse_update["indices"].append(indices.astype(index_dtype))
+        sparse_update["values"].append(flat[indices])
+        sparse_update["shapes"].append(list(gradient.shape))
+
+        flat[indices] = 0
+        new_residual.append(flat)
+
+    return sparse_update, new_residual
@@ -6,8 +6,16 @@ import logging
 import requests
 import urllib.request
 import os
+import base64
+import hashlib
+import time
+import uuid
+
+import numpy as np
 
 from core.utils.enums import RawEventTypes, MessageEventTypes
+from core.utils.tensor_frames import encode_frame, decode_frame
+from core.utils.update_encoding import encode_update, DEFAULT_UPDATE_ENCODING
 from websockets.client import WebSocketClientProtocol
 
 from functools import singledispatch
@@ -18,8 +26,16 @@ def to_serializable(val):
     """Used by default."""
     return str(val)
 
+@to_serializable.register(np.ndarray)
+def ndarray_to_serializable(val):
+    """Used for numpy arrays."""
+    return val.tolist()
+
 busy = False
 
+# Updates bigger than this are uploaded in chunks of this size.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 class ClientWebSocketProtocol(WebSocketClientProtocol):
     def onPing():
         print("Ping received from {}".format(self.peer))
@@ -39,6 +55,14 @@ class WebSocketClient(object):
         self.logger = logging.getLogger("WebSocketClient")
         self.logger.info("WebSocketClient {} set up!".format(repo_id))
         self.message_to_send = None
+        self.binary_frames = False
+        # NOTE: Kept across reconnections, so the cloud node keeps the
+        # performance history of this node.
+        self.client_id = str(uuid.uuid4())
+        self._pending_upload = None
+        # NOTE: Reused for every delta, so the connection is kept alive.
+        self._http = requests.Session()
+        self._delta = None
 
     async def prepare_dml(self):
         stop_received = False
@@ -59,24 +83,44 @@ class WebSocketClient(object):
                     print(json_response)
                     assert 'action' in json_response, 'No action found: {}'.format(str(json_response))
                     if json_response['action'] == 'TRAIN':
+                        if self._can_resume_upload(json_response):
+                            # We reconnected in the middle of uploading this round's update.
+                            self.logger.info('Resuming upload of update...')
+                            await self.send_upload_begin(websocket)
+                            continue
+                        self._pending_upload = None
                         self.logger.info('Received TRAIN message, beginning training...')
+                        download_started = time.time()
                         url = "{0}/keras/{1}".format(self._cloud_url, json_response["session_id"])
-                        if json_response["round"] == 1:
+                        # NOTE: In asynchronous sessions, the whole model is
+                        # reloaded if the one we have is too old for the delta.
+                        if json_response["round"] == 1 or json_response.get("reload_model"):
                             h5_model_folder = os.path.join('sessions', json_response['session_id'])
                             h5_model_filepath = os.path.join(h5_model_folder, 'model.h5')
                             if not os.path.isdir(h5_model_folder):
                                 os.makedirs(h5_model_folder)
                             urllib.request.urlretrieve(url, h5_model_filepath)
+                        if "delta_url" in json_response:
+                            json_response.update(self.fetch_delta(json_response["delta_url"], json_response["delta_hash"]))
+                        timings = {"download": time.time() - download_started}
                         results = self._optimizer.received_new_message(json_response)
                         if not results["success"]:
                             break
-                        await self.send_new_weights(websocket, results, json_response['session_id'], json_response['round'])
+                        update_encoding = json_response["hyperparams"].get("update_encoding", DEFAULT_UPDATE_ENCODING)
+                        await self.send_new_weights(websocket, results, json_response['session_id'], json_response['round'], update_encoding, timings)
                         #self.reconnections_remaining = 1
                     elif json_response['action'] == 'REGISTRATION_SUCCESS':
                         self.logger.info("Registration successful!")
+                        self.binary_frames = json_response.get("binary_frames", False)
+                        if self._pending_upload and not self._pending_upload["committed"]:
+                            self.logger.info('Resuming upload of update...')
+                            await self.send_upload_begin(websocket)
+                    elif json_response['action'] == 'UPLOAD_STATUS':
+                        await self.send_upload_chunks(websocket, json_response['sha256'], json_response['missing_chunks'])
                     elif json_response['action'] == 'STOP':
                         self.logger.info('Received STOP message, terminating...')
                         stop_received = True
+                        self._pending_upload = None
                         self._optimizer.clear_session()
                         break
                     else:
@@ -88,27 +132,133 @@ class WebSocketClient(object):
             "node_type": "LIBRARY",
             "repo_id": self.repo_id,
             "api_key": self.api_key,
+            "binary_frames": True,
+            "client_id": self.client_id,
         }
         self.logger.info("Sending register message for {}".format(self.repo_id))
         await websocket.send(json.dumps(registration_message))
 
 
-    async def send_new_weights(self, websocket, results, session_id, round):
+    async def send_new_weights(self, websocket, results, session_id, round, update_encoding=DEFAULT_UPDATE_ENCODING, timings=None):
+        if "gradients" in results:
+            gradients, encoding_params = encode_update(results["gradients"], update_encoding)
+            results = dict(results, gradients=gradients, **encoding_params)
         new_weights_message = {
             "type": "NEW_UPDATE",
             "repo_id": self.repo_id,
             "session_id": session_id,
             "action": "TRAIN",
-            "results": results,
+            # NOTE: The round goes before the results, so that the cloud node
+            # can drop a late update without decoding them.
             "round": round,
+            # NOTE: Lets the cloud node tell the download and training times
+            # apart when it chooses the nodes of a round.
+            "timings": timings or {},
+            "results": results,
         }
         self.logger.info("Sending new weights for {}".format(self.repo_id))
         try:
-            await websocket.send(json.dumps(new_weights_message, default=to_serializable))
+            if self.binary_frames:
+                payload = encode_frame(new_weights_message)
+            else:
+                payload = json.dumps(new_weights_message, default=to_serializable).encode()
+            if len(payload) > UPLOAD_CHUNK_SIZE:
+                self._pending_upload = {
+                    "sha256": hashlib.sha256(payload).hexdigest(),
+                    "payload": payload,
+                    "binary": self.binary_frames,
+                    "session_id": session_id,
+                    "round": round,
+                    "committed": False,
+                }
+                await self.send_upload_begin(websocket)
+            elif self.binary_frames:
+                await websocket.send(payload)
+            else:
+                await websocket.send(payload.decode())
         except Exception as e:
             print("Error sending weights!: " + str(e))            
             return {"success": False}          
 
+    async def send_upload_begin(self, websocket):
+        """
+        Start (or resume) uploading the pending update in chunks. The cloud
+        node replies with the chunks it still needs.
+        """
+        upload = self._pending_upload
+        begin_message = {
+            "type": "UPDATE_BEGIN",
+            "repo_id": self.repo_id,
+            "sha256": upload["sha256"],
+            "total_size": len(upload["payload"]),
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "binary": upload["binary"],
+        }
+        self.logger.info("Uploading new weights in chunks for {}".format(self.repo_id))
+        await websocket.send(json.dumps(begin_message))
+
+    async def send_upload_chunks(self, websocket, sha256, missing_chunks):
+        """
+        Send the chunks of the pending update the cloud node is missing and
+        commit the upload.
+        """
+        upload = self._pending_upload
+        if upload is None or upload["sha256"] != sha256:
+            self.logger.info("Status received for unknown upload, ignoring...")
+            return
+
+        for index in missing_chunks:
+            start = index * UPLOAD_CHUNK_SIZE
+            data = upload["payload"][start:start+UPLOAD_CHUNK_SIZE]
+            chunk_message = {
+                "type": "UPDATE_CHUNK",
+                "repo_id": self.repo_id,
+                "sha256": sha256,
+                "index": index,
+            }
+            if self.binary_frames:
+                chunk_message["data"] = np.frombuffer(data, dtype=np.uint8)
+                await websocket.send(encode_frame(chunk_message))
+            else:
+                chunk_message["data"] = base64.b64encode(data).decode()
+                await websocket.send(json.dumps(chunk_message))
+
+        commit_message = {
+            "type": "UPDATE_COMMIT",
+            "repo_id": self.repo_id,
+            "sha256": sha256,
+        }
+        await websocket.send(json.dumps(commit_message))
+        upload["committed"] = True
+
+    def fetch_delta(self, delta_url, delta_hash):
+        """
+        Fetch the averaged gradients of the last round from the cloud node,
+        unless they were already fetched, and check them against their hash.
+        """
+        if self._delta is not None and self._delta[0] == delta_hash:
+            return self._delta[1]
+
+        self.logger.info("Fetching delta for {}".format(self.repo_id))
+        response = self._http.get(self._cloud_url + delta_url)
+        response.raise_for_status()
+        payload = response.content
+        if hashlib.sha256(payload).hexdigest() != delta_hash:
+            raise ValueError("The delta doesn't match its hash!")
+        delta = decode_frame(payload)
+        self._delta = (delta_hash, delta)
+        return delta
+
+    def _can_resume_upload(self, train_message):
+        """
+        Whether the TRAIN message is for the round whose update was being
+        uploaded when the connection was lost.
+        """
+        upload = self._pending_upload
+        return upload is not None and not upload["committed"] \
+            and upload["session_id"] == train_message["session_id"] \
+            and upload["round"] == train_message["round"]
+
     async def listen(self, websocket):
         try:
             response = await websocket.recv()
@@ -119,7 +269,10 @@ class WebSocketClient(object):
             
         self.logger.info("Received message for {}!".format(self.repo_id))
         #self.logger.info("Message is: {}".format(response))
-        json_response = json.loads(response)
+        if isinstance(response, bytes):
+            json_response = decode_frame(response)
+        else:
+            json_response = json.loads(response)
         json_response["success"] = True
         return json_response
 